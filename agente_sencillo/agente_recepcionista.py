@@ -1,6 +1,8 @@
+import os
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from llm import llm
+from clasificador_intencion import ClasificadorIntencion, cargar_ejemplos, registrar_ejemplo
 
 prompt_router = PromptTemplate(
     input_variables=["mensaje"],
@@ -24,3 +26,24 @@ router_chain = LLMChain(
     llm=llm,
     prompt=prompt_router
 )
+
+# Clasificador local (CPU): solo se llama al LLM cuando no está seguro
+UMBRAL_CONFIANZA = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.8"))
+INTENT_LOG_PATH = os.getenv("INTENT_LOG_PATH", "")
+clasificador = ClasificadorIntencion(cargar_ejemplos(INTENT_LOG_PATH))
+
+
+def enrutar(mensaje: str) -> str:
+    """
+    Decide "crear" o "consultar", primero con el clasificador local y,
+    si la confianza no supera el umbral, con router_chain.
+    """
+    decision, confianza = clasificador.clasificar(mensaje)
+    if confianza >= UMBRAL_CONFIANZA:
+        return decision
+
+    decision = router_chain.invoke(
+        {"mensaje": mensaje}
+    )["text"].strip().lower()
+    registrar_ejemplo(INTENT_LOG_PATH, mensaje, decision)
+    return decision
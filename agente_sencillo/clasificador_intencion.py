@@ -0,0 +1,241 @@
+import json
+import os
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+
+# Ejemplos semilla (los del prompt del recepcionista y variantes habituales).
+# Se amplían con el tráfico registrado en INTENT_LOG_PATH.
+EJEMPLOS_SEMILLA: List[Tuple[str, str]] = [
+    ("Crea un cliente", "crear"),
+    ("Crear cliente nuevo", "crear"),
+    ("Quiero crear un cliente", "crear"),
+    ("Quiero registrar un cliente", "crear"),
+    ("Registra a Juan con email juan@gmail.com", "crear"),
+    ("Agrega un cliente llamado Pedro", "crear"),
+    ("Añade a María como cliente", "crear"),
+    ("Guarda este cliente", "crear"),
+    ("Dar de alta un cliente", "crear"),
+    ("Nuevo cliente", "crear"),
+    ("Su nombre es Juan", "crear"),
+    ("Mi nombre es Laura", "crear"),
+    ("Se llama Carlos", "crear"),
+    ("Mi correo es juan@email.com", "crear"),
+    ("El email es ana@empresa.com", "crear"),
+    ("Registrar cliente Ana ana@correo.com", "crear"),
+    ("Agregar nuevo cliente a la base de datos", "crear"),
+    ("Lista los clientes", "consultar"),
+    ("Listar todos los clientes", "consultar"),
+    ("Muéstrame los clientes", "consultar"),
+    ("Ver clientes", "consultar"),
+    ("Quiero ver los clientes", "consultar"),
+    ("¿Qué clientes hay?", "consultar"),
+    ("Busca el cliente Juan", "consultar"),
+    ("Muéstrame los que tienen gmail", "consultar"),
+    ("Solo los de hotmail", "consultar"),
+    ("¿Cuántos clientes hay registrados?", "consultar"),
+    ("Consultar clientes", "consultar"),
+    ("Dame la lista de clientes", "consultar"),
+    ("Enséñame todos los clientes", "consultar"),
+    ("¿Existe un cliente llamado Pedro?", "consultar"),
+    ("Mostrar clientes ordenados por nombre", "consultar"),
+    ("Filtra los que empiezan por A", "consultar"),
+    ("¿Qué clientes están registrados?", "consultar"),
+    ("Qué clientes tengo guardados", "consultar"),
+    ("Clientes creados hoy", "consultar"),
+    ("¿Hay algún cliente dado de alta con gmail?", "consultar"),
+    ("¿Está registrado juan@gmail.com?", "consultar"),
+    ("Clientes agregados esta semana", "consultar"),
+]
+
+# Reglas de palabras clave (sobre texto normalizado, sin tildes). Los participios
+# ("registrados", "creados", "dado de alta") describen clientes que ya existen:
+# son consultas, así que la regla de crear no los cuenta
+REGLAS: Dict[str, re.Pattern] = {
+    "crear": re.compile(
+        r"\b(crea(?!d)\w*|registra(?!d)\w*|agrega(?!d)\w*|anade\w*|anadir|guarda(?!d)\w*|"
+        r"(?<!dado de )(?<!dada de )(?<!dados de )(?<!dadas de )alta|inscrib\w*|nuevo cliente)\b"
+    ),
+    "consultar": re.compile(
+        r"\b(lista\w*|ver|veo|muestra\w*|mostrar|busca\w*|consulta\w*|cuantos|cuantas|existe\w*|"
+        r"filtra\w*|ensen\w*|dame|solo los|solo las)\b"
+    ),
+}
+
+PATRON_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+# Preguntas ("¿...?" o que empiezan por un interrogativo): la regla de crear no es
+# concluyente en ellas ("¿está registrado ...?") y decide el modelo o el LLM
+PATRON_PREGUNTA = re.compile(
+    r"^\s*(?:\S*\?|que|cual\w*|cuant\w*|quien\w*|donde|como|hay|esta|estan|tengo|tienes)\b"
+)
+# Preguntas del agente de creación que indican que el usuario está completando datos
+PATRON_PIDE_DATOS = re.compile(r"(nombre|email|correo)[^?]*\?")
+
+CONFIANZA_REGLA = 0.95
+CONFIANZA_CONTINUACION = 0.9
+
+
+def normalizar(texto: str) -> str:
+    """
+    Pasa a minúsculas y elimina tildes y signos de puntuación.
+    """
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r"[^\w@.\s]", " ", texto)
+
+
+def _caracteristicas(texto: str) -> List[str]:
+    """
+    Palabras + n-gramas de caracteres (3 a 5) dentro de cada palabra.
+    Los n-gramas hacen que "registrame" y "registrar" compartan rasgos.
+    """
+    palabras = normalizar(texto).split()
+    rasgos = [f"w:{p}" for p in palabras]
+    for p in palabras:
+        p = f"<{p}>"
+        for n in (3, 4, 5):
+            rasgos.extend(f"c:{p[i:i + n]}" for i in range(len(p) - n + 1))
+    return rasgos
+
+
+class ClasificadorIntencion:
+    """
+    Clasificador local (solo CPU) de la intención "crear" / "consultar".
+
+    Combina tres etapas, de la más barata a la más cara:
+    1. Reglas de palabras clave
+    2. Continuación de un flujo de creación (el asistente acaba de pedir nombre/email)
+    3. Regresión logística sobre TF-IDF (NumPy) entrenada con los ejemplos
+
+    Devuelve siempre una decisión y una confianza; quien lo usa decide si la
+    confianza es suficiente o si hay que consultar al LLM.
+    """
+
+    CLASES = ("consultar", "crear")
+
+    def __init__(self, ejemplos: Optional[Iterable[Tuple[str, str]]] = None):
+        self.entrenar(list(ejemplos) if ejemplos is not None else EJEMPLOS_SEMILLA)
+
+    def entrenar(self, ejemplos: Sequence[Tuple[str, str]], iteraciones: int = 300, lr: float = 0.5, l2: float = 1e-3):
+        """
+        Ajusta el vocabulario TF-IDF y la regresión logística.
+
+        Args:
+            ejemplos: Lista de (mensaje, decision)
+            iteraciones: Pasos de descenso de gradiente
+            lr: Tasa de aprendizaje
+            l2: Regularización L2
+        """
+        ejemplos = [(m, d) for m, d in ejemplos if d in self.CLASES]
+        documentos = [_caracteristicas(m) for m, _ in ejemplos]
+
+        vocabulario: Dict[str, int] = {}
+        for rasgos in documentos:
+            for r in rasgos:
+                vocabulario.setdefault(r, len(vocabulario))
+        self._vocabulario = vocabulario
+
+        df = np.zeros(len(vocabulario))
+        for rasgos in documentos:
+            for r in set(rasgos):
+                df[vocabulario[r]] += 1
+        self._idf = np.log((1 + len(documentos)) / (1 + df)) + 1
+
+        X = np.vstack([self._vectorizar(r) for r in documentos]) if documentos else np.zeros((0, len(vocabulario)))
+        y = np.array([self.CLASES.index(d) for _, d in ejemplos], dtype=float)
+
+        self._w = np.zeros(len(vocabulario))
+        self._b = 0.0
+        for _ in range(iteraciones if len(y) else 0):
+            p = 1 / (1 + np.exp(-(X @ self._w + self._b)))
+            error = p - y
+            self._w -= lr * (X.T @ error / len(y) + l2 * self._w)
+            self._b -= lr * error.mean()
+
+    def _vectorizar(self, rasgos: List[str]) -> np.ndarray:
+        vector = np.zeros(len(self._vocabulario))
+        for r in rasgos:
+            indice = self._vocabulario.get(r)
+            if indice is not None:
+                vector[indice] += 1
+        vector *= self._idf
+        norma = np.linalg.norm(vector)
+        return vector / norma if norma else vector
+
+    def probabilidades(self, mensaje: str) -> Dict[str, float]:
+        """
+        Probabilidad de cada clase según el modelo TF-IDF + logística.
+        """
+        x = self._vectorizar(_caracteristicas(mensaje))
+        p_crear = float(1 / (1 + np.exp(-(x @ self._w + self._b))))
+        return {"crear": p_crear, "consultar": 1 - p_crear}
+
+    def clasificar(self, mensaje: str, historial: Optional[Sequence] = None) -> Tuple[str, float]:
+        """
+        Clasifica un mensaje.
+
+        Args:
+            mensaje: Mensaje actual del usuario
+            historial: Mensajes anteriores (objetos con .type y .content), opcional
+
+        Returns:
+            Tuple[str, float]: (decision, confianza entre 0 y 1)
+        """
+        texto = normalizar(mensaje)
+
+        # 1. Reglas de palabras clave: solo son concluyentes si apuntan a una única clase
+        coincidencias = [clase for clase, patron in REGLAS.items() if patron.search(texto)]
+        es_pregunta = "?" in mensaje or PATRON_PREGUNTA.search(texto)
+        if len(coincidencias) == 1 and not (coincidencias[0] == "crear" and es_pregunta):
+            return coincidencias[0], CONFIANZA_REGLA
+
+        # 2. Continuación del flujo de creación: el asistente pidió nombre/email
+        if not coincidencias and historial:
+            ultimo_ai = next((m for m in reversed(historial) if m.type == "ai"), None)
+            if ultimo_ai is not None and PATRON_PIDE_DATOS.search(ultimo_ai.content.lower()):
+                if PATRON_EMAIL.search(mensaje) or len(texto.split()) <= 4:
+                    return "crear", CONFIANZA_CONTINUACION
+
+        # 3. Modelo estadístico
+        probabilidades = self.probabilidades(mensaje)
+        decision = max(probabilidades, key=probabilidades.get)
+        return decision, probabilidades[decision]
+
+
+def cargar_ejemplos(ruta: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Carga los ejemplos semilla más el tráfico registrado (JSONL con "mensaje" y "decision").
+
+    Args:
+        ruta: Ruta del fichero de tráfico (puede no existir)
+
+    Returns:
+        Lista de (mensaje, decision)
+    """
+    ejemplos = list(EJEMPLOS_SEMILLA)
+    if ruta and os.path.exists(ruta):
+        with open(ruta, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    registro = json.loads(linea)
+                    ejemplos.append((registro["mensaje"], registro["decision"]))
+                except (ValueError, KeyError):
+                    continue
+    return ejemplos
+
+
+def registrar_ejemplo(ruta: Optional[str], mensaje: str, decision: str):
+    """
+    Añade una decisión del LLM al fichero de tráfico para futuros entrenamientos.
+
+    Args:
+        ruta: Ruta del fichero de tráfico (si es vacía no se registra nada)
+        mensaje: Mensaje del usuario
+        decision: Decisión tomada por el LLM
+    """
+    if not ruta or decision not in ClasificadorIntencion.CLASES:
+        return
+    with open(ruta, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"mensaje": mensaje, "decision": decision}, ensure_ascii=False) + "\n")
@@ -1,15 +1,13 @@
 from database import engine, Base
 from agente_crear import agente_crear
 from agente_consultar import agente_consultar
-from agente_recepcionista import router_chain
+from agente_recepcionista import enrutar
 
 def init_db():
     Base.metadata.create_all(bind=engine)
 
 def procesar_mensaje(mensaje: str):
-    decision = router_chain.invoke(
-        {"mensaje": mensaje}
-    )["text"].strip().lower()
+    decision = enrutar(mensaje)
 
     print(f"\n🧭 Recepcionista decidió → {decision}")
 
@@ -1,22 +1,11 @@
-from langchain.agents import initialize_agent, AgentType
-from langchain.memory import ConversationBufferMemory
-from tools import consultar_clientes
+from langchain.agents import initialize_agent, AgentType, AgentExecutor
+from langchain.prompts import MessagesPlaceholder
+from tools import consultar_clientes, contar_clientes, buscar_clientes
 from llm import llm
+from config import AGENT_VERBOSE
 
 
-def crear_agente_con_memoria(memory: ConversationBufferMemory = None):
-    """
-    Crea el agente de consulta de clientes con memoria opcional.
-    Si no se pasa memoria, funciona sin historial.
-
-    Args:
-        memory: ConversationBufferMemory opcional con historial de la sesión
-
-    Returns:
-        Agente de LangChain configurado para consultar clientes
-    """
-    agent_kwargs = {
-        "prefix": """
+PREFIX = """
 Eres un agente que SOLO consulta información de clientes.
 
 IMPORTANTE: Revisa el historial de la conversación para entender el contexto completo.
@@ -24,29 +13,37 @@ El usuario puede estar refinando o filtrando una consulta anterior.
 
 Proceso:
 1. Revisa el historial para entender qué información busca el usuario
-2. Utiliza la herramienta consultar_clientes para obtener la lista
-3. Si el usuario pidió un filtro específico (por ejemplo, "solo los que tienen gmail"),
-   aplica ese filtro a los resultados
-4. Presenta la información de forma clara y organizada
+2. Traduce lo que pide a los argumentos de consultar_clientes (filtros, orden, límite).
+   Por ejemplo, "solo los que tienen gmail" → dominio_email="gmail".
+   NO pidas todos los clientes para filtrarlos tú: los filtros se aplican en la base de datos
+3. Si el usuario pregunta cuántos hay, usa contar_clientes
+   Si busca a alguien por un nombre o email concreto (aunque esté incompleto o mal escrito),
+   usa buscar_clientes
+4. Si pide "más" o "los siguientes", repite la consulta con el cursor indicado en el resultado anterior
+5. Presenta la información de forma clara y organizada
 
 Considera el contexto de mensajes anteriores para dar respuestas más precisas.
 """
-    }
-
-    if memory:
-        return initialize_agent(
-            tools=[consultar_clientes],
-            llm=llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True,
-            memory=memory,
-            agent_kwargs=agent_kwargs
-        )
-    else:
-        return initialize_agent(
-            tools=[consultar_clientes],
-            llm=llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True,
-            agent_kwargs=agent_kwargs
-        )
+
+
+def construir_agente() -> AgentExecutor:
+    """
+    Construye el agente de consulta de clientes.
+    El historial de la sesión NO se fija aquí: se pasa en cada invocación
+    mediante la variable "chat_history", por lo que el mismo agente puede
+    reutilizarse para todas las sesiones.
+
+    Returns:
+        AgentExecutor de LangChain configurado para consultar clientes
+    """
+    return initialize_agent(
+        tools=[consultar_clientes, contar_clientes, buscar_clientes],
+        llm=llm,
+        agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=AGENT_VERBOSE,
+        agent_kwargs={
+            "prefix": PREFIX,
+            "memory_prompts": [MessagesPlaceholder(variable_name="chat_history")],
+            "input_variables": ["input", "agent_scratchpad", "chat_history"],
+        }
+    )
@@ -1,22 +1,11 @@
-from langchain.agents import initialize_agent, AgentType
-from langchain.memory import ConversationBufferMemory
+from langchain.agents import initialize_agent, AgentType, AgentExecutor
+from langchain.prompts import MessagesPlaceholder
 from tools import crear_cliente
 from llm import llm
+from config import AGENT_VERBOSE
 
 
-def crear_agente_con_memoria(memory: ConversationBufferMemory = None):
-    """
-    Crea el agente de creación de clientes con memoria opcional.
-    Si no se pasa memoria, funciona sin historial.
-
-    Args:
-        memory: ConversationBufferMemory opcional con historial de la sesión
-
-    Returns:
-        Agente de LangChain configurado para crear clientes
-    """
-    agent_kwargs = {
-        "prefix": """
+PREFIX = """
 Eres un agente que SOLO crea clientes.
 
 IMPORTANTE: Antes de preguntar información, REVISA EL HISTORIAL DE LA CONVERSACIÓN.
@@ -36,22 +25,26 @@ Ejemplos:
 
 NO repitas preguntas que ya fueron respondidas en el historial.
 """
-    }
-
-    if memory:
-        return initialize_agent(
-            tools=[crear_cliente],
-            llm=llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True,
-            memory=memory,
-            agent_kwargs=agent_kwargs
-        )
-    else:
-        return initialize_agent(
-            tools=[crear_cliente],
-            llm=llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True,
-            agent_kwargs=agent_kwargs
-        )
+
+
+def construir_agente() -> AgentExecutor:
+    """
+    Construye el agente de creación de clientes.
+    El historial de la sesión NO se fija aquí: se pasa en cada invocación
+    mediante la variable "chat_history", por lo que el mismo agente puede
+    reutilizarse para todas las sesiones.
+
+    Returns:
+        AgentExecutor de LangChain configurado para crear clientes
+    """
+    return initialize_agent(
+        tools=[crear_cliente],
+        llm=llm,
+        agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=AGENT_VERBOSE,
+        agent_kwargs={
+            "prefix": PREFIX,
+            "memory_prompts": [MessagesPlaceholder(variable_name="chat_history")],
+            "input_variables": ["input", "agent_scratchpad", "chat_history"],
+        }
+    )
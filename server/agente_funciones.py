@@ -0,0 +1,91 @@
+from langchain.agents import AgentExecutor, create_openai_functions_agent
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.tools import BaseTool, StructuredTool
+from tools import crear_cliente, consultar_clientes, contar_clientes, buscar_clientes
+from llm import llm
+from config import AGENT_VERBOSE
+
+
+prompt_funciones = ChatPromptTemplate.from_messages([
+    ("system", """Eres el asistente de un sistema de gestión de clientes.
+
+Dispones de cuatro herramientas:
+- crear_cliente: registra un cliente. Requiere nombre y email.
+- consultar_clientes: lista clientes; los filtros (dominio de email, nombre) se aplican en la base de datos.
+- contar_clientes: cuenta clientes con los mismos filtros.
+- buscar_clientes: busca clientes por nombre o email aunque esté incompleto o mal escrito.
+
+Revisa el historial de la conversación: el usuario puede haber dado el nombre
+o el email en mensajes anteriores. Si quiere crear un cliente y tienes AMBOS datos,
+llama a crear_cliente directamente. Si falta alguno, pregunta SOLO por lo que falta.
+Si quiere ver o buscar clientes, llama a consultar_clientes con los filtros adecuados
+(por ejemplo, "los de gmail" → dominio_email="gmail"); si pregunta cuántos hay, a contar_clientes."""),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+    MessagesPlaceholder(variable_name="agent_scratchpad"),
+])
+
+
+
+def _devolver_directo(herramienta: BaseTool) -> BaseTool:
+    """
+    Copia una herramienta con return_direct=True. La salida de nuestras
+    herramientas ya es una respuesta para el usuario, así que no hace falta
+    otra llamada al LLM para redactarla: intención + ejecución en una sola ronda.
+    """
+    return StructuredTool.from_function(
+        func=herramienta.func,
+        name=herramienta.name,
+        description=herramienta.description,
+        args_schema=herramienta.args_schema,
+        return_direct=True
+    )
+
+
+HERRAMIENTAS = [
+    _devolver_directo(crear_cliente),
+    _devolver_directo(consultar_clientes),
+    _devolver_directo(contar_clientes),
+    _devolver_directo(buscar_clientes),
+]
+
+# Decisión equivalente a la del router según la herramienta que se llamó
+DECISION_POR_HERRAMIENTA = {
+    "crear_cliente": "crear",
+    "consultar_clientes": "consultar",
+    "contar_clientes": "consultar",
+    "buscar_clientes": "consultar",
+}
+
+
+def construir_agente() -> AgentExecutor:
+    """
+    Construye el agente de function calling que decide la intención y ejecuta
+    la herramienta en la misma llamada al LLM (modo ORCHESTRATION_MODE=funciones).
+
+    Returns:
+        AgentExecutor que devuelve también los pasos intermedios
+    """
+    agente = create_openai_functions_agent(llm, HERRAMIENTAS, prompt_funciones)
+    return AgentExecutor(
+        agent=agente,
+        tools=HERRAMIENTAS,
+        verbose=AGENT_VERBOSE,
+        return_intermediate_steps=True
+    )
+
+
+def decision_desde_pasos(pasos) -> str:
+    """
+    Deduce la decisión ("crear"/"consultar") a partir de los pasos intermedios.
+
+    Args:
+        pasos: intermediate_steps devueltos por el AgentExecutor
+
+    Returns:
+        str: "crear", "consultar" o "conversacion" si no se llamó a ninguna herramienta
+    """
+    for accion, _ in reversed(pasos):
+        if accion.tool in DECISION_POR_HERRAMIENTA:
+            return DECISION_POR_HERRAMIENTA[accion.tool]
+    return "conversacion"
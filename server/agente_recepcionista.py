@@ -2,6 +2,11 @@ from langchain.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceh
 from langchain.chains import LLMChain
 from langchain.agents import AgentExecutor, create_openai_functions_agent
 from llm import llm
+from limitador_llm import LLMNoDisponible
+from prompt_builder import recortar_historial
+from clasificador_intencion import ClasificadorIntencion, cargar_ejemplos, registrar_ejemplo
+from config import ROUTER_CONFIDENCE_THRESHOLD, INTENT_LOG_PATH
+import metrics
 
 
 # Plantilla de prompt para el router/recepcionista CON historial
@@ -54,6 +59,32 @@ router_chain = LLMChain(
     prompt=prompt_router
 )
 
+# Clasificador local (CPU) que evita la llamada al LLM cuando está seguro
+clasificador = ClasificadorIntencion(cargar_ejemplos(INTENT_LOG_PATH))
+
+decisiones_router = metrics.counter(
+    "router_decisions_total",
+    "Decisiones del router por fuente (local = clasificador, llm = gpt)"
+)
+
+
+def clasificar_local(mensaje: str, memory):
+    """
+    Intenta decidir sin LLM con el clasificador local.
+
+    Args:
+        mensaje: Mensaje actual del usuario
+        memory: Objeto ConversationBufferMemory con el historial
+
+    Returns:
+        str | None: La decisión si la confianza supera el umbral, None si hay que usar el LLM
+    """
+    decision, confianza = clasificador.clasificar(mensaje, memory.chat_memory.messages)
+    if confianza >= ROUTER_CONFIDENCE_THRESHOLD:
+        decisiones_router.inc(fuente="local", decision=decision)
+        return decision
+    return None
+
 
 def router_con_memoria(mensaje: str, memory):
     """
@@ -66,6 +97,10 @@ def router_con_memoria(mensaje: str, memory):
     Returns:
         str: "crear" o "consultar"
     """
+    decision = clasificar_local(mensaje, memory)
+    if decision:
+        return decision
+
     try:
         # Obtener el historial de mensajes
         chat_history = memory.chat_memory.messages
@@ -80,7 +115,46 @@ def router_con_memoria(mensaje: str, memory):
 
         # Extraer la decisión
         decision = response.content.strip().lower()
+        decisiones_router.inc(fuente="llm", decision=decision)
+        registrar_ejemplo(INTENT_LOG_PATH, mensaje, decision)
         return decision
     except Exception as e:
         # Fallback al router sin memoria
         return router_chain.invoke({"mensaje": mensaje})["text"].strip().lower()
+
+
+async def arouter_con_memoria(mensaje: str, memory, callbacks=None):
+    """
+    Versión asíncrona de router_con_memoria (usa ainvoke, no bloquea el event loop).
+
+    Args:
+        mensaje: Mensaje actual del usuario
+        memory: Objeto ConversationBufferMemory con el historial
+        callbacks: Callbacks de LangChain opcionales para la llamada al LLM
+
+    Returns:
+        str: "crear" o "consultar"
+    """
+    decision = clasificar_local(mensaje, memory)
+    if decision:
+        return decision
+
+    try:
+        response = await llm.ainvoke(
+            prompt_router_con_historial.format_messages(
+                chat_history=recortar_historial(memory.chat_memory.messages),
+                mensaje=mensaje
+            ),
+            config={"callbacks": callbacks}
+        )
+        decision = response.content.strip().lower()
+        decisiones_router.inc(fuente="llm", decision=decision)
+        registrar_ejemplo(INTENT_LOG_PATH, mensaje, decision)
+        return decision
+    except LLMNoDisponible:
+        # Con el LLM saturado el router sin memoria tampoco respondería
+        raise
+    except Exception:
+        # Fallback al router sin memoria
+        resultado = await router_chain.ainvoke({"mensaje": mensaje}, config={"callbacks": callbacks})
+        return resultado["text"].strip().lower()
@@ -0,0 +1,45 @@
+from typing import Dict
+from langchain.agents import AgentExecutor
+from agente_crear import construir_agente as construir_agente_crear
+from agente_consultar import construir_agente as construir_agente_consultar
+from agente_funciones import construir_agente as construir_agente_funciones
+
+
+# Constructores disponibles: uno por decisión del router más el agente de function calling
+CONSTRUCTORES = {
+    "crear": construir_agente_crear,
+    "consultar": construir_agente_consultar,
+    "funciones": construir_agente_funciones,
+}
+
+# Registro de agentes ya construidos (uno por proceso, compartidos por todas las sesiones)
+_agentes: Dict[str, AgentExecutor] = {}
+
+
+def inicializar_agentes():
+    """
+    Construye todos los agentes del registro. Se llama una vez al arrancar
+    el servidor para sacar la construcción del camino de cada petición.
+    """
+    for nombre, constructor in CONSTRUCTORES.items():
+        if nombre not in _agentes:
+            _agentes[nombre] = constructor()
+
+
+def obtener_agente(nombre: str) -> AgentExecutor:
+    """
+    Devuelve el agente ya construido para una decisión del router.
+
+    Args:
+        nombre: "crear", "consultar" o "funciones"
+
+    Returns:
+        AgentExecutor reutilizable
+
+    Raises:
+        KeyError: Si no existe un agente con ese nombre
+    """
+    if nombre not in _agentes:
+        # Construcción perezosa si no se llamó a inicializar_agentes (CLI, scripts)
+        _agentes[nombre] = CONSTRUCTORES[nombre]()
+    return _agentes[nombre]
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import redirect_stdout
+from typing import Dict, List
+
+
+# Mensajes de ejemplo: consultas (la mayoría) y altas de clientes
+MENSAJES_CONSULTA = [
+    "lista los clientes",
+    "ver clientes",
+    "muéstrame los clientes de gmail",
+    "¿cuántos clientes hay?",
+    "busca a Ana",
+]
+MENSAJES_CREAR = [
+    "crea el cliente llamado Juan Pérez con email juan{n}@ejemplo.com",
+    "registra un cliente nuevo",
+]
+
+# Contadores del servidor que se resumen al final
+METRICAS_INFORME = [
+    "llm_calls_total",
+    "singleflight_coalesced_total",
+    "result_cache_hits_total",
+    "llm_cache_hits_total",
+    "llm_rejected_total",
+    "degraded_responses_total",
+]
+
+# Endpoint de la petición en curso, para repartir el tiempo de base de datos
+_endpoint: contextvars.ContextVar[str] = contextvars.ContextVar("endpoint_benchmark", default="segundo_plano")
+
+
+def _percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))]
+
+
+def _total(metrics, nombre: str) -> float:
+    return sum(metrics.counter(nombre, "").series().values())
+
+
+def _parsear_mezcla(texto: str) -> Dict[str, float]:
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, peso = parte.split("=")
+        if nombre.strip() not in ("chat", "whatsapp", "history"):
+            raise ValueError(f"Endpoint desconocido en --mezcla: {nombre}")
+        mezcla[nombre.strip()] = float(peso)
+    return mezcla
+
+
+def configurar_entorno(args, directorio: str):
+    """
+    Fija el entorno ANTES de importar el servidor (config.py lee las variables
+    al importarse): LLM simulado, Twilio local y bases de datos en un
+    directorio temporal. Nunca toca las bases de datos reales.
+    """
+    os.environ["LLM_PROVIDER"] = "simulado"
+    os.environ["OUTBOX_TRANSPORT"] = "local"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directorio, 'benchmark.db')}"
+    os.environ.pop("DATABASE_ASYNC_URL", None)
+    os.environ["MESSAGE_SHARD_URL"] = "sqlite:///" + os.path.join(directorio, "benchmark_mensajes_{shard}.db")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(directorio, "benchmark_llm_cache.db")
+    os.environ["INTENT_LOG_PATH"] = ""
+    os.environ["LLM_SIMULATED_LATENCY_P50_MS"] = str(args.latencia_p50_ms)
+    os.environ["LLM_SIMULATED_LATENCY_P95_MS"] = str(args.latencia_p95_ms)
+    os.environ["LLM_SIMULATED_SEED"] = str(args.semilla)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACbenchmark")
+    os.environ.setdefault("TWILIO_AUTH_TOKEN", "benchmark")
+    # Sin límite por destinatario: cada sesión de WhatsApp recibe varias respuestas seguidas
+    os.environ.setdefault("OUTBOX_RATE_PER_SECOND", "1000")
+    os.environ.setdefault("OUTBOX_RATE_BURST", "1000")
+    if not args.cache_llm:
+        os.environ["LLM_CACHE"] = "false"
+
+
+def medir_base_de_datos(motores) -> Dict[str, float]:
+    """
+    Suma el tiempo de las sentencias SQL por endpoint (o "segundo_plano" para
+    los workers, el sink y el outbox) mediante los eventos de SQLAlchemy.
+    """
+    from sqlalchemy import event
+
+    tiempos: Dict[str, float] = defaultdict(float)
+
+    def antes(conn, cursor, sentencia, parametros, contexto, executemany):
+        conn.info.setdefault("benchmark_inicio", []).append(time.perf_counter())
+
+    def despues(conn, cursor, sentencia, parametros, contexto, executemany):
+        tiempos[_endpoint.get()] += time.perf_counter() - conn.info["benchmark_inicio"].pop()
+
+    for motor in motores:
+        event.listen(motor, "before_cursor_execute", antes)
+        event.listen(motor, "after_cursor_execute", despues)
+    return tiempos
+
+
+async def ejecutar(args) -> dict:
+    import database
+    import entrypoint
+    import httpx
+    import metrics
+    from llm_cache import cache_llm
+    from outbox import emisor
+    from shards import SHARDS
+
+    motores = {id(m): m for m in [database.engine, database.async_engine.sync_engine]
+               + [s.engine for s in SHARDS] + [s.async_engine.sync_engine for s in SHARDS]}
+    if cache_llm is not None:
+        motores[id(cache_llm.engine)] = cache_llm.engine
+    tiempos_bd = medir_base_de_datos(motores.values())
+
+    aleatorio = random.Random(args.semilla)
+    mezcla = _parsear_mezcla(args.mezcla)
+    endpoints, pesos = zip(*mezcla.items())
+    plan = [(aleatorio.choices(endpoints, pesos)[0], aleatorio.randrange(args.sesiones), aleatorio.random())
+            for _ in range(args.peticiones)]
+
+    latencias: Dict[str, List[float]] = defaultdict(list)
+    errores: Dict[str, int] = defaultdict(int)
+    siguiente = iter(range(len(plan)))
+
+    def mensaje(n: int, azar: float) -> str:
+        if azar < args.proporcion_crear:
+            return aleatorio.choice(MENSAJES_CREAR).format(n=n)
+        return aleatorio.choice(MENSAJES_CONSULTA)
+
+    async def peticion(cliente, n: int):
+        endpoint, sesion, azar = plan[n]
+        _endpoint.set(endpoint)
+        inicio = time.perf_counter()
+        if endpoint == "chat":
+            respuesta = await cliente.post("/chat", json={"mensaje": mensaje(n, azar)},
+                                           headers={"session-id": f"bench-{sesion}"})
+        elif endpoint == "whatsapp":
+            respuesta = await cliente.post("/whatsapp", data={
+                "From": f"whatsapp:+34{sesion:09d}", "Body": mensaje(n, azar), "MessageSid": f"SMbench{n}"
+            })
+        else:
+            respuesta = await cliente.get(f"/history/bench-{sesion}")
+        latencias[endpoint].append(time.perf_counter() - inicio)
+        if respuesta.status_code >= 400:
+            errores[endpoint] += 1
+
+    async def worker(cliente):
+        for n in siguiente:
+            await peticion(cliente, n)
+
+    await entrypoint.app.router.startup()
+    try:
+        transporte = httpx.ASGITransport(app=entrypoint.app)
+        async with httpx.AsyncClient(transport=transporte, base_url="http://benchmark", timeout=300) as cliente:
+            inicio = time.perf_counter()
+            await asyncio.gather(*(worker(cliente) for _ in range(args.concurrencia)))
+            duracion = time.perf_counter() - inicio
+
+            # Las respuestas de WhatsApp se generan y envían en segundo plano
+            whatsapp = len(latencias["whatsapp"])
+            while whatsapp and len(emisor.transporte.enviados) < whatsapp \
+                    and time.perf_counter() - inicio < duracion + args.espera_whatsapp:
+                await asyncio.sleep(0.05)
+            whatsapp_completado = time.perf_counter() - inicio if whatsapp else 0.0
+    finally:
+        await entrypoint.app.router.shutdown()
+        for motor in motores.values():
+            motor.dispose()
+
+    total = sum(len(v) for v in latencias.values())
+    informe = {
+        "peticiones": total,
+        "concurrencia": args.concurrencia,
+        "sesiones": args.sesiones,
+        "duracion_s": duracion,
+        "rps": total / duracion if duracion else 0.0,
+        "bd_ms_por_peticion": 1000 * sum(tiempos_bd.values()) / total if total else 0.0,
+        "bd_ms_por_endpoint": {k: 1000 * v for k, v in tiempos_bd.items()},
+        "whatsapp_enviados": len(emisor.transporte.enviados),
+        "whatsapp_completado_s": whatsapp_completado,
+        "endpoints": {
+            endpoint: {
+                "peticiones": len(valores),
+                "errores": errores[endpoint],
+                "p50_ms": 1000 * _percentil(valores, 50),
+                "p95_ms": 1000 * _percentil(valores, 95),
+                "p99_ms": 1000 * _percentil(valores, 99),
+                "rps": len(valores) / duracion if duracion else 0.0,
+                "bd_ms_por_peticion": 1000 * tiempos_bd.get(endpoint, 0.0) / len(valores) if valores else 0.0,
+            }
+            for endpoint, valores in sorted(latencias.items())
+        },
+        "metricas": {nombre: _total(metrics, nombre) for nombre in METRICAS_INFORME},
+    }
+    return informe
+
+
+def imprimir(informe: dict):
+    print(f"\nPeticiones: {informe['peticiones']}  concurrencia: {informe['concurrencia']}  "
+          f"sesiones: {informe['sesiones']}  duración: {informe['duracion_s']:.2f} s  "
+          f"RPS: {informe['rps']:.1f}")
+    print(f"{'endpoint':<10} {'n':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>8} {'BD ms/pet':>10}")
+    for endpoint, datos in informe["endpoints"].items():
+        print(f"{endpoint:<10} {datos['peticiones']:>6} {datos['errores']:>5} {datos['p50_ms']:>9.1f} "
+              f"{datos['p95_ms']:>9.1f} {datos['p99_ms']:>9.1f} {datos['rps']:>8.1f} {datos['bd_ms_por_peticion']:>10.2f}")
+    segundo_plano = informe["bd_ms_por_endpoint"].get("segundo_plano", 0.0)
+    print(f"BD total por petición: {informe['bd_ms_por_peticion']:.2f} ms "
+          f"(segundo plano: {segundo_plano:.0f} ms en total)")
+    print("Servidor: " + "  ".join(f"{nombre}={valor:.0f}" for nombre, valor in informe["metricas"].items()))
+    if informe["whatsapp_enviados"]:
+        print(f"WhatsApp: {informe['whatsapp_enviados']} respuestas enviadas; "
+              f"todas entregadas a los {informe['whatsapp_completado_s']:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prueba de carga sin red: LLM simulado, Twilio local y bases de datos temporales"
+    )
+    parser.add_argument("--peticiones", type=int, default=500, help="Peticiones totales")
+    parser.add_argument("--concurrencia", type=int, default=20, help="Peticiones simultáneas")
+    parser.add_argument("--sesiones", type=int, default=50, help="Sesiones distintas")
+    parser.add_argument("--mezcla", default="chat=70,whatsapp=20,history=10",
+                        help="Reparto de peticiones entre endpoints (pesos)")
+    parser.add_argument("--proporcion-crear", type=float, default=0.1,
+                        help="Fracción de mensajes que piden crear un cliente")
+    parser.add_argument("--latencia-p50-ms", type=float, default=50, help="Mediana de latencia del LLM simulado")
+    parser.add_argument("--latencia-p95-ms", type=float, default=150, help="p95 de latencia del LLM simulado")
+    parser.add_argument("--cache-llm", action="store_true", help="Activa la caché persistente del LLM")
+    parser.add_argument("--semilla", type=int, default=1, help="Semilla (mismo plan de peticiones y latencias)")
+    parser.add_argument("--espera-whatsapp", type=float, default=60,
+                        help="Segundos máximos de espera a que se envíen las respuestas de WhatsApp")
+    parser.add_argument("--json", help="Guarda el informe en este fichero (para comparar ejecuciones)")
+    parser.add_argument("--verbose", action="store_true", help="Muestra la salida del servidor")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as directorio:
+        configurar_entorno(args, directorio)
+        salida = sys.stdout if args.verbose else open(os.devnull, "w")
+        with redirect_stdout(salida):
+            informe = asyncio.run(ejecutar(args))
+        imprimir(informe)
+        if args.json:
+            with open(args.json, "w") as fichero:
+                json.dump(informe, fichero, indent=2, ensure_ascii=False)
+            print(f"Informe guardado en {args.json}")
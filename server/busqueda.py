@@ -0,0 +1,183 @@
+from difflib import SequenceMatcher
+from itertools import combinations
+from typing import List, Tuple
+from sqlalchemy import and_, or_, select, text
+from models import Cliente, normalizar_texto
+from consultas import escapar_like
+
+
+# Candidatos que se recuperan del índice antes de reordenar por similitud
+CANDIDATOS = 50
+# Trigramas (los menos frecuentes) que se usan en la búsqueda difusa
+TRIGRAMAS_DIFUSOS = 6
+
+
+def crear_indice_busqueda(conn):
+    """
+    Crea el índice de texto completo de clientes (SQLite FTS5 con tokenizador
+    trigram) y los triggers que lo mantienen sincronizado con la tabla
+    clientes, de modo que cada INSERT de crear_cliente queda indexado en la
+    misma transacción. Es idempotente; en otros motores no hace nada y la
+    búsqueda usa LIKE.
+
+    Args:
+        conn: Conexión síncrona de SQLAlchemy (dentro de una transacción)
+    """
+    if conn.dialect.name != "sqlite":
+        return
+
+    # Frecuencia de cada trigrama, para elegir los más selectivos en la búsqueda difusa
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS clientes_fts_vocab USING fts5vocab(clientes_fts, 'row')"
+    ))
+
+    existe = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'clientes_fts'"
+    )).first()
+    if existe:
+        return
+
+    print("[busqueda] Creando índice FTS5 (trigram) de clientes...")
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE clientes_fts USING fts5(
+            nombre_normalizado, email,
+            content='clientes', content_rowid='id', tokenize='trigram'
+        )
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER clientes_fts_ai AFTER INSERT ON clientes BEGIN
+            INSERT INTO clientes_fts(rowid, nombre_normalizado, email)
+            VALUES (new.id, new.nombre_normalizado, new.email);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER clientes_fts_ad AFTER DELETE ON clientes BEGIN
+            INSERT INTO clientes_fts(clientes_fts, rowid, nombre_normalizado, email)
+            VALUES ('delete', old.id, old.nombre_normalizado, old.email);
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER clientes_fts_au AFTER UPDATE ON clientes BEGIN
+            INSERT INTO clientes_fts(clientes_fts, rowid, nombre_normalizado, email)
+            VALUES ('delete', old.id, old.nombre_normalizado, old.email);
+            INSERT INTO clientes_fts(rowid, nombre_normalizado, email)
+            VALUES (new.id, new.nombre_normalizado, new.email);
+        END
+    """))
+    # Indexar los clientes que ya existían
+    conn.execute(text("INSERT INTO clientes_fts(clientes_fts) VALUES ('rebuild')"))
+
+
+def _frase_fts(texto: str) -> str:
+    return '"' + texto.replace('"', '""') + '"'
+
+
+def _trigramas(texto: str) -> List[str]:
+    return sorted({texto[i:i + 3] for i in range(len(texto) - 2)})
+
+
+def _similitud(consulta: str, nombre_normalizado: str, email: str) -> float:
+    """
+    Similitud 0-1 entre la consulta y el nombre (o la parte local del email).
+    Tolera errores de escritura ("jaun" ~ "juan").
+    """
+    candidatos = [nombre_normalizado or "", email.split("@")[0]] + (nombre_normalizado or "").split()
+    return max(SequenceMatcher(None, consulta, c).ratio() for c in candidatos)
+
+
+def _trigramas_selectivos(db, consulta: str) -> List[str]:
+    """
+    Devuelve los trigramas de la consulta que aparecen en menos documentos.
+    Los trigramas muy comunes ("ari", "ez ") casan con media tabla y no aportan.
+    """
+    trigramas = _trigramas(consulta)
+    parametros = {f"t{i}": t for i, t in enumerate(trigramas)}
+    frecuencias = dict(db.execute(
+        text(f"SELECT term, doc FROM clientes_fts_vocab WHERE term IN ({', '.join(':' + k for k in parametros)})"),
+        parametros
+    ).all())
+    # Los trigramas que no están en el índice no pueden casar con nada
+    presentes = [t for t in trigramas if t in frecuencias]
+    presentes.sort(key=lambda t: frecuencias[t])
+    return presentes[:TRIGRAMAS_DIFUSOS]
+
+
+def _candidatos_fts(db, consulta: str, limite: int) -> list:
+    """
+    Recupera candidatos del índice FTS5: primero coincidencia exacta de la
+    subcadena y, si no llenan la página, cualquiera de los trigramas más
+    selectivos de la consulta (búsqueda difusa, tolera errores de escritura).
+    """
+    sql = text("""
+        SELECT c.id, c.nombre, c.email, c.nombre_normalizado
+        FROM clientes_fts f JOIN clientes c ON c.id = f.rowid
+        WHERE clientes_fts MATCH :q
+        ORDER BY f.rank
+        LIMIT :n
+    """)
+    filas = db.execute(sql, {"q": _frase_fts(consulta), "n": CANDIDATOS}).all()
+    if len(filas) < limite:
+        trigramas = [_frase_fts(t) for t in _trigramas_selectivos(db, consulta)]
+        if not trigramas:
+            return filas
+        # Exigir al menos dos trigramas en común descarta la mayoría de candidatos
+        # irrelevantes sin perder los nombres con una errata
+        if len(trigramas) >= 2:
+            difusa = " OR ".join(f"({a} AND {b})" for a, b in combinations(trigramas, 2))
+        else:
+            difusa = trigramas[0]
+        vistos = {f.id for f in filas}
+        filas += [f for f in db.execute(sql, {"q": difusa, "n": CANDIDATOS}).all() if f.id not in vistos]
+    return filas
+
+
+def _candidatos_like(db, consulta: str) -> list:
+    """
+    Candidatos sin FTS5 (consultas de menos de 3 caracteres u otros motores).
+    """
+    if len(consulta) >= 3:
+        patron = f"%{escapar_like(consulta)}%"
+        condicion = or_(
+            Cliente.nombre_normalizado.like(patron, escape="\\"),
+            Cliente.email.like(patron, escape="\\")
+        )
+    else:
+        condicion = and_(
+            Cliente.nombre_normalizado >= consulta,
+            Cliente.nombre_normalizado < consulta + "\uffff"
+        )
+    return db.execute(
+        select(Cliente.id, Cliente.nombre, Cliente.email, Cliente.nombre_normalizado)
+        .where(condicion)
+        .limit(CANDIDATOS)
+    ).all()
+
+
+def buscar(db, texto: str, limite: int = 10) -> List[Tuple[str, str, float]]:
+    """
+    Busca clientes por nombre o email, tolerando coincidencias parciales y
+    errores de escritura, y los devuelve ordenados por relevancia.
+
+    Args:
+        db: Sesión síncrona de SQLAlchemy
+        texto: Texto a buscar
+        limite: Número máximo de resultados
+
+    Returns:
+        Lista de (nombre, email, similitud) de mayor a menor similitud
+    """
+    consulta = normalizar_texto(texto)
+    if not consulta:
+        return []
+
+    if len(consulta) >= 3 and db.get_bind().dialect.name == "sqlite":
+        filas = _candidatos_fts(db, consulta, limite)
+    else:
+        filas = _candidatos_like(db, consulta)
+
+    resultados = [
+        (f.nombre, f.email, _similitud(consulta, f.nombre_normalizado, f.email))
+        for f in filas
+    ]
+    resultados.sort(key=lambda r: r[2], reverse=True)
+    return resultados[:limite]
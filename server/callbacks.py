@@ -0,0 +1,99 @@
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Set, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from limitador_llm import etapa_actual
+from tokens import contar_tokens
+import metrics
+
+
+duracion_herramientas = metrics.histogram(
+    "tool_duration_seconds",
+    "Duración de cada ejecución de herramienta por herramienta y resultado"
+)
+
+
+def _tokens_generados(generacion) -> int:
+    # En function calling el texto puede ir vacío y la respuesta estar en la llamada a la función
+    mensaje = getattr(generacion, "message", None)
+    extra = mensaje.additional_kwargs if mensaje is not None else {}
+    return contar_tokens(generacion.text) + contar_tokens(str(extra) if extra else "")
+
+
+class ContadorLlamadasLLM(BaseCallbackHandler):
+    """
+    Callback de LangChain que instrumenta un turno: cuenta las llamadas al
+    LLM, los tokens de prompt y de respuesta por etapa (router / agente) y las
+    iteraciones ReAct, y mide cada ejecución de herramienta.
+
+    Los tokens salen del token_usage de la API (origen "api"); las respuestas
+    en streaming no lo traen, así que se estiman con contar_tokens a partir
+    del prompt y del texto generado (origen "estimado"). Las llamadas
+    agrupadas con otra idéntica en curso (CoalescerLlamadas) no se cuentan:
+    solo las mide singleflight_coalesced_total.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self.llamadas = 0
+        self.iteraciones = 0  # Acciones del agente (iteraciones ReAct)
+        # (etapa, origen) -> [tokens de prompt, tokens de respuesta]
+        self.tokens: Dict[Tuple[str, str], List[int]] = defaultdict(lambda: [0, 0])
+        self._herramientas: Dict[UUID, tuple] = {}
+        self._prompts: Dict[UUID, int] = {}  # Tokens de prompt estimados de cada llamada en curso
+        self._en_streaming: Set[UUID] = set()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any):
+        self.llamadas += 1
+        self._prompts[run_id] = sum(contar_tokens(prompt) for prompt in prompts)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *,
+                            run_id: UUID, **kwargs: Any):
+        self.llamadas += 1
+        self._prompts[run_id] = sum(contar_tokens(str(m.content)) for lista in messages for m in lista)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        self._en_streaming.add(run_id)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        prompt = self._prompts.pop(run_id, 0)
+        en_streaming = run_id in self._en_streaming
+        self._en_streaming.discard(run_id)
+        salida = response.llm_output or {}
+        if salida.get("agrupada"):
+            self.llamadas -= 1
+            return
+        uso = salida.get("token_usage") or {}
+        if uso:
+            tokens = self.tokens[(etapa_actual(), "api")]
+            tokens[0] += uso.get("prompt_tokens", 0)
+            tokens[1] += uso.get("completion_tokens", 0)
+        elif en_streaming:
+            # Las respuestas servidas desde la caché no consumen tokens y no se cuentan
+            tokens = self.tokens[(etapa_actual(), "estimado")]
+            tokens[0] += prompt
+            tokens[1] += sum(_tokens_generados(g) for lista in response.generations for g in lista)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._prompts.pop(run_id, None)
+        self._en_streaming.discard(run_id)
+
+    def on_agent_action(self, action: Any, **kwargs: Any):
+        self.iteraciones += 1
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any):
+        self._herramientas[run_id] = (serialized.get("name", "desconocida"), time.perf_counter())
+
+    def _fin_herramienta(self, run_id: UUID, resultado: str):
+        nombre, inicio = self._herramientas.pop(run_id, (None, None))
+        if nombre is not None:
+            duracion_herramientas.observe(time.perf_counter() - inicio, herramienta=nombre, resultado=resultado)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        self._fin_herramienta(run_id, "ok")
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._fin_herramienta(run_id, "error")
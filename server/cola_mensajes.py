@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple
+import metrics
+
+
+Trabajo = Callable[[], Awaitable[None]]
+
+profundidad_cola = metrics.gauge(
+    "queue_depth",
+    "Mensajes encolados pendientes de procesar"
+)
+workers_ocupados = metrics.gauge(
+    "queue_busy_workers",
+    "Workers procesando un mensaje en este momento"
+)
+espera_cola = metrics.histogram(
+    "queue_wait_seconds",
+    "Tiempo entre que un mensaje se encola y un worker empieza a procesarlo"
+)
+duracion_trabajo = metrics.histogram(
+    "queue_job_seconds",
+    "Tiempo de procesamiento de cada mensaje encolado"
+)
+rechazados = metrics.counter(
+    "queue_rejected_total",
+    "Mensajes rechazados porque la cola estaba llena"
+)
+
+
+class ColaLlena(Exception):
+    """La cola alcanzó su tamaño máximo."""
+
+
+class ColaPorSesion:
+    """
+    Cola de trabajos con un pool acotado de workers. Los trabajos de una misma
+    sesión se ejecutan de uno en uno y en orden de llegada; los de sesiones
+    distintas, en paralelo (hasta `workers` a la vez).
+    """
+
+    def __init__(self, workers: int, maximo: int):
+        self.workers = workers
+        self.maximo = maximo
+        # Trabajos pendientes por sesión: (trabajo, instante en que se encoló)
+        self._pendientes: Dict[str, Deque[Tuple[Trabajo, float]]] = {}
+        # Sesiones con trabajo pendiente y sin ningún worker atendiéndolas
+        self._listas: asyncio.Queue = asyncio.Queue()
+        self._total = 0
+        self._tareas: List[asyncio.Task] = []
+
+    def encolar(self, session_id: str, trabajo: Trabajo):
+        """
+        Añade un trabajo al final de la cola de su sesión. No bloquea.
+
+        Args:
+            session_id: Sesión a la que pertenece el trabajo
+            trabajo: Función sin argumentos que devuelve la corrutina a ejecutar
+
+        Raises:
+            ColaLlena: Si ya hay `maximo` trabajos pendientes
+        """
+        if self._total >= self.maximo:
+            rechazados.inc()
+            raise ColaLlena(f"Cola llena ({self.maximo} mensajes pendientes)")
+
+        cola = self._pendientes.get(session_id)
+        if cola is None:
+            # La sesión no estaba en curso ni pendiente: queda lista para un worker
+            cola = self._pendientes[session_id] = deque()
+            self._listas.put_nowait(session_id)
+        cola.append((trabajo, time.perf_counter()))
+        self._total += 1
+        profundidad_cola.set(self._total)
+
+    async def _worker(self):
+        while True:
+            session_id = await self._listas.get()
+            cola = self._pendientes[session_id]
+            trabajo, encolado = cola.popleft()
+            self._total -= 1
+            profundidad_cola.set(self._total)
+            espera_cola.observe(time.perf_counter() - encolado)
+
+            workers_ocupados.inc()
+            inicio = time.perf_counter()
+            try:
+                await trabajo()
+            except Exception as e:
+                print(f"[cola] Error procesando mensaje de {session_id}: {e}")
+            finally:
+                duracion_trabajo.observe(time.perf_counter() - inicio)
+                workers_ocupados.dec()
+
+            # Mientras la sesión tenga mensajes vuelve a la cola de listas (al final,
+            # para no acaparar un worker); así nunca hay dos workers en la misma sesión
+            if cola:
+                self._listas.put_nowait(session_id)
+            else:
+                del self._pendientes[session_id]
+
+    def iniciar(self):
+        """
+        Arranca los workers en el event loop actual.
+        """
+        if not self._tareas:
+            self._tareas = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def detener(self):
+        """
+        Cancela los workers. Los trabajos pendientes se descartan.
+        """
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+    def __len__(self) -> int:
+        return self._total
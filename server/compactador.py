@@ -0,0 +1,204 @@
+import asyncio
+from collections import OrderedDict
+from typing import List, Optional, Set
+from langchain_core.messages import HumanMessage, SystemMessage
+from sqlalchemy import select
+from models import Mensaje, ResumenSesion
+from config import (
+    MEMORY_SUMMARY, MEMORY_SUMMARY_TRIGGER_TURNS, MEMORY_SUMMARY_KEEP_TURNS, MEMORY_SUMMARY_MAX_TOKENS,
+    MEMORY_MAX_TOKENS, LLM_SUMMARY_TIMEOUT_SECONDS, MEMORY_CACHE_SIZE,
+)
+from limitador_llm import etapa_llm
+from llm import llm
+from llm_cache import sin_cache
+from memory_manager import PersistentMemoryManager
+from retencion import restaurar_sesion
+from shards import obtener_shard
+from tokens import contar_tokens, CARACTERES_POR_TOKEN
+import metrics
+
+
+compactaciones = metrics.counter(
+    "session_compactions_total",
+    "Compactaciones de sesiones por resultado (ok / error)"
+)
+mensajes_resumidos = metrics.counter(
+    "session_summarized_messages_total",
+    "Mensajes incorporados al resumen de su sesión"
+)
+duracion_compactacion = metrics.histogram(
+    "session_compaction_seconds",
+    "Duración de cada compactación de sesión (lectura, resumen con el LLM y escritura)"
+)
+
+PROMPT_RESUMEN = f"""Resume la conversación entre un usuario y el asistente de gestión de clientes.
+Parte del resumen anterior (si lo hay) e incorpora los mensajes nuevos.
+Conserva los datos útiles para continuar la conversación: nombres, emails,
+clientes creados o consultados, peticiones pendientes y preferencias del usuario.
+Escribe en español, en tercera persona y en menos de {MEMORY_SUMMARY_MAX_TOKENS * 3 // 4} palabras."""
+
+
+def _transcripcion(filas) -> str:
+    nombres = {"user": "Usuario", "assistant": "Asistente"}
+    return "\n".join(f"{nombres.get(fila.role, fila.role)}: {fila.content}" for fila in filas)
+
+
+def _lotes(filas, max_tokens: int) -> List[list]:
+    """
+    Parte los mensajes en lotes de como mucho max_tokens (al menos un mensaje
+    por lote), para que el prompt de cada llamada esté acotado aunque la
+    sesión tenga meses de historial sin resumir.
+    """
+    lotes, lote, tokens = [], [], 0
+    for fila in filas:
+        coste = contar_tokens(fila.content)
+        if lote and tokens + coste > max_tokens:
+            lotes.append(lote)
+            lote, tokens = [], 0
+        lote.append(fila)
+        tokens += coste
+    if lote:
+        lotes.append(lote)
+    return lotes
+
+
+class CompactadorSesiones:
+    """
+    Resume en segundo plano los mensajes antiguos de las sesiones largas
+    (p. ej. las de WhatsApp, que no terminan nunca): cuando una sesión tiene
+    MEMORY_SUMMARY_TRIGGER_TURNS turnos sin resumir, todos menos los últimos
+    MEMORY_SUMMARY_KEEP_TURNS se incorporan a su ResumenSesion con el LLM.
+    La memoria de los agentes pasa a ser el resumen más los turnos recientes,
+    así que el prompt no crece con la antigüedad de la sesión.
+
+    El pipeline avisa tras cada turno; el trabajo se hace fuera del camino de
+    la petición, de una sesión en una, y si el LLM falla se reintenta con el
+    siguiente aviso.
+    """
+
+    def __init__(self):
+        self._pendientes: Set[str] = set()
+        self._orden: "asyncio.Queue[str]" = None
+        # Turnos sin resumir (estimados) de las sesiones activas, en LRU acotada
+        # como la caché de sesiones: una sesión expulsada se revisa en la BD al volver
+        self._turnos: "OrderedDict[str, int]" = OrderedDict()
+        self._tarea: Optional[asyncio.Task] = None
+
+    def _anotar(self, session_id: str, turnos: int):
+        self._turnos[session_id] = turnos
+        self._turnos.move_to_end(session_id)
+        while len(self._turnos) > MEMORY_CACHE_SIZE:
+            self._turnos.popitem(last=False)
+
+    def avisar(self, session_id: str):
+        """
+        Anota un turno nuevo de la sesión. La sesión se revisa la primera vez
+        que se ve (tras un reinicio) y después cuando acumula
+        MEMORY_SUMMARY_TRIGGER_TURNS turnos sin resumir.
+
+        Args:
+            session_id: Sesión que acaba de guardar un turno
+        """
+        if not MEMORY_SUMMARY or self._tarea is None:
+            return
+        turnos = self._turnos.get(session_id)
+        self._anotar(session_id, (turnos or 0) + 1)
+        if (turnos is None or turnos + 1 >= MEMORY_SUMMARY_TRIGGER_TURNS) and session_id not in self._pendientes:
+            self._pendientes.add(session_id)
+            self._orden.put_nowait(session_id)
+
+    async def compactar(self, session_id: str) -> int:
+        """
+        Incorpora al resumen de la sesión los mensajes sin resumir salvo los
+        últimos MEMORY_SUMMARY_KEEP_TURNS turnos, si hay al menos
+        MEMORY_SUMMARY_TRIGGER_TURNS turnos sin resumir.
+
+        Args:
+            session_id: Sesión a compactar
+
+        Returns:
+            int: Mensajes incorporados al resumen (0 si no hacía falta)
+        """
+        # Una sesión archivada que vuelve a tener actividad se resume con su historial completo
+        await restaurar_sesion(session_id)
+        shard = obtener_shard(session_id)
+        if shard.sink.pendiente(session_id):
+            await shard.sink.vaciar()
+
+        async with shard.AsyncSessionLocal() as db:
+            actual = await db.get(ResumenSesion, session_id)
+            resumen = actual.resumen if actual else ""
+            desde_id = actual.hasta_id if actual else 0
+            filas = (await db.execute(
+                select(Mensaje.id, Mensaje.role, Mensaje.content)
+                .where(Mensaje.session_id == session_id, Mensaje.id > desde_id)
+                .order_by(Mensaje.timestamp, Mensaje.id)
+            )).all()
+
+        self._anotar(session_id, len(filas) // 2)
+        if len(filas) < MEMORY_SUMMARY_TRIGGER_TURNS * 2:
+            return 0
+        a_resumir = filas[:len(filas) - MEMORY_SUMMARY_KEEP_TURNS * 2]
+
+        with duracion_compactacion.cronometrar(), sin_cache():
+            for lote in _lotes(a_resumir, MEMORY_MAX_TOKENS):
+                with etapa_llm("resumen", LLM_SUMMARY_TIMEOUT_SECONDS):
+                    respuesta = await llm.ainvoke([
+                        SystemMessage(content=PROMPT_RESUMEN),
+                        HumanMessage(content=f"Resumen anterior:\n{resumen or '(ninguno)'}\n\n"
+                                             f"Mensajes nuevos:\n{_transcripcion(lote)}")
+                    ])
+                resumen = str(respuesta.content).strip()[:MEMORY_SUMMARY_MAX_TOKENS * CARACTERES_POR_TOKEN]
+
+            async with shard.AsyncSessionLocal() as db:
+                # Si la sesión se borró mientras se resumía, no se resucita
+                if await db.get(Mensaje, a_resumir[-1].id) is None:
+                    return 0
+                await db.merge(ResumenSesion(
+                    session_id=session_id,
+                    resumen=resumen,
+                    hasta_id=a_resumir[-1].id,
+                    mensajes_resumidos=(actual.mensajes_resumidos if actual else 0) + len(a_resumir),
+                ))
+                await db.commit()
+
+        # El próximo turno carga el resumen nuevo y solo los mensajes posteriores
+        PersistentMemoryManager._cache.invalidate(session_id)
+        self._anotar(session_id, MEMORY_SUMMARY_KEEP_TURNS)
+        mensajes_resumidos.inc(len(a_resumir))
+        return len(a_resumir)
+
+    async def _bucle(self):
+        while True:
+            session_id = await self._orden.get()
+            self._pendientes.discard(session_id)
+            try:
+                resumidos = await self.compactar(session_id)
+            except Exception as e:
+                compactaciones.inc(resultado="error")
+                print(f"[compactador] Error resumiendo la sesión {session_id}: {e}")
+                continue
+            if resumidos:
+                compactaciones.inc(resultado="ok")
+                print(f"[compactador] Sesión {session_id}: {resumidos} mensajes incorporados al resumen")
+
+    def iniciar(self):
+        """
+        Arranca el compactador en el event loop actual.
+        """
+        if MEMORY_SUMMARY and self._tarea is None:
+            self._orden = asyncio.Queue()
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """
+        Detiene el compactador. Las sesiones pendientes se revisarán tras el siguiente arranque.
+        """
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+            self._pendientes.clear()
+
+
+compactador = CompactadorSesiones()
@@ -0,0 +1,160 @@
+import os
+
+
+def _env_bool(nombre: str, default: bool) -> bool:
+    """Lee una variable de entorno booleana ("true"/"false", "1"/"0")."""
+    valor = os.getenv(nombre)
+    if valor is None:
+        return default
+    return valor.strip().lower() in ("1", "true", "yes", "si", "sí")
+
+
+# Muestra las trazas ReAct de los agentes en consola (solo para depuración)
+AGENT_VERBOSE = _env_bool("AGENT_VERBOSE", False)
+
+# Memoria de sesión: "window" carga solo los últimos turnos dentro de un
+# presupuesto de tokens; "buffer" carga el historial completo (comportamiento original)
+MEMORY_MODE = os.getenv("MEMORY_MODE", "window").strip().lower()
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "10"))
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "2000"))
+
+# Resumen incremental de sesiones largas: cuando una sesión acumula
+# MEMORY_SUMMARY_TRIGGER_TURNS turnos sin resumir, un proceso en segundo plano
+# los resume (salvo los últimos MEMORY_SUMMARY_KEEP_TURNS, que siguen literales)
+MEMORY_SUMMARY = _env_bool("MEMORY_SUMMARY", True)
+MEMORY_SUMMARY_TRIGGER_TURNS = int(os.getenv("MEMORY_SUMMARY_TRIGGER_TURNS", "10"))
+MEMORY_SUMMARY_KEEP_TURNS = int(os.getenv("MEMORY_SUMMARY_KEEP_TURNS", "4"))
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "300"))
+LLM_SUMMARY_TIMEOUT_SECONDS = float(os.getenv("LLM_SUMMARY_TIMEOUT_SECONDS", "60"))
+
+# Número máximo de sesiones "calientes" que se mantienen en memoria del proceso
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "1000"))
+
+# GET /history: mensajes por página (por defecto y máximo) y filas por lectura en modo NDJSON
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "1000"))
+HISTORY_STREAM_CHUNK = int(os.getenv("HISTORY_STREAM_CHUNK", "500"))
+# Archivos de sesiones archivadas que se mantienen descomprimidos para paginar su historial (0 = ninguno)
+HISTORY_ARCHIVE_CACHE_SIZE = int(os.getenv("HISTORY_ARCHIVE_CACHE_SIZE", "32"))
+
+# Presupuesto de tokens del historial que se envía en cada prompt (router y agentes)
+PROMPT_HISTORY_MAX_TOKENS = int(os.getenv("PROMPT_HISTORY_MAX_TOKENS", "1500"))
+
+# Clasificador local de intención: por encima de este umbral de confianza no se llama al LLM router
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.8"))
+# Fichero JSONL donde se registran las decisiones del LLM para reentrenar el clasificador ("" = desactivado)
+INTENT_LOG_PATH = os.getenv("INTENT_LOG_PATH", "")
+
+# Orquestación de cada turno: "router" (clasificador/LLM router + agente ReAct) o
+# "funciones" (un único agente de function calling que decide y ejecuta la herramienta)
+ORCHESTRATION_MODE = os.getenv("ORCHESTRATION_MODE", "router").strip().lower()
+
+# Flujo "crear": "slots" (extracción local de nombre/email + llamada directa a crear_cliente)
+# o "agente" (agente ReAct original)
+CREATE_FLOW_MODE = os.getenv("CREATE_FLOW_MODE", "slots").strip().lower()
+# Minutos tras los que una creación a medias se descarta
+SLOT_TTL_MINUTES = int(os.getenv("SLOT_TTL_MINUTES", "30"))
+
+# Cola del webhook de WhatsApp: workers que procesan mensajes en paralelo (en orden
+# dentro de cada sesión) y máximo de mensajes pendientes antes de rechazar con 503
+WHATSAPP_WORKERS = int(os.getenv("WHATSAPP_WORKERS", "8"))
+WHATSAPP_QUEUE_MAX = int(os.getenv("WHATSAPP_QUEUE_MAX", "1000"))
+
+# Idempotencia: segundos que se recuerda cada MessageSid de Twilio / Idempotency-Key
+# de /chat y número máximo de claves recordadas
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+# Outbox de respuestas de WhatsApp: "twilio" envía de verdad, "local" solo las registra (pruebas)
+OUTBOX_TRANSPORT = os.getenv("OUTBOX_TRANSPORT", "twilio").strip().lower()
+# Latencia simulada de cada envío con el transporte local (benchmarks)
+OUTBOX_LOCAL_LATENCY_MS = float(os.getenv("OUTBOX_LOCAL_LATENCY_MS", "0"))
+# Intentos antes de marcar un mensaje como fallido y backoff exponencial entre ellos
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "2"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "300"))
+# Límite de envío por destinatario (token bucket): mensajes por segundo y ráfaga
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "1"))
+OUTBOX_RATE_BURST = int(os.getenv("OUTBOX_RATE_BURST", "3"))
+# Mensajes que se leen por vuelta y envíos simultáneos (destinos distintos)
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+# Plazo de cada envío al proveedor: un envío colgado cuenta como error y se reintenta
+OUTBOX_SEND_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_SEND_TIMEOUT_SECONDS", "15"))
+
+# Retención de mensajes: las sesiones sin actividad durante más de los días de
+# su canal ("canal=días", sin entrada = no se archiva) salen de la tabla mensajes
+# a un archivo comprimido y vuelven solas cuando la sesión se usa de nuevo
+RETENTION = _env_bool("RETENTION", True)
+RETENTION_TTL_DAYS = {
+    canal.strip(): float(dias)
+    for canal, dias in (
+        parte.split("=") for parte in os.getenv("RETENTION_TTL_DAYS", "web=7,whatsapp=30").split(",") if parte.strip()
+    )
+}
+# Días que se guarda una sesión archivada antes de borrarla del todo (0 = nunca)
+RETENTION_PURGE_DAYS = float(os.getenv("RETENTION_PURGE_DAYS", "365"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+# Sesiones por transacción al archivar/purgar y mensajes por DELETE al borrar una sesión
+RETENTION_BATCH_SESSIONS = int(os.getenv("RETENTION_BATCH_SESSIONS", "100"))
+RETENTION_BATCH_MESSAGES = int(os.getenv("RETENTION_BATCH_MESSAGES", "1000"))
+
+# Escritura agrupada de mensajes (group commit): máximo de mensajes por commit,
+# milisegundos que se espera a juntar escrituras concurrentes y si la respuesta
+# HTTP espera a que el commit esté hecho (durable) o se devuelve antes
+MESSAGE_SINK_MAX_BATCH = int(os.getenv("MESSAGE_SINK_MAX_BATCH", "500"))
+MESSAGE_SINK_FLUSH_MS = float(os.getenv("MESSAGE_SINK_FLUSH_MS", "2"))
+MESSAGE_SINK_DURABLE = _env_bool("MESSAGE_SINK_DURABLE", True)
+
+# Base de datos: URL de SQLAlchemy (SQLite por defecto; también PostgreSQL/MySQL).
+# DATABASE_ASYNC_URL se deduce de DATABASE_URL si no se indica (sqlite -> aiosqlite, postgresql -> asyncpg)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./server_chat.db")
+DATABASE_ASYNC_URL = os.getenv("DATABASE_ASYNC_URL", "")
+# Pool de conexiones (por engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# PRAGMAs de SQLite aplicados a cada conexión nueva
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").strip().upper()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Reparto de los mensajes de conversación en varias bases de datos por session_id.
+# Con 1 shard se usa DATABASE_URL; con más, cada shard i usa MESSAGE_SHARD_URL con {shard} = i
+MESSAGE_SHARDS = int(os.getenv("MESSAGE_SHARDS", "1"))
+MESSAGE_SHARD_URL = os.getenv("MESSAGE_SHARD_URL", "sqlite:///./server_chat_mensajes_{shard}.db")
+
+# Caché persistente de respuestas del LLM (coincidencia exacta de modelo, parámetros y prompt)
+LLM_CACHE = _env_bool("LLM_CACHE", True)
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+# Caché en memoria de los resultados de consultar/contar/buscar clientes (0 la desactiva)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+
+# Límite de concurrencia adaptativo (AIMD) de las llamadas al LLM: límite inicial,
+# mínimo y máximo; latencia por encima de la cual se reduce el límite; llamadas que
+# pueden esperar turno y cuánto esperan antes de responder con la respuesta degradada
+LLM_CONCURRENCY_INITIAL = float(os.getenv("LLM_CONCURRENCY_INITIAL", "8"))
+LLM_CONCURRENCY_MIN = float(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = float(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+LLM_LATENCY_TARGET_SECONDS = float(os.getenv("LLM_LATENCY_TARGET_SECONDS", "10"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "100"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "2"))
+# Reintentos ante 429 / timeouts / 5xx (backoff exponencial con jitter desde LLM_RETRY_BASE_SECONDS)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+# Plazo total de las llamadas al LLM de cada etapa del turno y de cada petición HTTP a OpenAI
+LLM_ROUTER_TIMEOUT_SECONDS = float(os.getenv("LLM_ROUTER_TIMEOUT_SECONDS", "8"))
+LLM_AGENT_TIMEOUT_SECONDS = float(os.getenv("LLM_AGENT_TIMEOUT_SECONDS", "30"))
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "20"))
+
+# Proveedor del LLM: "openai" o "simulado" (modelo falso sin red para pruebas de carga, ver benchmark.py)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai").strip().lower()
+# Latencia del LLM simulado (log-normal): mediana y percentil 95 en milisegundos; semilla opcional
+LLM_SIMULATED_LATENCY_P50_MS = float(os.getenv("LLM_SIMULATED_LATENCY_P50_MS", "800"))
+LLM_SIMULATED_LATENCY_P95_MS = float(os.getenv("LLM_SIMULATED_LATENCY_P95_MS", "2000"))
+LLM_SIMULATED_SEED = int(os.environ["LLM_SIMULATED_SEED"]) if os.getenv("LLM_SIMULATED_SEED") else None
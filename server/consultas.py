@@ -0,0 +1,129 @@
+import base64
+import json
+from typing import List, Optional, Tuple
+from sqlalchemy import and_, func, or_, select
+from models import Cliente, normalizar_texto
+
+
+LIMITE_MAXIMO = 100
+
+# Orden disponible -> (columna de ordenación, descendente)
+ORDENES = {
+    "nombre": (Cliente.nombre_normalizado, False),
+    "email": (Cliente.email, False),
+    "recientes": (Cliente.id, True),
+}
+
+
+def escapar_like(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def aplicar_filtros(consulta, dominio_email: Optional[str] = None,
+                    nombre_prefijo: Optional[str] = None, nombre_contiene: Optional[str] = None):
+    """
+    Añade a la consulta los filtros sobre clientes, todos resueltos en SQL.
+
+    Args:
+        consulta: select() de SQLAlchemy sobre Cliente
+        dominio_email: Dominio exacto del email ("gmail.com"); acepta "@gmail.com" o "gmail"
+        nombre_prefijo: El nombre empieza por este texto (sin distinguir mayúsculas/tildes)
+        nombre_contiene: El nombre contiene este texto (sin distinguir mayúsculas/tildes)
+
+    Returns:
+        La consulta filtrada
+    """
+    if dominio_email:
+        dominio = dominio_email.strip().lower().lstrip("@")
+        if "." in dominio:
+            consulta = consulta.where(Cliente.email_dominio == dominio)
+        else:
+            # "gmail" -> gmail.com, gmail.es, ... (rango sobre el índice)
+            consulta = consulta.where(and_(
+                Cliente.email_dominio >= f"{dominio}.",
+                Cliente.email_dominio < f"{dominio}/"
+            ))
+    if nombre_prefijo:
+        prefijo = normalizar_texto(nombre_prefijo)
+        # Rango [prefijo, prefijo + U+FFFF) en lugar de LIKE para usar el índice en cualquier motor
+        consulta = consulta.where(and_(
+            Cliente.nombre_normalizado >= prefijo,
+            Cliente.nombre_normalizado < prefijo + "\uffff"
+        ))
+    if nombre_contiene:
+        patron = f"%{escapar_like(normalizar_texto(nombre_contiene))}%"
+        consulta = consulta.where(Cliente.nombre_normalizado.like(patron, escape="\\"))
+    return consulta
+
+
+def codificar_cursor(valor, id_: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([valor, id_]).encode()).decode()
+
+
+def decodificar_cursor(cursor: str) -> Tuple[object, int]:
+    try:
+        valor, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return valor, int(id_)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Cursor no válido") from e
+
+
+def consultar_pagina(db, dominio_email: Optional[str] = None, nombre_prefijo: Optional[str] = None,
+                     nombre_contiene: Optional[str] = None, orden: str = "nombre",
+                     limite: int = 20, cursor: Optional[str] = None) -> Tuple[List[Tuple[str, str]], Optional[str]]:
+    """
+    Devuelve una página de clientes con paginación por cursor (keyset).
+
+    Args:
+        db: Sesión síncrona de SQLAlchemy
+        dominio_email, nombre_prefijo, nombre_contiene: Filtros (ver aplicar_filtros)
+        orden: "nombre", "email" o "recientes"
+        limite: Tamaño de página (máximo LIMITE_MAXIMO)
+        cursor: Cursor devuelto por la página anterior
+
+    Returns:
+        Tuple[lista de (nombre, email), cursor de la página siguiente o None]
+
+    Raises:
+        ValueError: Si el orden o el cursor no son válidos
+    """
+    if orden not in ORDENES:
+        raise ValueError(f"Orden no válido: {orden}. Usa uno de: {', '.join(ORDENES)}")
+    columna, descendente = ORDENES[orden]
+    limite = max(1, min(int(limite), LIMITE_MAXIMO))
+
+    consulta = aplicar_filtros(
+        select(Cliente.id, Cliente.nombre, Cliente.email, columna.label("clave")),
+        dominio_email, nombre_prefijo, nombre_contiene
+    )
+
+    if cursor:
+        valor, ultimo_id = decodificar_cursor(cursor)
+        if descendente:
+            consulta = consulta.where(or_(columna < valor, and_(columna == valor, Cliente.id < ultimo_id)))
+        else:
+            consulta = consulta.where(or_(columna > valor, and_(columna == valor, Cliente.id > ultimo_id)))
+
+    if descendente:
+        consulta = consulta.order_by(columna.desc(), Cliente.id.desc())
+    else:
+        consulta = consulta.order_by(columna, Cliente.id)
+
+    filas = db.execute(consulta.limit(limite + 1)).all()
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1].clave, filas[-1].id)
+    return [(f.nombre, f.email) for f in filas], siguiente
+
+
+def contar(db, dominio_email: Optional[str] = None, nombre_prefijo: Optional[str] = None,
+           nombre_contiene: Optional[str] = None) -> int:
+    """
+    Cuenta los clientes que cumplen los filtros (COUNT en SQL).
+    """
+    consulta = aplicar_filtros(
+        select(func.count(Cliente.id)),
+        dominio_email, nombre_prefijo, nombre_contiene
+    )
+    return db.execute(consulta).scalar_one()
@@ -1,14 +1,97 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from config import (
+    DATABASE_URL, DATABASE_ASYNC_URL,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE_KB, SQLITE_BUSY_TIMEOUT_MS,
+)
+import metrics
 
-DATABASE_URL = "sqlite:///./server_chat.db"
+# Driver asíncrono equivalente a cada driver síncrono
+DRIVERS_ASINCRONOS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
 
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,
-    future=True,
-    connect_args={"check_same_thread": False}  # Necesario para SQLite con FastAPI
-)
+
+def url_asincrona(url: str) -> str:
+    """
+    Deduce la URL del driver asíncrono a partir de la URL síncrona
+    ("sqlite:///./x.db" -> "sqlite+aiosqlite:///./x.db").
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in DRIVERS_ASINCRONOS:
+        raise ValueError(f"No hay driver asíncrono para '{backend}'; usa DATABASE_ASYNC_URL")
+    return url.set(drivername=DRIVERS_ASINCRONOS[backend]).render_as_string(hide_password=False)
+
+
+def _es_sqlite_en_memoria(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def _aplicar_pragmas(conexion_dbapi, _registro):
+    """
+    Configura cada conexión SQLite nueva: WAL (lectores y escritor no se
+    bloquean), synchronous NORMAL (un fsync por checkpoint en lugar de por
+    commit, seguro con WAL), caché de páginas y espera ante bloqueos.
+    """
+    cursor = conexion_dbapi.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _opciones_pool(url) -> dict:
+    if _es_sqlite_en_memoria(url):
+        return {}  # SQLAlchemy usa un pool de una sola conexión
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": url.get_backend_name() != "sqlite",
+    }
+
+
+def crear_engine(url: str):
+    """
+    Crea el engine síncrono para una URL, con el pool configurado y, en
+    SQLite, los PRAGMAs de rendimiento.
+    """
+    url = make_url(url)
+    opciones = _opciones_pool(url)
+    if url.get_backend_name() == "sqlite":
+        opciones["connect_args"] = {"check_same_thread": False}  # Necesario para SQLite con FastAPI
+    motor = create_engine(url, echo=False, future=True, **opciones)
+    if url.get_backend_name() == "sqlite":
+        event.listen(motor, "connect", _aplicar_pragmas)
+    return motor
+
+
+def crear_async_engine(url: str):
+    """
+    Crea el engine asíncrono para una URL (ver crear_engine).
+    """
+    url = make_url(url)
+    opciones = _opciones_pool(url)
+    if opciones and url.get_backend_name() == "sqlite":
+        # aiosqlite usa NullPool por defecto: una conexión (y un hilo) nuevos por sesión
+        opciones["poolclass"] = AsyncAdaptedQueuePool
+    motor = create_async_engine(url, echo=False, future=True, **opciones)
+    if url.get_backend_name() == "sqlite":
+        event.listen(motor.sync_engine, "connect", _aplicar_pragmas)
+    return motor
+
+
+engine = crear_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(
     bind=engine,
@@ -16,4 +99,19 @@ SessionLocal = sessionmaker(
     autocommit=False
 )
 
+# Motor asíncrono para el camino de las peticiones (no bloquea el event loop)
+async_engine = crear_async_engine(DATABASE_ASYNC_URL or url_asincrona(DATABASE_URL))
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
+
+# Duración de los commits de todas las escrituras (mensajes, clientes, outbox), por operación
+duracion_escrituras = metrics.histogram(
+    "db_write_seconds",
+    "Duración de las escrituras (commits) en la base de datos por operación"
+)
@@ -1,20 +1,31 @@
-from fastapi import FastAPI, Header, HTTPException, Form
+from fastapi import FastAPI, Header, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
-from twilio.rest import Client
+from typing import Literal, Optional
 from dotenv import load_dotenv
+import orjson
 import uuid
-import os
 
 load_dotenv()
 
-from database import engine, Base
-from agente_crear import crear_agente_con_memoria as crear_agente_crear
-from agente_consultar import crear_agente_con_memoria as crear_agente_consultar
-from agente_recepcionista import router_chain, router_con_memoria
-from memory_manager import PersistentMemoryManager
+from database import engine, async_engine, Base
+from migrations import aplicar_migraciones
+from memory_manager import PersistentMemoryManager, codificar_cursor, decodificar_cursor
+from agentes import inicializar_agentes
+from pipeline import procesar_mensaje, procesar_mensaje_stream
+from streaming import evento_sse
+from cola_mensajes import ColaPorSesion, ColaLlena
+from config import (
+    WHATSAPP_WORKERS, WHATSAPP_QUEUE_MAX, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS,
+    HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX,
+)
+from idempotencia import AlmacenIdempotencia
+from outbox import emisor
+from compactador import compactador
+from retencion import gestor_retencion
+from shards import inicializar_shards, detener_shards
+import metrics
 
 # Inicializar FastAPI
 app = FastAPI(
@@ -32,14 +43,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Crear tablas en la base de datos
+# Crear tablas en la base de datos y aplicar migraciones pendientes
 Base.metadata.create_all(bind=engine)
+aplicar_migraciones(engine)
+inicializar_shards()
+
+# Cola de mensajes entrantes de WhatsApp (el webhook responde sin esperar al LLM)
+cola_whatsapp = ColaPorSesion(workers=WHATSAPP_WORKERS, maximo=WHATSAPP_QUEUE_MAX)
+
+# Resultados por clave de idempotencia: los reintentos no repiten el pipeline
+idempotencia = AlmacenIdempotencia(ttl=IDEMPOTENCY_TTL_SECONDS, maximo=IDEMPOTENCY_MAX_KEYS)
+
+
+@app.on_event("startup")
+async def construir_agentes():
+    """
+    Construye los agentes una sola vez por proceso al arrancar el servidor
+    y arranca los workers de la cola de WhatsApp, el emisor del outbox, el
+    compactador de sesiones y la retención de mensajes.
+    """
+    inicializar_agentes()
+    cola_whatsapp.iniciar()
+    emisor.iniciar()
+    compactador.iniciar()
+    gestor_retencion.iniciar()
 
-# Configuración de Twilio
-account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-twilio_number = os.getenv("TWILIO_PHONE_NUMBER", "whatsapp:+12697484776")
-twilio_client = Client(account_sid, auth_token)
+
+@app.on_event("shutdown")
+async def detener_workers():
+    await cola_whatsapp.detener()
+    await emisor.detener()
+    await compactador.detener()
+    await gestor_retencion.detener()
+    await detener_shards()  # Guarda los mensajes que aún estén en los sinks
+    # Cierra las conexiones del pool (los hilos de aiosqlite impiden terminar el proceso)
+    await async_engine.dispose()
 
 
 # Modelos Pydantic para request/response
@@ -53,8 +91,10 @@ class ChatResponse(BaseModel):
 
 class HistoryResponse(BaseModel):
     session_id: str
-    total_mensajes: int
+    total_mensajes: int  # Mensajes de la sesión
+    mensajes_pagina: int  # Mensajes de esta página
     historial: list
+    siguiente: Optional[str] = None  # Cursor de la página siguiente (None si no hay más)
 
 
 @app.get("/")
@@ -71,13 +111,16 @@ async def root():
 @app.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
-    session_id: Optional[str] = Header(None, alias="session-id")
+    session_id: Optional[str] = Header(None, alias="session-id"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """
     Endpoint principal de chat con memoria persistente.
 
     **Headers:**
     - session-id: ID de sesión (opcional, se genera automáticamente si no existe)
+    - Idempotency-Key: Clave opcional; si se repite, se devuelve la misma respuesta
+      sin procesar el mensaje otra vez
 
     **Body:**
     - mensaje: El mensaje del usuario
@@ -89,124 +132,103 @@ async def chat(
     if not session_id:
         session_id = str(uuid.uuid4())
 
-    # 2. Cargar memoria ANTES de guardar el mensaje actual
-    memory = PersistentMemoryManager.load_memory_for_agent(session_id)
+    # 2. Procesar el turno completo (memoria, router, agente) de forma asíncrona
+    async def procesar() -> ChatResponse:
+        decision, respuesta = await procesar_mensaje(session_id, request.mensaje)
+        return ChatResponse(
+            respuesta=respuesta,
+            session_id=session_id,
+            decision=decision
+        )
 
-    # 3. Guardar mensaje del usuario DESPUÉS de cargar historial
-    PersistentMemoryManager.save_message(
-        session_id=session_id,
-        role="user",
-        content=request.mensaje
-    )
+    if not idempotency_key:
+        return await procesar()
+    respuesta, _ = await idempotencia.ejecutar(f"chat:{idempotency_key}", procesar)
+    return respuesta
 
-    # 4. Decidir qué agente usar (recepcionista CON contexto)
-    try:
-        # Usar el router que considera el historial
-        decision = router_con_memoria(request.mensaje, memory)
-    except Exception as e:
-        decision = "error"
-        respuesta = f"❌ Error al procesar la solicitud: {str(e)}"
-
-    # 5. Agregar el mensaje actual a la memoria para que el agente lo vea
-    memory.chat_memory.add_user_message(request.mensaje)
-
-    # 6. Procesar con el agente correspondiente
-    if decision == "crear":
-        # Crear un resumen del contexto para el agente
-        contexto_resumido = []
-        for msg in memory.chat_memory.messages[:-1]:  # Excluir el último (mensaje actual)
-            if msg.type == "human":
-                contexto_resumido.append(f"Usuario dijo: {msg.content}")
-            else:
-                contexto_resumido.append(f"Asistente respondió: {msg.content}")
-
-        # Construir mensaje enriquecido con contexto
-        if contexto_resumido:
-            mensaje_con_contexto = f"""Contexto de la conversación anterior:
-                                {chr(10).join(contexto_resumido)}
-                                Mensaje actual del usuario: {request.mensaje}
-                                IMPORTANTE: Revisa el contexto anterior para extraer nombre y email si ya fueron mencionados."""
-        else:
-            mensaje_con_contexto = request.mensaje
 
-        try:
-            agente = crear_agente_crear(memory)
-            resultado = agente.invoke(
-                {"input": mensaje_con_contexto}
-            )
-            respuesta = resultado.get("output", str(resultado))
-        except Exception as e:
-            respuesta = f"❌ Error en agente crear: {str(e)}"
-
-    elif decision == "consultar":
-        # Crear un resumen del contexto para el agente
-        contexto_resumido = []
-        for msg in memory.chat_memory.messages[:-1]:  # Excluir el último (mensaje actual)
-            if msg.type == "human":
-                contexto_resumido.append(f"Usuario dijo: {msg.content}")
-            else:
-                contexto_resumido.append(f"Asistente respondió: {msg.content}")
-
-        # Construir mensaje enriquecido con contexto
-        if contexto_resumido:
-            mensaje_con_contexto = f"""Contexto de la conversación anterior:
-                                    {chr(10).join(contexto_resumido)}
-                                    Mensaje actual del usuario: {request.mensaje}
-                                    IMPORTANTE: Revisa el contexto anterior para entender qué información busca el usuario."""
-        else:
-            mensaje_con_contexto = request.mensaje
+@app.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    session_id: Optional[str] = Header(None, alias="session-id")
+):
+    """
+    Igual que /chat, pero devuelve la respuesta en streaming (Server-Sent Events)
+    a medida que el agente la genera.
 
-        try:
-            agente = crear_agente_consultar(memory)
-            resultado = agente.invoke(
-                {"input": mensaje_con_contexto}
-            )
-            respuesta = resultado.get("output", str(resultado))
-        except Exception as e:
-            respuesta = f"❌ Error en agente consultar: {str(e)}"
-
-    else:
-        respuesta = "❓ No entendí la solicitud. Por favor, reformula tu mensaje."
-
-    # 7. Guardar respuesta del asistente en BD
-    PersistentMemoryManager.save_message(
-        session_id=session_id,
-        role="assistant",
-        content=respuesta
-    )
+    **Headers:**
+    - session-id: ID de sesión (opcional, se genera automáticamente si no existe)
 
-    return ChatResponse(
-        respuesta=respuesta,
-        session_id=session_id,
-        decision=decision
+    **Body:**
+    - mensaje: El mensaje del usuario
+
+    **Returns:**
+    - Eventos SSE: `decision`, `token` (uno por fragmento), `error` y `fin`
+      (con la respuesta completa, la decisión y el session_id)
+    """
+    if not session_id:
+        session_id = str(uuid.uuid4())
+
+    async def eventos():
+        async for evento, datos in procesar_mensaje_stream(session_id, request.mensaje):
+            yield evento_sse(evento, datos)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"session-id": session_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
+def _mensaje_historial(fila) -> dict:
+    return {"id": fila.id, "role": fila.role, "content": fila.content, "timestamp": fila.timestamp}
+
+
 @app.get("/history/{session_id}", response_model=HistoryResponse)
-async def get_history(session_id: str):
+async def get_history(
+    session_id: str,
+    after: Optional[str] = Query(None, description="Cursor devuelto en `siguiente` (timestamp|id)"),
+    limit: Optional[int] = Query(None, ge=1, description=f"Mensajes por página (máximo {HISTORY_PAGE_MAX})"),
+    formato: Literal["json", "ndjson"] = Query("json", description="`ndjson`: un mensaje por línea, en streaming")
+):
     """
-    Obtiene el historial completo de una sesión.
+    Obtiene el historial de una sesión por páginas (keyset sobre timestamp + id).
 
     **Path Parameters:**
     - session_id: ID de la sesión a consultar
 
+    **Query Parameters:**
+    - after: Cursor de la página anterior (`siguiente`); sin él, desde el principio
+    - limit: Mensajes por página (por defecto HISTORY_PAGE_SIZE)
+    - formato: `json` (una página) o `ndjson` (todos los mensajes tras `after`,
+      o `limit` si se indica, leídos de la base de datos por lotes)
+
     **Returns:**
-    - Historial completo de mensajes de la sesión
+    - Página de mensajes de la sesión y cursor de la siguiente
     """
-    mensajes = PersistentMemoryManager.get_history(session_id)
-
-    return HistoryResponse(
-        session_id=session_id,
-        total_mensajes=len(mensajes),
-        historial=[
-            {
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat()
-            }
-            for msg in mensajes
-        ]
-    )
+    try:
+        despues = decodificar_cursor(after) if after else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor 'after' no válido")
+
+    if formato == "ndjson":
+        async def lineas():
+            async for fila in PersistentMemoryManager.aiter_history(session_id, despues, limit):
+                yield orjson.dumps(_mensaje_historial(fila)) + b"\n"
+
+        return StreamingResponse(lineas(), media_type="application/x-ndjson")
+
+    limite = min(limit or HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX)
+    # Se lee una fila de más para saber si hay página siguiente
+    filas = await PersistentMemoryManager.aget_history_page(session_id, despues, limite + 1)
+    pagina = filas[:limite]
+    return ORJSONResponse({
+        "session_id": session_id,
+        "total_mensajes": await PersistentMemoryManager.acontar_mensajes(session_id),
+        "mensajes_pagina": len(pagina),
+        "historial": [_mensaje_historial(fila) for fila in pagina],
+        "siguiente": codificar_cursor(pagina[-1].timestamp, pagina[-1].id) if len(filas) > limite else None,
+    })
 
 
 @app.delete("/history/{session_id}")
@@ -220,18 +242,37 @@ async def clear_history(session_id: str):
     **Returns:**
     - Mensaje de confirmación
     """
-    PersistentMemoryManager.clear_session(session_id)
+    await PersistentMemoryManager.aclear_session(session_id)
     return {
         "message": f"Historial de sesión {session_id} eliminado correctamente",
         "session_id": session_id
     }
 
 
+async def responder_whatsapp(session_id: str, destino: str, mensaje: str):
+    """
+    Procesa un mensaje de WhatsApp y deja la respuesta en el outbox.
+    Se ejecuta en un worker de la cola, fuera de la petición del webhook.
+    """
+    # 1. Procesar el turno completo (memoria, router, agente) de forma asíncrona
+    decision, respuesta = await procesar_mensaje(session_id, mensaje, canal="whatsapp")
+    print(f"[DEBUG] Decisión: '{decision}' - respuesta: {respuesta[:100]}...")
+
+    # 2. Guardar la respuesta en el outbox; el emisor la envía via Twilio con reintentos
+    await emisor.encolar(session_id, destino, respuesta)
+
+
 @app.post("/whatsapp")
-async def recibir_mensaje_whatsapp(From: str = Form(...), Body: str = Form(...)):
+async def recibir_mensaje_whatsapp(
+    From: str = Form(...),
+    Body: str = Form(...),
+    MessageSid: Optional[str] = Form(None)
+):
     """
     Endpoint para recibir mensajes de WhatsApp via Twilio.
-    Usa el sistema multi-agente para generar respuestas inteligentes.
+    Encola el mensaje y responde al momento; un worker genera la respuesta con
+    el sistema multi-agente y la envía después (en orden dentro de cada sesión).
+    Las reentregas de Twilio (mismo MessageSid) no se vuelven a encolar.
     """
     mensaje = Body.strip()
     # Usar el número de teléfono como session_id para mantener contexto por usuario
@@ -240,108 +281,36 @@ async def recibir_mensaje_whatsapp(From: str = Form(...), Body: str = Form(...))
     print(f"[WhatsApp] {From}: {mensaje}")
     print(f"[DEBUG] session_id generado: {session_id}")
 
-    # 1. Cargar memoria del usuario
-    print(f"[DEBUG] Cargando memoria para session_id: {session_id}")
-    memory = PersistentMemoryManager.load_memory_for_agent(session_id)
-    print(f"[DEBUG] Memoria cargada - mensajes en historial: {len(memory.chat_memory.messages)}")
-
-    # 2. Guardar mensaje del usuario
-    print(f"[DEBUG] Guardando mensaje del usuario en BD...")
-    PersistentMemoryManager.save_message(
-        session_id=session_id,
-        role="user",
-        content=mensaje
-    )
-    print(f"[DEBUG] Mensaje guardado en BD")
+    async def encolar() -> dict:
+        try:
+            cola_whatsapp.encolar(session_id, lambda: responder_whatsapp(session_id, From, mensaje))
+        except ColaLlena as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        return {"status": "encolado", "session_id": session_id}
 
-    # 3. Decidir qué agente usar
-    print(f"[DEBUG] Llamando a router_con_memoria con mensaje: '{mensaje}'")
-    try:
-        decision = router_con_memoria(mensaje, memory)
-        print(f"[DEBUG] router_con_memoria retornó decisión: '{decision}'")
-    except Exception as e:
-        print(f"[DEBUG] ERROR en router_con_memoria: {str(e)}")
-        decision = "error"
-        respuesta = f"Error al procesar: {str(e)}"
-
-    # 4. Agregar mensaje a memoria
-    print(f"[DEBUG] Agregando mensaje a memoria del agente")
-    memory.chat_memory.add_user_message(mensaje)
-
-    # 5. Procesar con el agente correspondiente
-    print(f"[DEBUG] Entrando a procesar con decisión: '{decision}'")
-    if decision == "crear":
-        print(f"[DEBUG] >>> ENTRANDO A RAMA 'crear'")
-        contexto_resumido = []
-        for msg in memory.chat_memory.messages[:-1]:
-            if msg.type == "human":
-                contexto_resumido.append(f"Usuario dijo: {msg.content}")
-            else:
-                contexto_resumido.append(f"Asistente respondió: {msg.content}")
-
-        if contexto_resumido:
-            mensaje_con_contexto = f"""Contexto de la conversación anterior:
-{chr(10).join(contexto_resumido)}
-Mensaje actual del usuario: {mensaje}
-IMPORTANTE: Revisa el contexto anterior para extraer nombre y email si ya fueron mencionados."""
-        else:
-            mensaje_con_contexto = mensaje
+    if not MessageSid:
+        return JSONResponse(content=await encolar())
 
-        try:
-            agente = crear_agente_crear(memory)
-            resultado = agente.invoke({"input": mensaje_con_contexto})
-            respuesta = resultado.get("output", str(resultado))
-        except Exception as e:
-            respuesta = f"Error en agente crear: {str(e)}"
-
-    elif decision == "consultar":
-        print(f"[DEBUG] >>> ENTRANDO A RAMA 'consultar'")
-        contexto_resumido = []
-        for msg in memory.chat_memory.messages[:-1]:
-            if msg.type == "human":
-                contexto_resumido.append(f"Usuario dijo: {msg.content}")
-            else:
-                contexto_resumido.append(f"Asistente respondió: {msg.content}")
-
-        if contexto_resumido:
-            mensaje_con_contexto = f"""Contexto de la conversación anterior:
-{chr(10).join(contexto_resumido)}
-Mensaje actual del usuario: {mensaje}
-IMPORTANTE: Revisa el contexto anterior para entender qué información busca el usuario."""
-        else:
-            mensaje_con_contexto = mensaje
+    resultado, repetido = await idempotencia.ejecutar(f"whatsapp:{MessageSid}", encolar)
+    if repetido:
+        print(f"[WhatsApp] Mensaje {MessageSid} repetido, se ignora")
+    return JSONResponse(content=resultado)
 
-        try:
-            agente = crear_agente_consultar(memory)
-            resultado = agente.invoke({"input": mensaje_con_contexto})
-            respuesta = resultado.get("output", str(resultado))
-        except Exception as e:
-            respuesta = f"Error en agente consultar: {str(e)}"
-
-    else:
-        print(f"[DEBUG] >>> ENTRANDO A RAMA 'else' - decisión no reconocida: '{decision}'")
-        respuesta = "No entendí la solicitud. Por favor, reformula tu mensaje."
-
-    # 6. Guardar respuesta en BD
-    print(f"[DEBUG] Respuesta generada: {respuesta[:100]}...")
-    print(f"[DEBUG] Guardando respuesta en BD...")
-    PersistentMemoryManager.save_message(
-        session_id=session_id,
-        role="assistant",
-        content=respuesta
-    )
 
-    # 7. Enviar respuesta via Twilio
-    try:
-        twilio_client.messages.create(
-            from_=twilio_number,
-            to=From,
-            body=respuesta
-        )
-    except Exception as e:
-        print(f"[WhatsApp] Error enviando mensaje: {e}")
+@app.get("/stats")
+async def stats():
+    """
+    Métricas internas del proceso (tokens de historial enviados/ahorrados, etc.)
+    """
+    return metrics.snapshot()
 
-    return JSONResponse(content={"status": "enviado", "session_id": session_id})
+
+@app.get("/metrics")
+async def metricas_prometheus():
+    """
+    Métricas del proceso en el formato de texto de Prometheus
+    """
+    return PlainTextResponse(metrics.exponer_prometheus(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/health")
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Tuple
+import metrics
+
+
+peticiones_repetidas = metrics.counter(
+    "idempotency_hits_total",
+    "Peticiones repetidas resueltas sin volver a ejecutar el pipeline (en_curso / completada)"
+)
+peticiones_nuevas = metrics.counter(
+    "idempotency_misses_total",
+    "Claves de idempotencia vistas por primera vez"
+)
+
+
+class AlmacenIdempotencia:
+    """
+    Recuerda el resultado de cada operación por su clave de idempotencia durante
+    `ttl` segundos (como máximo `maximo` claves, se descartan las más antiguas).
+    Una repetición recibe el resultado guardado o, si la primera ejecución
+    todavía no ha terminado, espera a ese mismo resultado.
+    """
+
+    def __init__(self, ttl: float, maximo: int):
+        self.ttl = ttl
+        self.maximo = maximo
+        # clave -> (instante de caducidad, future con el resultado)
+        self._entradas: "OrderedDict[str, Tuple[float, asyncio.Future]]" = OrderedDict()
+
+    def _purgar(self, ahora: float):
+        # Las entradas están en orden de inserción y todas tienen el mismo TTL
+        while self._entradas:
+            clave, (expira, _) = next(iter(self._entradas.items()))
+            if expira > ahora and len(self._entradas) <= self.maximo:
+                break
+            del self._entradas[clave]
+
+    async def ejecutar(self, clave: str, operacion: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Ejecuta la operación una sola vez por clave.
+
+        Args:
+            clave: Clave de idempotencia (MessageSid de Twilio, cabecera Idempotency-Key...)
+            operacion: Función sin argumentos que devuelve la corrutina a ejecutar
+
+        Returns:
+            Tuple[resultado, repetida]: repetida es True si no se ha ejecutado de nuevo
+
+        Raises:
+            Exception: La de la operación; en ese caso la clave se olvida para permitir reintentos
+        """
+        ahora = time.monotonic()
+        self._purgar(ahora)
+
+        entrada = self._entradas.get(clave)
+        if entrada is not None:
+            futuro = entrada[1]
+            peticiones_repetidas.inc(estado="completada" if futuro.done() else "en_curso")
+            # shield: si se cancela esta petición no se cancela la original
+            return await asyncio.shield(futuro), True
+
+        peticiones_nuevas.inc()
+        futuro = asyncio.get_running_loop().create_future()
+        self._entradas[clave] = (ahora + self.ttl, futuro)
+        self._purgar(ahora)
+        try:
+            resultado = await operacion()
+        except BaseException as e:
+            if self._entradas.get(clave, (None, None))[1] is futuro:
+                del self._entradas[clave]
+            if isinstance(e, asyncio.CancelledError):
+                futuro.cancel()
+            else:
+                futuro.set_exception(e)
+                # Marcar la excepción como recuperada si nadie más la esperaba
+                futuro.exception()
+            raise
+        futuro.set_result(resultado)
+        return resultado, False
+
+    def __len__(self) -> int:
+        return len(self._entradas)
@@ -0,0 +1,316 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Optional
+import openai
+from config import (
+    LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX,
+    LLM_LATENCY_TARGET_SECONDS, LLM_QUEUE_MAX, LLM_QUEUE_TIMEOUT_SECONDS,
+    LLM_MAX_RETRIES, LLM_RETRY_BASE_SECONDS,
+)
+import metrics
+
+
+llamadas_en_curso = metrics.gauge(
+    "llm_inflight",
+    "Llamadas al LLM en curso"
+)
+llamadas_en_cola = metrics.gauge(
+    "llm_queued",
+    "Llamadas al LLM esperando turno en el limitador"
+)
+limite_actual = metrics.gauge(
+    "llm_concurrency_limit",
+    "Límite de concurrencia actual del limitador AIMD"
+)
+rechazadas = metrics.counter(
+    "llm_rejected_total",
+    "Llamadas al LLM rechazadas sin ejecutar por motivo (cola_llena / espera / plazo)"
+)
+reintentos = metrics.counter(
+    "llm_retries_total",
+    "Reintentos de llamadas al LLM por motivo (429 / timeout / conexion / servidor)"
+)
+plazos_agotados = metrics.counter(
+    "llm_deadline_exceeded_total",
+    "Llamadas al LLM cortadas por agotar el plazo de su etapa"
+)
+
+# Errores de la API que se reintentan y motivo para las métricas
+ERRORES_REINTENTABLES = (
+    (openai.RateLimitError, "429"),
+    (openai.APITimeoutError, "timeout"),
+    (openai.APIConnectionError, "conexion"),
+    (openai.InternalServerError, "servidor"),
+)
+
+# Etapa del turno y plazo absoluto (time.monotonic) de las llamadas al LLM en curso
+_etapa: ContextVar[str] = ContextVar("etapa_llm", default="otra")
+_fecha_limite: ContextVar[Optional[float]] = ContextVar("fecha_limite_llm", default=None)
+
+
+class LLMNoDisponible(Exception):
+    """
+    El LLM no puede atender la llamada ahora (limitador saturado o plazo de
+    la etapa agotado). El pipeline responde con una respuesta degradada.
+    """
+
+
+@contextmanager
+def etapa_llm(nombre: str, segundos: float):
+    """
+    Fija el plazo de las llamadas al LLM hechas dentro del bloque (todas
+    juntas, incluidas las esperas en cola y los reintentos).
+
+        with etapa_llm("router", LLM_ROUTER_TIMEOUT_SECONDS):
+            decision = await arouter_con_memoria(...)
+    """
+    token_etapa = _etapa.set(nombre)
+    token_plazo = _fecha_limite.set(time.monotonic() + segundos)
+    try:
+        yield
+    finally:
+        _fecha_limite.reset(token_plazo)
+        _etapa.reset(token_etapa)
+
+
+def etapa_actual() -> str:
+    """
+    Etapa del turno (fijada con etapa_llm) en la que se hace la llamada actual.
+    """
+    return _etapa.get()
+
+
+def _restante() -> Optional[float]:
+    fecha_limite = _fecha_limite.get()
+    return None if fecha_limite is None else fecha_limite - time.monotonic()
+
+
+def _motivo_reintento(error: Exception) -> Optional[str]:
+    for tipo, motivo in ERRORES_REINTENTABLES:
+        if isinstance(error, tipo):
+            return motivo
+    return None
+
+
+class LimitadorAIMD:
+    """
+    Límite de concurrencia adaptativo (AIMD) para las llamadas al LLM: cada
+    llamada que termina bien y rápido sube el límite en 1/límite (+1 por
+    "ronda"); un 429, un plazo de etapa agotado o una latencia por encima del
+    objetivo lo reduce a la mitad (como mucho una vez por ventana de latencia objetivo). Las llamadas
+    que no caben esperan en una cola acotada y, si la cola está llena o la
+    espera se alarga, se rechazan enseguida con LLMNoDisponible.
+    """
+
+    def __init__(self, inicial: float = LLM_CONCURRENCY_INITIAL, minimo: float = LLM_CONCURRENCY_MIN,
+                 maximo: float = LLM_CONCURRENCY_MAX, latencia_objetivo: float = LLM_LATENCY_TARGET_SECONDS,
+                 max_cola: int = LLM_QUEUE_MAX, espera_max: float = LLM_QUEUE_TIMEOUT_SECONDS):
+        self.limite = float(inicial)
+        self.minimo = float(minimo)
+        self.maximo = float(maximo)
+        self.latencia_objetivo = latencia_objetivo
+        self.max_cola = max_cola
+        self.espera_max = espera_max
+        self.en_curso = 0
+        self._cola: Deque[asyncio.Future] = deque()
+        self._ultimo_recorte = 0.0
+        limite_actual.set(self.limite)
+
+    def _hay_hueco(self) -> bool:
+        return self.en_curso < int(self.limite)
+
+    def _despertar(self):
+        while self._cola and self._hay_hueco():
+            futuro = self._cola.popleft()
+            if not futuro.done():
+                self.en_curso += 1
+                futuro.set_result(None)
+        llamadas_en_cola.set(len(self._cola))
+        llamadas_en_curso.set(self.en_curso)
+
+    async def adquirir(self):
+        """
+        Reserva un hueco o espera a que lo haya (lo que sea menor de espera_max
+        y el plazo de la etapa).
+
+        Raises:
+            LLMNoDisponible: Cola llena o espera agotada
+        """
+        if self._hay_hueco() and not self._cola:
+            self.en_curso += 1
+            llamadas_en_curso.set(self.en_curso)
+            return
+        if len(self._cola) >= self.max_cola:
+            rechazadas.inc(motivo="cola_llena")
+            raise LLMNoDisponible("Demasiadas llamadas al LLM en espera")
+
+        restante = _restante()
+        espera = self.espera_max if restante is None else max(0.0, min(self.espera_max, restante))
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.append(futuro)
+        llamadas_en_cola.set(len(self._cola))
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), espera)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if futuro.done() and not futuro.cancelled():
+                # Se concedió el hueco justo a la vez: se devuelve
+                self.liberar()
+            else:
+                futuro.cancel()
+                try:
+                    self._cola.remove(futuro)
+                except ValueError:
+                    pass
+                llamadas_en_cola.set(len(self._cola))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            rechazadas.inc(motivo="espera")
+            raise LLMNoDisponible("El LLM está saturado") from None
+
+    def liberar(self):
+        self.en_curso -= 1
+        self._despertar()
+
+    def registrar(self, latencia: float, sobrecarga: bool = False):
+        """
+        Ajusta el límite con el resultado de una llamada.
+
+        Args:
+            latencia: Segundos que tardó la llamada
+            sobrecarga: True si la API respondió 429 o la llamada agotó el plazo de su etapa
+        """
+        ahora = time.monotonic()
+        if sobrecarga or latencia > self.latencia_objetivo:
+            if ahora - self._ultimo_recorte >= self.latencia_objetivo:
+                self.limite = max(self.minimo, self.limite / 2)
+                self._ultimo_recorte = ahora
+        else:
+            self.limite = min(self.maximo, self.limite + 1 / self.limite)
+        limite_actual.set(self.limite)
+        self._despertar()
+
+    async def _esperar_reintento(self, intento: int, motivo: str, error: Exception):
+        reintentos.inc(motivo=motivo)
+        print(f"[llm] Reintento {intento}/{LLM_MAX_RETRIES} tras error ({motivo}): {error}")
+        espera = LLM_RETRY_BASE_SECONDS * 2 ** (intento - 1) * random.uniform(0.5, 1.0)
+        restante = _restante()
+        if restante is not None and espera >= restante:
+            rechazadas.inc(motivo="plazo")
+            raise LLMNoDisponible(f"Plazo de la etapa {_etapa.get()} agotado") from error
+        await asyncio.sleep(espera)
+
+    def _comprobar_plazo(self):
+        restante = _restante()
+        if restante is not None and restante <= 0:
+            rechazadas.inc(motivo="plazo")
+            raise LLMNoDisponible(f"Plazo de la etapa {_etapa.get()} agotado")
+
+    async def ejecutar(self, operacion: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Ejecuta una llamada al LLM dentro del límite, con el plazo de la etapa
+        y reintentos con backoff exponencial y jitter ante errores transitorios
+        (429, timeouts, errores de conexión y 5xx).
+
+        Args:
+            operacion: Función sin argumentos que devuelve la corrutina de la llamada
+
+        Returns:
+            Resultado de la llamada
+
+        Raises:
+            LLMNoDisponible: Limitador saturado o plazo agotado
+            Exception: Errores no reintentables o el último error tras agotar los reintentos
+        """
+        intento = 0
+        while True:
+            self._comprobar_plazo()
+            await self.adquirir()
+            inicio = time.monotonic()
+            try:
+                resultado = await asyncio.wait_for(operacion(), _restante())
+            except asyncio.TimeoutError:
+                self.liberar()
+                # Una llamada cortada por el plazo no es un éxito rápido: cuenta como sobrecarga
+                self.registrar(time.monotonic() - inicio, sobrecarga=True)
+                plazos_agotados.inc(etapa=_etapa.get())
+                raise LLMNoDisponible(f"Plazo de la etapa {_etapa.get()} agotado") from None
+            except Exception as e:
+                self.liberar()
+                motivo = _motivo_reintento(e)
+                if motivo is None:
+                    raise
+                self.registrar(time.monotonic() - inicio, sobrecarga=(motivo == "429"))
+                if intento >= LLM_MAX_RETRIES:
+                    raise
+                intento += 1
+                await self._esperar_reintento(intento, motivo, e)
+                continue
+            except BaseException:
+                self.liberar()
+                raise
+            self.liberar()
+            self.registrar(time.monotonic() - inicio)
+            return resultado
+
+    async def ejecutar_stream(self, crear_stream: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Variante de ejecutar para respuestas en streaming: el hueco se ocupa
+        hasta el último fragmento y solo se reintenta si aún no se ha emitido
+        ninguno. Para ajustar el límite cuenta la latencia hasta el primer
+        fragmento (la duración total depende de la longitud de la respuesta).
+
+        Args:
+            crear_stream: Función sin argumentos que devuelve el iterador asíncrono de fragmentos
+
+        Yields:
+            Fragmentos de la respuesta
+        """
+        intento = 0
+        while True:
+            self._comprobar_plazo()
+            await self.adquirir()
+            inicio = time.monotonic()
+            latencia = None  # Hasta el primer fragmento
+            stream = crear_stream()
+            try:
+                while True:
+                    try:
+                        fragmento = await asyncio.wait_for(stream.__anext__(), _restante())
+                    except StopAsyncIteration:
+                        break
+                    if latencia is None:
+                        latencia = time.monotonic() - inicio
+                    yield fragmento
+            except asyncio.TimeoutError:
+                self.liberar()
+                # Una llamada cortada por el plazo no es un éxito rápido: cuenta como sobrecarga
+                self.registrar(time.monotonic() - inicio, sobrecarga=True)
+                plazos_agotados.inc(etapa=_etapa.get())
+                raise LLMNoDisponible(f"Plazo de la etapa {_etapa.get()} agotado") from None
+            except Exception as e:
+                self.liberar()
+                motivo = _motivo_reintento(e)
+                if motivo is None:
+                    raise
+                self.registrar(time.monotonic() - inicio, sobrecarga=(motivo == "429"))
+                if latencia is not None or intento >= LLM_MAX_RETRIES:
+                    raise
+                intento += 1
+                await self._esperar_reintento(intento, motivo, e)
+                continue
+            except BaseException:
+                self.liberar()
+                raise
+            finally:
+                await stream.aclose()
+            self.liberar()
+            self.registrar(latencia if latencia is not None else time.monotonic() - inicio)
+            return
+
+
+# Limitador compartido por todas las llamadas al LLM del proceso
+limitador_llm = LimitadorAIMD()
@@ -1,9 +1,124 @@
+from typing import Any, AsyncIterator, List, Optional
+from langchain_core.load import dumps
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
 from langchain_openai import ChatOpenAI
 import os
+from config import (
+    LLM_REQUEST_TIMEOUT_SECONDS, LLM_PROVIDER,
+    LLM_SIMULATED_LATENCY_P50_MS, LLM_SIMULATED_LATENCY_P95_MS, LLM_SIMULATED_SEED,
+)
+from limitador_llm import limitador_llm
+from llm_cache import cache_llm
+from llm_simulado import ChatSimulado
+from single_flight import SingleFlight
+
+
+# Llamadas al LLM en curso, compartidas por todas las sesiones del proceso
+vuelos_llm = SingleFlight("llm")
+
+
+class CoalescerLlamadas:
+    """
+    Mixin para modelos de chat de LangChain: las llamadas asíncronas idénticas
+    (mismo modelo, parámetros y mensajes) que coinciden en el tiempo se hacen
+    una sola vez contra la API y todas reciben la misma respuesta. En una ráfaga
+    de mensajes iguales baja la concurrencia máxima contra OpenAI.
+
+    Las llamadas que se unen a otra en curso reciben la respuesta sin
+    token_usage y marcada como agrupada: los callbacks no cuentan como
+    llamada ni como tokens algo que no ha llegado a la API.
+    """
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        clave = (self._get_llm_string(stop=stop, **kwargs), dumps(messages))
+        ejecutada = False
+
+        def operacion():
+            nonlocal ejecutada
+            ejecutada = True
+            return super(CoalescerLlamadas, self)._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+        resultado = await vuelos_llm.ejecutar(clave, operacion)
+        if ejecutada:
+            return resultado
+        return ChatResult(
+            generations=resultado.generations,
+            llm_output={**(resultado.llm_output or {}), "token_usage": {}, "agrupada": True}
+        )
+
+
+class LimitarLlamadas:
+    """
+    Mixin para modelos de chat de LangChain: las llamadas asíncronas pasan por
+    el limitador AIMD compartido (concurrencia adaptativa, plazo de la etapa y
+    reintentos con jitter). Si está saturado lanza LLMNoDisponible.
+    El modelo base debe implementar _astream (ChatOpenAI lo hace).
+    """
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await limitador_llm.ejecutar(
+            lambda: super(LimitarLlamadas, self)._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for fragmento in limitador_llm.ejecutar_stream(
+            lambda: super(LimitarLlamadas, self)._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        ):
+            yield fragmento
+
+
+class ChatOpenAIServidor(CoalescerLlamadas, LimitarLlamadas, ChatOpenAI):
+    """
+    ChatOpenAI del servidor: agrupa las llamadas idénticas simultáneas y
+    después las limita (una llamada agrupada ocupa un solo hueco).
+    """
+
+
+class ChatSimuladoServidor(CoalescerLlamadas, LimitarLlamadas, ChatSimulado):
+    """
+    Modelo simulado (LLM_PROVIDER=simulado) con el mismo envoltorio que el
+    real, para que las pruebas de carga midan también la agrupación y el limitador.
+    """
+
+
+def _crear_llm():
+    if LLM_PROVIDER == "simulado":
+        print(f"[llm] Usando el LLM simulado (p50={LLM_SIMULATED_LATENCY_P50_MS} ms, p95={LLM_SIMULATED_LATENCY_P95_MS} ms)")
+        return ChatSimuladoServidor(
+            latencia_p50_ms=LLM_SIMULATED_LATENCY_P50_MS,
+            latencia_p95_ms=LLM_SIMULATED_LATENCY_P95_MS,
+            semilla=LLM_SIMULATED_SEED,
+            cache=cache_llm,
+        )
+
+    # Los reintentos los hace el limitador, no el cliente de OpenAI
+    return ChatOpenAIServidor(
+        model="gpt-4o-mini",
+        temperature=0,
+        cache=cache_llm,
+        max_retries=0,
+        timeout=LLM_REQUEST_TIMEOUT_SECONDS,
+    )
 
 
 # Configurar el LLM
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0,
-)
+llm = _crear_llm()
@@ -0,0 +1,222 @@
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Optional
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, delete, event, func, select, update
+from sqlalchemy.orm import Session, declarative_base, object_session, sessionmaker
+from database import crear_engine
+from models import Cliente
+from config import LLM_CACHE, LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES
+import metrics
+
+
+aciertos = metrics.counter(
+    "llm_cache_hits_total",
+    "Llamadas al LLM servidas desde la caché"
+)
+fallos = metrics.counter(
+    "llm_cache_misses_total",
+    "Llamadas al LLM que no estaban en la caché"
+)
+desalojos = metrics.counter(
+    "llm_cache_evictions_total",
+    "Entradas eliminadas de la caché del LLM por motivo (ttl / tamano / clientes)"
+)
+
+# Desactiva la caché para las llamadas hechas dentro de sin_cache()
+_cache_desactivada: ContextVar[bool] = ContextVar("cache_llm_desactivada", default=False)
+# Marca las respuestas guardadas dentro de depende_de_clientes()
+_depende_clientes: ContextVar[bool] = ContextVar("cache_llm_depende_clientes", default=False)
+
+BaseTablasCache = declarative_base()
+
+
+class EntradaCache(BaseTablasCache):
+    """Respuesta del LLM guardada por hash de (modelo + parámetros, prompt)"""
+    __tablename__ = "llm_cache"
+
+    clave = Column(String, primary_key=True)  # sha256 de llm_string + prompt
+    respuesta = Column(Text, nullable=False)  # Generaciones serializadas con langchain_core.load
+    depende_clientes = Column(Boolean, nullable=False, default=False, index=True)
+    creado = Column(DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_uso = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    usos = Column(Integer, nullable=False, default=0)
+
+
+@contextmanager
+def sin_cache():
+    """
+    Las llamadas al LLM dentro del bloque no leen ni escriben la caché.
+
+        with sin_cache():
+            respuesta = await llm.ainvoke(...)
+    """
+    token = _cache_desactivada.set(True)
+    try:
+        yield
+    finally:
+        _cache_desactivada.reset(token)
+
+
+@contextmanager
+def depende_de_clientes():
+    """
+    Las respuestas guardadas dentro del bloque dependen del contenido de la
+    tabla clientes (agentes que consultan herramientas) y se invalidan cuando
+    esta cambia.
+    """
+    token = _depende_clientes.set(True)
+    try:
+        yield
+    finally:
+        _depende_clientes.reset(token)
+
+
+class CacheLLMSQLite(BaseCache):
+    """
+    Caché exacta y persistente de respuestas del LLM en un fichero SQLite,
+    enchufada al hook de caché de LangChain. Añade lo que no trae SQLiteCache:
+    caducidad (TTL), tamaño máximo con desalojo de las menos usadas
+    recientemente, contadores de aciertos/fallos y la invalidación de las
+    respuestas que dependen de resultados de herramientas cuando cambia la
+    tabla clientes.
+
+    LangChain la consulta en invoke/ainvoke (y en los agentes ReAct, que
+    llaman a agenerate); las llamadas con .astream no pasan por la caché.
+    """
+
+    def __init__(self, ruta: str, ttl_segundos: int, max_entradas: int):
+        self.engine = crear_engine(f"sqlite:///{ruta}")
+        BaseTablasCache.metadata.create_all(self.engine)
+        self.SessionLocal = sessionmaker(bind=self.engine, autoflush=False)
+        self.ttl = timedelta(seconds=ttl_segundos)
+        self.max_entradas = max_entradas
+        self._lock = Lock()
+        with self.SessionLocal() as db:
+            self._total = db.execute(select(func.count(EntradaCache.clave))).scalar_one()
+
+    @staticmethod
+    def _clave(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if _cache_desactivada.get():
+            return None
+        clave = self._clave(prompt, llm_string)
+        ahora = datetime.utcnow()
+        with self.SessionLocal() as db:
+            entrada = db.get(EntradaCache, clave)
+            if entrada is None:
+                fallos.inc()
+                return None
+            if entrada.creado < ahora - self.ttl:
+                db.delete(entrada)
+                db.commit()
+                with self._lock:
+                    self._total -= 1
+                desalojos.inc(motivo="ttl")
+                fallos.inc()
+                return None
+            db.execute(
+                update(EntradaCache)
+                .where(EntradaCache.clave == clave)
+                .values(ultimo_uso=ahora, usos=EntradaCache.usos + 1)
+            )
+            db.commit()
+            respuesta = entrada.respuesta
+        aciertos.inc()
+        return loads(respuesta)
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if _cache_desactivada.get():
+            return
+        clave = self._clave(prompt, llm_string)
+        with self.SessionLocal() as db:
+            nueva = db.get(EntradaCache, clave) is None
+            db.merge(EntradaCache(
+                clave=clave,
+                respuesta=dumps(return_val),
+                depende_clientes=_depende_clientes.get(),
+                creado=datetime.utcnow(),
+                ultimo_uso=datetime.utcnow(),
+            ))
+            db.commit()
+        if nueva:
+            with self._lock:
+                self._total += 1
+                exceso = self._total - self.max_entradas
+            if exceso > 0:
+                self._desalojar(exceso)
+
+    def _desalojar(self, exceso: int):
+        """
+        Elimina las entradas usadas hace más tiempo. Libera un 10 % extra para
+        no desalojar en cada inserción.
+        """
+        cantidad = exceso + self.max_entradas // 10
+        with self.SessionLocal() as db:
+            antiguas = select(EntradaCache.clave).order_by(EntradaCache.ultimo_uso).limit(cantidad)
+            borradas = db.execute(delete(EntradaCache).where(EntradaCache.clave.in_(antiguas))).rowcount
+            db.commit()
+        with self._lock:
+            self._total -= borradas
+        desalojos.inc(borradas, motivo="tamano")
+
+    def invalidar_dependientes_clientes(self):
+        """
+        Borra las respuestas marcadas con depende_de_clientes() (listados,
+        conteos...), que pueden quedar obsoletas al cambiar clientes.
+        """
+        with self.SessionLocal() as db:
+            borradas = db.execute(delete(EntradaCache).where(EntradaCache.depende_clientes)).rowcount
+            db.commit()
+        with self._lock:
+            self._total -= borradas
+        if borradas:
+            desalojos.inc(borradas, motivo="clientes")
+
+    def clear(self, **kwargs) -> None:
+        with self.SessionLocal() as db:
+            db.execute(delete(EntradaCache))
+            db.commit()
+        with self._lock:
+            self._total = 0
+
+    def entradas(self) -> int:
+        """
+        Número de respuestas guardadas. No se implementa __len__: LangChain
+        evalúa la caché como booleano y una caché vacía se ignoraría.
+        """
+        return self._total
+
+
+# None con LLM_CACHE=false: el LLM no usa caché
+cache_llm = CacheLLMSQLite(LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES) if LLM_CACHE else None
+
+
+# Los eventos del mapper llegan en el flush, antes del commit: si se invalidara
+# ahí, una petición concurrente podría volver a llenar la caché con los datos
+# antiguos antes de que el cambio fuera visible. Se anota en la sesión y se
+# invalida al hacer commit (o se descarta si hay rollback).
+@event.listens_for(Cliente, "after_insert")
+@event.listens_for(Cliente, "after_update")
+@event.listens_for(Cliente, "after_delete")
+def _clientes_cambiados(mapper, connection, cliente):
+    sesion = object_session(cliente)
+    if sesion is not None:
+        sesion.info["clientes_cambiados"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidar_tras_commit(sesion):
+    if sesion.info.pop("clientes_cambiados", False) and cache_llm is not None:
+        cache_llm.invalidar_dependientes_clientes()
+
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_tras_rollback(sesion):
+    sesion.info.pop("clientes_cambiados", None)
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import math
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from tokens import contar_tokens
+
+
+PATRON_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+PATRON_NOMBRE = re.compile(r"(?:llamad[oa]|nombre(?: es)?|cliente)\s+([A-ZÁÉÍÓÚÑ][\wáéíóúñ]+(?:\s+[A-ZÁÉÍÓÚÑ][\wáéíóúñ]+)?)")
+PALABRAS_CREAR = ("crea", "registr", "agreg", "añad", "guarda", "nuevo", "alta")
+
+
+def _bloque_accion(accion: str, entrada: Any) -> str:
+    return "```json\n" + json.dumps({"action": accion, "action_input": entrada}, ensure_ascii=False) + "\n```"
+
+
+def _es_crear(texto: str) -> bool:
+    texto = texto.lower()
+    return "@" in texto or any(palabra in texto for palabra in PALABRAS_CREAR)
+
+
+def _datos_cliente(texto: str) -> Dict[str, Optional[str]]:
+    email = PATRON_EMAIL.search(texto)
+    nombre = PATRON_NOMBRE.search(texto)
+    return {
+        "nombre": nombre.group(1) if nombre else None,
+        "email": email.group(0).lower() if email else None,
+    }
+
+
+class ChatSimulado(BaseChatModel):
+    """
+    Modelo de chat falso para pruebas de carga sin red: reconoce los prompts
+    del servidor (router, agentes ReAct, agente de funciones y extracción de
+    slots) y devuelve respuestas con el formato que cada uno espera, tras una
+    latencia aleatoria con distribución log-normal (mediana y p95 configurables).
+    """
+
+    latencia_p50_ms: float = 800
+    latencia_p95_ms: float = 2000
+    semilla: Optional[int] = None
+    aleatorio: Any = None
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.aleatorio = random.Random(self.semilla)
+
+    @property
+    def _llm_type(self) -> str:
+        return "simulado"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"latencia_p50_ms": self.latencia_p50_ms, "latencia_p95_ms": self.latencia_p95_ms}
+
+    def _latencia(self) -> float:
+        """
+        Segundos de una llamada: log-normal con la mediana y el p95 configurados.
+        """
+        mu = math.log(max(self.latencia_p50_ms, 0.001))
+        sigma = max(0.0, math.log(max(self.latencia_p95_ms, self.latencia_p50_ms) / max(self.latencia_p50_ms, 0.001)) / 1.645)
+        return self.aleatorio.lognormvariate(mu, sigma) / 1000
+
+    def _responder(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) -> AIMessage:
+        sistema = next((str(m.content) for m in messages if isinstance(m, SystemMessage)), "")
+        humanos = [str(m.content) for m in messages if isinstance(m, HumanMessage)]
+        ultimo = humanos[-1] if humanos else ""
+
+        # Agente de funciones (function calling)
+        if kwargs.get("functions"):
+            datos = _datos_cliente(ultimo)
+            if _es_crear(ultimo):
+                if datos["nombre"] and datos["email"]:
+                    return self._llamada_funcion("crear_cliente", datos)
+                return AIMessage(content="¿Cuál es el nombre y el email del cliente?")
+            if "cuánt" in ultimo.lower() or "cuant" in ultimo.lower():
+                return self._llamada_funcion("contar_clientes", {})
+            return self._llamada_funcion("consultar_clientes", {})
+
+        # Resumen de sesiones (compactador)
+        if sistema.startswith("Resume la conversación"):
+            nuevos = ultimo.split("Mensajes nuevos:")[-1].strip().splitlines()
+            return AIMessage(content="El usuario ha hablado de: " + "; ".join(l[:60] for l in nuevos[-6:]))
+
+        # Extracción de slots
+        if sistema.startswith("Extrae el nombre y el email"):
+            return AIMessage(content=json.dumps(_datos_cliente(ultimo), ensure_ascii=False))
+
+        # Router (con y sin historial)
+        if "Responde SOLO con una de estas palabras" in sistema + ultimo:
+            mensaje = ultimo.split("Mensaje:")[-1].split("Responde SOLO")[0] if not sistema else ultimo
+            return AIMessage(content="crear" if _es_crear(mensaje) else "consultar")
+
+        # Agentes ReAct de chat estructurado
+        if '"action"' in sistema:
+            if "Observation:" in ultimo:
+                observacion = ultimo.rsplit("Observation:", 1)[1].split("Thought:")[0].strip()
+                return AIMessage(content=_bloque_accion("Final Answer", observacion))
+            entrada = ultimo.split("\n\n")[0]
+            if "crear_cliente" in sistema:
+                datos = _datos_cliente(entrada)
+                if datos["nombre"] and datos["email"]:
+                    return AIMessage(content=_bloque_accion("crear_cliente", datos))
+                return AIMessage(content=_bloque_accion("Final Answer", "¿Cuál es el nombre y el email del cliente?"))
+            if "cuánt" in entrada.lower() or "cuant" in entrada.lower():
+                return AIMessage(content=_bloque_accion("contar_clientes", {}))
+            return AIMessage(content=_bloque_accion("consultar_clientes", {}))
+
+        return AIMessage(content="De acuerdo.")
+
+    @staticmethod
+    def _llamada_funcion(nombre: str, argumentos: Dict[str, Any]) -> AIMessage:
+        return AIMessage(
+            content="",
+            additional_kwargs={"function_call": {"name": nombre, "arguments": json.dumps(argumentos, ensure_ascii=False)}}
+        )
+
+    def _resultado(self, messages: List[BaseMessage], mensaje: AIMessage) -> ChatResult:
+        uso = {
+            "prompt_tokens": sum(contar_tokens(str(m.content)) for m in messages),
+            "completion_tokens": contar_tokens(str(mensaje.content) or json.dumps(mensaje.additional_kwargs)),
+        }
+        uso["total_tokens"] = uso["prompt_tokens"] + uso["completion_tokens"]
+        return ChatResult(
+            generations=[ChatGeneration(message=mensaje)],
+            llm_output={"token_usage": uso, "model_name": "simulado"}
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._latencia())
+        return self._resultado(messages, self._responder(messages, kwargs))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._latencia())
+        return self._resultado(messages, self._responder(messages, kwargs))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._latencia())
+        mensaje = self._responder(messages, kwargs)
+        if mensaje.additional_kwargs:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs=mensaje.additional_kwargs))
+            return
+        texto = str(mensaje.content)
+        for i in range(0, len(texto), 4):
+            trozo = texto[i:i + 4]
+            fragmento = ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+            if run_manager:
+                await run_manager.on_llm_new_token(trozo, chunk=fragmento)
+            yield fragmento
+            await asyncio.sleep(0)
@@ -1,17 +1,117 @@
+from datetime import datetime
 from langchain.memory import ConversationBufferMemory
-from database import SessionLocal
-from models import Mensaje
-from typing import List
+from langchain_core.messages import SystemMessage
+from sqlalchemy import and_, func, or_, select, delete
+from models import Mensaje, ResumenSesion, SesionArchivada
+from typing import AsyncIterator, List, NamedTuple, Optional, Tuple
+from config import (
+    MEMORY_MODE, MEMORY_MAX_TURNS, MEMORY_MAX_TOKENS, MEMORY_CACHE_SIZE, MESSAGE_SINK_DURABLE, MEMORY_SUMMARY,
+    HISTORY_PAGE_SIZE, HISTORY_STREAM_CHUNK, RETENTION_BATCH_MESSAGES,
+)
+from retencion import leer_sesion_archivada, leer_sesion_archivada_sync, restaurar_sesion, restaurar_sesion_sync
+from shards import SHARDS, obtener_shard
+from session_cache import SessionCache
+from tokens import contar_tokens
+
+
+# Rol de la entrada con el resumen de los mensajes antiguos (siempre la primera de la lista)
+ROL_RESUMEN = "resumen"
+
+
+def recortar_ventana(mensajes: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Aplica la ventana de memoria configurada a una lista de mensajes.
+    En modo "window" conserva como máximo los últimos MEMORY_MAX_TURNS turnos
+    (usuario + asistente) y descarta los más antiguos hasta quedar dentro de
+    MEMORY_MAX_TOKENS. En modo "buffer" no recorta nada. El resumen de la
+    sesión, si lo hay, se conserva siempre.
+
+    Args:
+        mensajes: Lista de (role, content) ordenada del más antiguo al más reciente
+
+    Returns:
+        Lista recortada con el mismo orden
+    """
+    if mensajes and mensajes[0][0] == ROL_RESUMEN:
+        return mensajes[:1] + recortar_ventana(mensajes[1:])
+    if MEMORY_MODE != "window":
+        return mensajes
+
+    mensajes = mensajes[-MEMORY_MAX_TURNS * 2:]
+    total = sum(contar_tokens(content) for _, content in mensajes)
+    while len(mensajes) > 1 and total > MEMORY_MAX_TOKENS:
+        total -= contar_tokens(mensajes[0][1])
+        mensajes = mensajes[1:]
+    return mensajes
+
+
+# Posición de un mensaje en el historial (orden de lectura): (timestamp, id)
+Cursor = Tuple[datetime, int]
+
+
+def codificar_cursor(timestamp: datetime, id: int) -> str:
+    """
+    Cursor opaco para continuar el historial después de un mensaje: "timestamp|id".
+    """
+    return f"{timestamp.isoformat()}|{id}"
+
+
+def decodificar_cursor(cursor: str) -> Cursor:
+    """
+    Inverso de codificar_cursor.
+
+    Raises:
+        ValueError: Cursor mal formado
+    """
+    timestamp, _, id = cursor.rpartition("|")
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+class FilaHistorial(NamedTuple):
+    """Mensaje archivado servido en el historial, con las columnas de una fila de mensajes"""
+    id: int
+    role: str
+    content: str
+    timestamp: datetime
+
+
+def _filas_archivadas(archivados: List[tuple]) -> List[FilaHistorial]:
+    # El archivo guarda el id original de cada mensaje, así que el cursor
+    # (timestamp, id) es el mismo antes y después de restaurar la sesión
+    return [FilaHistorial(*fila) for fila in archivados]
 
 
 class PersistentMemoryManager:
     """
     Gestiona la memoria de conversaciones con persistencia en base de datos.
     Permite guardar, recuperar y limpiar el historial de mensajes por sesión.
+
+    Cada operación tiene una variante asíncrona (prefijo "a") que usa el motor
+    asíncrono de SQLAlchemy y es la que deben usar los endpoints de FastAPI.
+
+    La memoria para los agentes se sirve desde una caché LRU de sesiones
+    calientes que save_message mantiene actualizada, así que en régimen
+    estable los turnos no leen de la base de datos.
+
+    Las escrituras asíncronas pasan por el MessageSink (group commit): los
+    mensajes de muchas sesiones concurrentes comparten transacción.
+
+    Con MESSAGE_SHARDS > 1 cada sesión vive en un shard (base de datos) fijo
+    según el hash de su session_id, y todas sus operaciones van a ese shard.
+
+    Con MEMORY_SUMMARY los mensajes antiguos de la sesión se sustituyen por su
+    resumen (ResumenSesion, lo mantiene el compactador en segundo plano): la
+    memoria es el resumen más los mensajes posteriores a él.
+
+    Las sesiones inactivas las archiva la retención (retencion.py): antes de
+    cargar la memoria de una sesión archivada (un turno nuevo) se restaura, y
+    su historial se lee del archivo sin sacarla de él.
     """
 
+    _cache = SessionCache(MEMORY_CACHE_SIZE, recortar_ventana)
+
     @staticmethod
-    def save_message(session_id: str, role: str, content: str):
+    def save_message(session_id: str, role: str, content: str, canal: str = "web"):
         """
         Guarda un mensaje en la base de datos.
 
@@ -19,18 +119,21 @@ class PersistentMemoryManager:
             session_id: Identificador único de la sesión
             role: "user" o "assistant"
             content: Contenido del mensaje
+            canal: "web" o "whatsapp" (TTL de retención)
         """
-        db = SessionLocal()
+        db = obtener_shard(session_id).SessionLocal()
         try:
             mensaje = Mensaje(
                 session_id=session_id,
                 role=role,
-                content=content
+                content=content,
+                canal=canal
             )
             db.add(mensaje)
             db.commit()
         finally:
             db.close()
+        PersistentMemoryManager._cache.append(session_id, role, content)
 
     @staticmethod
     def get_history(session_id: str) -> List[Mensaje]:
@@ -43,9 +146,13 @@ class PersistentMemoryManager:
         Returns:
             Lista de mensajes ordenados por timestamp
         """
-        db = SessionLocal()
+        archivados = [
+            Mensaje(session_id=session_id, role=role, content=content, timestamp=timestamp)
+            for _, role, content, timestamp in leer_sesion_archivada_sync(session_id)
+        ]
+        db = obtener_shard(session_id).SessionLocal()
         try:
-            return db.query(Mensaje)\
+            return archivados + db.query(Mensaje)\
                 .filter(Mensaje.session_id == session_id)\
                 .order_by(Mensaje.timestamp)\
                 .all()
@@ -55,11 +162,79 @@ class PersistentMemoryManager:
     @staticmethod
     def load_memory_for_agent(session_id: str) -> ConversationBufferMemory:
         """
-        Carga el historial desde BD y lo convierte en memoria de LangChain.
+        Carga el resumen de la sesión y el historial posterior (ventana
+        configurada) y lo convierte en memoria de LangChain.
 
         Args:
             session_id: Identificador único de la sesión
 
+        Returns:
+            ConversationBufferMemory con historial cargado
+        """
+        mensajes = PersistentMemoryManager._cache.get(session_id)
+        if mensajes is None:
+            restaurar_sesion_sync(session_id)
+            db = obtener_shard(session_id).SessionLocal()
+            try:
+                resumen = db.execute(
+                    PersistentMemoryManager._consulta_resumen(session_id)
+                ).first() if MEMORY_SUMMARY else None
+                filas = db.execute(
+                    PersistentMemoryManager._consulta_ventana(session_id, resumen.hasta_id if resumen else 0)
+                ).all()
+            finally:
+                db.close()
+            mensajes = PersistentMemoryManager._filas_a_mensajes(resumen, filas)
+            PersistentMemoryManager._cache.put(session_id, mensajes)
+
+        return PersistentMemoryManager._construir_memoria(recortar_ventana(mensajes))
+
+    @staticmethod
+    def _consulta_resumen(session_id: str):
+        """
+        Construye la consulta del resumen de una sesión y del último mensaje que incluye.
+        """
+        return select(ResumenSesion.resumen, ResumenSesion.hasta_id)\
+            .where(ResumenSesion.session_id == session_id)
+
+    @staticmethod
+    def _consulta_ventana(session_id: str, desde_id: int = 0):
+        """
+        Construye la consulta de los mensajes de la ventana de una sesión
+        posteriores al mensaje desde_id (el último ya resumido).
+        En modo "window" solo lee los últimos turnos (orden descendente + LIMIT).
+        """
+        consulta = select(Mensaje.role, Mensaje.content)\
+            .where(Mensaje.session_id == session_id)
+        if desde_id:
+            consulta = consulta.where(Mensaje.id > desde_id)
+        if MEMORY_MODE == "window":
+            return consulta\
+                .order_by(Mensaje.timestamp.desc(), Mensaje.id.desc())\
+                .limit(MEMORY_MAX_TURNS * 2)
+        return consulta.order_by(Mensaje.timestamp, Mensaje.id)
+
+    @staticmethod
+    def _filas_a_mensajes(resumen, filas) -> List[Tuple[str, str]]:
+        """
+        Convierte el resumen (o None) y las filas de _consulta_ventana en
+        (role, content) en orden cronológico, con el resumen en primer lugar.
+        """
+        mensajes = [(fila.role, fila.content) for fila in filas]
+        if MEMORY_MODE == "window":
+            mensajes.reverse()
+        if resumen is not None:
+            mensajes.insert(0, (ROL_RESUMEN, resumen.resumen))
+        return mensajes
+
+    @staticmethod
+    def _construir_memoria(mensajes: List[Tuple[str, str]]) -> ConversationBufferMemory:
+        """
+        Convierte una lista de mensajes (role, content) en memoria de LangChain.
+
+        Args:
+            mensajes: Mensajes de la sesión en orden cronológico
+
         Returns:
             ConversationBufferMemory con historial cargado
         """
@@ -68,38 +243,301 @@ class PersistentMemoryManager:
             return_messages=True
         )
 
-        # Cargar mensajes históricos directamente desde la BD
-        db = SessionLocal()
-        try:
-            mensajes = db.query(Mensaje)\
-                .filter(Mensaje.session_id == session_id)\
-                .order_by(Mensaje.timestamp)\
-                .all()
-        finally:
-            db.close()
-
         # Convertir a formato LangChain
-        for msg in mensajes:
-            if msg.role == "user":
-                memory.chat_memory.add_user_message(msg.content)
-            elif msg.role == "assistant":
-                memory.chat_memory.add_ai_message(msg.content)
+        for role, content in mensajes:
+            if role == "user":
+                memory.chat_memory.add_user_message(content)
+            elif role == "assistant":
+                memory.chat_memory.add_ai_message(content)
+            elif role == ROL_RESUMEN:
+                memory.chat_memory.add_message(
+                    SystemMessage(content=f"Resumen de la conversación anterior:\n{content}")
+                )
 
         return memory
 
     @staticmethod
     def clear_session(session_id: str):
         """
-        Elimina todos los mensajes de una sesión.
+        Elimina todos los mensajes de una sesión, su resumen y su archivo.
 
         Args:
             session_id: Identificador único de la sesión
         """
-        db = SessionLocal()
+        db = obtener_shard(session_id).SessionLocal()
         try:
             db.query(Mensaje)\
                 .filter(Mensaje.session_id == session_id)\
                 .delete()
+            db.query(ResumenSesion)\
+                .filter(ResumenSesion.session_id == session_id)\
+                .delete()
+            db.query(SesionArchivada)\
+                .filter(SesionArchivada.session_id == session_id)\
+                .delete()
             db.commit()
         finally:
             db.close()
+        PersistentMemoryManager._cache.invalidate(session_id)
+
+    # ------------------------------------------------------------------
+    # Variantes asíncronas
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    async def asave_message(session_id: str, role: str, content: str, canal: str = "web"):
+        """
+        Versión asíncrona de save_message (escritura agrupada).
+        Con MESSAGE_SINK_DURABLE vuelve cuando el mensaje ya está guardado.
+
+        Args:
+            session_id: Identificador único de la sesión
+            role: "user" o "assistant"
+            content: Contenido del mensaje
+            canal: "web" o "whatsapp" (TTL de retención)
+        """
+        await PersistentMemoryManager._aescribir(session_id, [(role, content)], canal)
+
+    @staticmethod
+    async def _aescribir(session_id: str, mensajes: List[Tuple[str, str]], canal: str):
+        """
+        Escribe los mensajes con el sink y después los añade a la caché, para
+        que la caché nunca tenga mensajes que no llegaron a la base de datos.
+        Si la escritura falla (o se cancela) la sesión se invalida; si falla un
+        commit no durable, lo hace el sink con al_fallar.
+        """
+        try:
+            await obtener_shard(session_id).sink.escribir(
+                session_id, mensajes, esperar=MESSAGE_SINK_DURABLE, canal=canal
+            )
+        except BaseException:
+            PersistentMemoryManager._cache.invalidate(session_id)
+            raise
+        for role, content in mensajes:
+            PersistentMemoryManager._cache.append(session_id, role, content)
+
+    @staticmethod
+    async def asave_turn(session_id: str, mensaje_usuario: str, respuesta: str, canal: str = "web"):
+        """
+        Guarda el mensaje del usuario y la respuesta del asistente en un solo commit.
+
+        Args:
+            session_id: Identificador único de la sesión
+            mensaje_usuario: Mensaje del usuario
+            respuesta: Respuesta del asistente
+            canal: "web" o "whatsapp" (TTL de retención)
+        """
+        await PersistentMemoryManager._aescribir(
+            session_id, [("user", mensaje_usuario), ("assistant", respuesta)], canal
+        )
+
+    @staticmethod
+    async def aget_history(session_id: str) -> List[Mensaje]:
+        """
+        Versión asíncrona de get_history.
+
+        Args:
+            session_id: Identificador único de la sesión
+
+        Returns:
+            Lista de mensajes ordenados por timestamp
+        """
+        archivados = [
+            Mensaje(session_id=session_id, role=role, content=content, timestamp=timestamp)
+            for _, role, content, timestamp in await leer_sesion_archivada(session_id)
+        ]
+        sink = obtener_shard(session_id).sink
+        if sink.pendiente(session_id):
+            await sink.vaciar()
+        async with obtener_shard(session_id).AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Mensaje)
+                .where(Mensaje.session_id == session_id)
+                .order_by(Mensaje.timestamp, Mensaje.id)
+            )
+            return archivados + list(result.scalars().all())
+
+    @staticmethod
+    def _consulta_pagina(session_id: str, despues: Optional[Cursor], limite: int):
+        """
+        Construye la consulta (solo columnas, sin objetos ORM) de los
+        siguientes `limite` mensajes de una sesión tras el cursor, por keyset
+        sobre (timestamp, id): usa el índice de la sesión y no depende de
+        OFFSET, así que cada página cuesta lo mismo aunque la sesión sea larga.
+        """
+        consulta = select(Mensaje.id, Mensaje.role, Mensaje.content, Mensaje.timestamp)\
+            .where(Mensaje.session_id == session_id)
+        if despues is not None:
+            timestamp, id = despues
+            consulta = consulta.where(or_(
+                Mensaje.timestamp > timestamp,
+                and_(Mensaje.timestamp == timestamp, Mensaje.id > id)
+            ))
+        return consulta.order_by(Mensaje.timestamp, Mensaje.id).limit(limite)
+
+    @staticmethod
+    async def aget_history_page(session_id: str, despues: Optional[Cursor] = None,
+                                limite: int = HISTORY_PAGE_SIZE) -> list:
+        """
+        Lee una página del historial de una sesión. Si la sesión está archivada,
+        sus mensajes antiguos se leen del archivo sin restaurarla.
+
+        Args:
+            session_id: Identificador único de la sesión
+            despues: Cursor del último mensaje ya leído (None = desde el principio)
+            limite: Número máximo de mensajes
+
+        Returns:
+            Filas (id, role, content, timestamp) en orden cronológico
+        """
+        archivados = _filas_archivadas(await leer_sesion_archivada(session_id, despues and despues[0]))
+        return await PersistentMemoryManager._apagina(session_id, despues, limite, archivados)
+
+    @staticmethod
+    async def _apagina(session_id: str, despues: Optional[Cursor], limite: int,
+                       archivados: List[FilaHistorial]) -> list:
+        """
+        Página del historial: primero los mensajes archivados tras el cursor y,
+        si no llenan la página, los de la tabla mensajes.
+        """
+        pagina = [fila for fila in archivados if despues is None or (fila.timestamp, fila.id) > despues][:limite]
+        if len(pagina) == limite:
+            return pagina
+        if pagina:
+            despues = (pagina[-1].timestamp, pagina[-1].id)
+
+        sink = obtener_shard(session_id).sink
+        if sink.pendiente(session_id):
+            await sink.vaciar()
+        async with obtener_shard(session_id).AsyncSessionLocal() as db:
+            result = await db.execute(
+                PersistentMemoryManager._consulta_pagina(session_id, despues, limite - len(pagina))
+            )
+            return pagina + result.all()
+
+    @staticmethod
+    async def aiter_history(session_id: str, despues: Optional[Cursor] = None,
+                            limite: Optional[int] = None, lote: int = HISTORY_STREAM_CHUNK) -> AsyncIterator:
+        """
+        Recorre el historial de una sesión leyéndolo por lotes, cada uno en su
+        propia sesión de base de datos: la memoria no crece con la longitud del
+        historial y no se retiene una conexión mientras el cliente consume.
+
+        Args:
+            session_id: Identificador único de la sesión
+            despues: Cursor del último mensaje ya leído (None = desde el principio)
+            limite: Número máximo de mensajes (None = hasta el final)
+            lote: Filas por lectura
+
+        Yields:
+            Filas (id, role, content, timestamp) en orden cronológico
+        """
+        # El archivo (si lo hay) se descomprime una sola vez para todos los lotes
+        archivados = _filas_archivadas(await leer_sesion_archivada(session_id, despues and despues[0]))
+        restantes = limite
+        while restantes is None or restantes > 0:
+            tamano = lote if restantes is None else min(lote, restantes)
+            filas = await PersistentMemoryManager._apagina(session_id, despues, tamano, archivados)
+            for fila in filas:
+                yield fila
+            if len(filas) < tamano:
+                return
+            despues = (filas[-1].timestamp, filas[-1].id)
+            if restantes is not None:
+                restantes -= len(filas)
+
+    @staticmethod
+    async def acontar_mensajes(session_id: str) -> int:
+        """
+        Cuenta los mensajes de una sesión, incluidos los archivados (sin
+        descomprimir el archivo: usa su contador).
+
+        Args:
+            session_id: Identificador único de la sesión
+
+        Returns:
+            int: Mensajes de la sesión
+        """
+        sink = obtener_shard(session_id).sink
+        if sink.pendiente(session_id):
+            await sink.vaciar()
+        async with obtener_shard(session_id).AsyncSessionLocal() as db:
+            vivos = await db.scalar(
+                select(func.count()).select_from(Mensaje).where(Mensaje.session_id == session_id)
+            )
+            archivados = await db.scalar(
+                select(SesionArchivada.mensajes).where(SesionArchivada.session_id == session_id)
+            )
+        return vivos + (archivados or 0)
+
+    @staticmethod
+    async def aload_memory_for_agent(session_id: str) -> ConversationBufferMemory:
+        """
+        Versión asíncrona de load_memory_for_agent.
+
+        Args:
+            session_id: Identificador único de la sesión
+
+        Returns:
+            ConversationBufferMemory con historial cargado
+        """
+        mensajes = PersistentMemoryManager._cache.get(session_id)
+        if mensajes is None:
+            await restaurar_sesion(session_id)
+            # Lo que aún está en el sink no se vería en la base de datos
+            sink = obtener_shard(session_id).sink
+            if sink.pendiente(session_id):
+                await sink.vaciar()
+            async with obtener_shard(session_id).AsyncSessionLocal() as db:
+                resumen = (await db.execute(
+                    PersistentMemoryManager._consulta_resumen(session_id)
+                )).first() if MEMORY_SUMMARY else None
+                result = await db.execute(
+                    PersistentMemoryManager._consulta_ventana(session_id, resumen.hasta_id if resumen else 0)
+                )
+                filas = result.all()
+            mensajes = PersistentMemoryManager._filas_a_mensajes(resumen, filas)
+            PersistentMemoryManager._cache.put(session_id, mensajes)
+
+        return PersistentMemoryManager._construir_memoria(recortar_ventana(mensajes))
+
+    @staticmethod
+    async def aclear_session(session_id: str):
+        """
+        Versión asíncrona de clear_session. Los mensajes se borran en lotes de
+        RETENTION_BATCH_MESSAGES (una transacción por lote), para no bloquear
+        la base de datos con un DELETE enorme en las sesiones largas.
+
+        Args:
+            session_id: Identificador único de la sesión
+        """
+        sink = obtener_shard(session_id).sink
+        if sink.pendiente(session_id):
+            await sink.vaciar()
+        AsyncSessionLocal = obtener_shard(session_id).AsyncSessionLocal
+        while True:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    delete(Mensaje).where(Mensaje.id.in_(
+                        select(Mensaje.id)
+                        .where(Mensaje.session_id == session_id)
+                        .limit(RETENTION_BATCH_MESSAGES)
+                    ))
+                )
+                await db.commit()
+            if result.rowcount < RETENTION_BATCH_MESSAGES:
+                break
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(ResumenSesion).where(ResumenSesion.session_id == session_id)
+            )
+            await db.execute(
+                delete(SesionArchivada).where(SesionArchivada.session_id == session_id)
+            )
+            await db.commit()
+        PersistentMemoryManager._cache.invalidate(session_id)
+
+
+# Un commit fallido del sink no debe dejar en la caché mensajes que no se guardaron
+for _shard in SHARDS:
+    _shard.sink.al_fallar = PersistentMemoryManager._cache.invalidate
@@ -0,0 +1,171 @@
+import asyncio
+from collections import Counter, deque
+from datetime import datetime
+from typing import Callable, Deque, List, Optional, Tuple
+from sqlalchemy import insert
+from database import duracion_escrituras
+from models import Mensaje
+from config import MESSAGE_SINK_MAX_BATCH, MESSAGE_SINK_FLUSH_MS
+import metrics
+
+
+filas_escritas = metrics.counter(
+    "message_sink_rows_total",
+    "Mensajes insertados por el sink de escritura"
+)
+commits = metrics.counter(
+    "message_sink_commits_total",
+    "Transacciones (commits) del sink de escritura"
+)
+tamano_lote = metrics.histogram(
+    "message_sink_batch_size",
+    "Mensajes por commit del sink de escritura",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+
+class MessageSink:
+    """
+    Escritura agrupada (group commit) de mensajes: las inserciones de todas las
+    sesiones se acumulan y se guardan en una sola transacción. Mientras un
+    commit está en curso, las nuevas escrituras forman el lote siguiente, así
+    que con carga concurrente cada fsync de SQLite cubre muchos mensajes. Los
+    lotes se cortan entre grupos de escribir(): un turno (usuario + asistente)
+    se guarda entero o no se guarda.
+    """
+
+    def __init__(self, motor, shard: int = 0, max_lote: int = MESSAGE_SINK_MAX_BATCH,
+                 espera_ms: float = MESSAGE_SINK_FLUSH_MS):
+        self.motor = motor  # Engine asíncrono donde se insertan los mensajes
+        self.shard = str(shard)
+        self.max_lote = max_lote
+        self.espera = espera_ms / 1000
+        # Grupos de filas de cada llamada a escribir() con el futuro que se resuelve en su commit
+        self._pendientes: Deque[Tuple[List[dict], asyncio.Future]] = deque()
+        self._filas_pendientes = 0
+        self._sesiones_pendientes = Counter()
+        self._hay_datos: Optional[asyncio.Event] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._loop = None
+        self._en_vuelo: List[asyncio.Future] = []  # Grupos cuyo commit está en curso
+        # Se llama con cada sesión de un lote que no se pudo guardar (p. ej. para invalidar cachés)
+        self.al_fallar: Optional[Callable[[str], None]] = None
+
+    def _asegurar_iniciado(self):
+        loop = asyncio.get_running_loop()
+        if self._tarea is None or self._loop is not loop:
+            self._loop = loop
+            self._hay_datos = asyncio.Event()
+            self._tarea = loop.create_task(self._bucle())
+            if self._pendientes:
+                self._hay_datos.set()
+
+    async def escribir(self, session_id: str, mensajes: List[Tuple[str, str]], esperar: bool = True,
+                       canal: str = "web"):
+        """
+        Encola mensajes de una sesión para el siguiente commit. Todos los
+        mensajes de una llamada se guardan en la misma transacción (un grupo
+        nunca se reparte entre dos commits).
+
+        Args:
+            session_id: Identificador único de la sesión
+            mensajes: Lista de (role, content) en orden cronológico
+            esperar: Si es True no vuelve hasta que el commit se ha hecho (durable)
+            canal: Canal de la sesión ("web" o "whatsapp"), para la retención
+        """
+        self._asegurar_iniciado()
+        ahora = datetime.utcnow()
+        filas = [
+            {"session_id": session_id, "role": role, "content": content, "timestamp": ahora, "canal": canal}
+            for role, content in mensajes
+        ]
+        futuro = self._loop.create_future()
+        self._pendientes.append((filas, futuro))
+        self._filas_pendientes += len(filas)
+        self._sesiones_pendientes[session_id] += len(filas)
+        self._hay_datos.set()
+        if esperar:
+            # shield: si se cancela la petición, el grupo se guarda igualmente
+            await asyncio.shield(futuro)
+
+    def pendiente(self, session_id: str) -> bool:
+        """
+        Indica si la sesión tiene mensajes aún no guardados.
+        """
+        return self._sesiones_pendientes[session_id] > 0
+
+    async def vaciar(self):
+        """
+        Espera a que todo lo encolado hasta ahora esté guardado.
+        """
+        futuros = self._en_vuelo + [futuro for _, futuro in self._pendientes]
+        if not futuros:
+            return
+        self._asegurar_iniciado()
+        # Los errores ya se han registrado y los reciben las escrituras que esperaban
+        await asyncio.gather(*(asyncio.shield(f) for f in futuros), return_exceptions=True)
+
+    def _siguiente_lote(self) -> Tuple[List[dict], List[asyncio.Future]]:
+        """
+        Saca grupos completos hasta llenar max_lote filas; un grupo mayor que
+        max_lote va solo en su propio commit.
+        """
+        filas, futuros = [], []
+        while self._pendientes and (not futuros or len(filas) + len(self._pendientes[0][0]) <= self.max_lote):
+            grupo, futuro = self._pendientes.popleft()
+            filas.extend(grupo)
+            futuros.append(futuro)
+        self._filas_pendientes -= len(filas)
+        return filas, futuros
+
+    async def _bucle(self):
+        while True:
+            await self._hay_datos.wait()
+            # Pequeña espera para que se sumen al lote las escrituras que llegan a la vez
+            if self.espera and self._filas_pendientes < self.max_lote:
+                await asyncio.sleep(self.espera)
+
+            filas, futuros = self._siguiente_lote()
+            if not self._pendientes:
+                self._hay_datos.clear()
+            self._en_vuelo = futuros
+
+            error = None
+            try:
+                with duracion_escrituras.cronometrar(operacion="mensajes"):
+                    async with self.motor.begin() as conn:
+                        await conn.execute(insert(Mensaje), filas)
+                filas_escritas.inc(len(filas), shard=self.shard)
+                commits.inc(shard=self.shard)
+                tamano_lote.observe(len(filas))
+            except Exception as e:
+                print(f"[message_sink] Error guardando {len(filas)} mensajes: {e}")
+                error = e
+                if self.al_fallar is not None:
+                    for session_id in {fila["session_id"] for fila in filas}:
+                        self.al_fallar(session_id)
+            finally:
+                # Cada grupo se resuelve cuando termina el commit que lo contiene
+                for futuro in futuros:
+                    if error is None:
+                        futuro.set_result(None)
+                    else:
+                        futuro.set_exception(error)
+                        futuro.exception()  # Evita el aviso si ninguna escritura esperaba el resultado
+                self._en_vuelo = []
+                for fila in filas:
+                    self._sesiones_pendientes[fila["session_id"]] -= 1
+                    if self._sesiones_pendientes[fila["session_id"]] <= 0:
+                        del self._sesiones_pendientes[fila["session_id"]]
+
+    async def detener(self):
+        """
+        Guarda lo pendiente y detiene la tarea de escritura.
+        """
+        if self._tarea is None:
+            return
+        await self.vaciar()
+        self._tarea.cancel()
+        await asyncio.gather(self._tarea, return_exceptions=True)
+        self._tarea = None
+
@@ -0,0 +1,240 @@
+import math
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+
+# Clave de una serie: tupla ordenada de pares (label, valor)
+Etiquetas = Tuple[Tuple[str, str], ...]
+
+
+def _clave(labels: Dict[str, str]) -> Etiquetas:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter:
+    """
+    Contador monótono con etiquetas opcionales, seguro entre hilos.
+    """
+
+    tipo = "counter"
+
+    def __init__(self, nombre: str, descripcion: str):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self._valores: Dict[Etiquetas, float] = {}
+        self._lock = Lock()
+
+    def inc(self, cantidad: float = 1, **labels: str):
+        """
+        Incrementa el contador para la combinación de etiquetas dada.
+        """
+        clave = _clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def valor(self, **labels: str) -> float:
+        """
+        Devuelve el valor actual para una combinación de etiquetas.
+        """
+        return self._valores.get(_clave(labels), 0)
+
+    def series(self) -> Dict[Etiquetas, float]:
+        with self._lock:
+            return dict(self._valores)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                ",".join(f"{k}={v}" for k, v in clave) or "total": valor
+                for clave, valor in self._valores.items()
+            }
+
+
+class Gauge:
+    """
+    Valor instantáneo (sube y baja) con etiquetas opcionales, seguro entre hilos.
+    """
+
+    tipo = "gauge"
+
+    def __init__(self, nombre: str, descripcion: str):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self._valores: Dict[Etiquetas, float] = {}
+        self._lock = Lock()
+
+    def set(self, valor: float, **labels: str):
+        with self._lock:
+            self._valores[_clave(labels)] = valor
+
+    def inc(self, cantidad: float = 1, **labels: str):
+        clave = _clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def dec(self, cantidad: float = 1, **labels: str):
+        self.inc(-cantidad, **labels)
+
+    def valor(self, **labels: str) -> float:
+        return self._valores.get(_clave(labels), 0)
+
+    def series(self) -> Dict[Etiquetas, float]:
+        with self._lock:
+            return dict(self._valores)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                ",".join(f"{k}={v}" for k, v in clave) or "total": valor
+                for clave, valor in self._valores.items()
+            }
+
+
+# Límites (en segundos) de los buckets por defecto de los histogramas
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """
+    Distribución de observaciones (latencias) en buckets acumulados, con
+    etiquetas opcionales, seguro entre hilos.
+    """
+
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, descripcion: str, buckets: Sequence[float] = BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self.buckets = tuple(sorted(buckets))
+        # Por serie: [conteo por bucket..., conteo total, suma]
+        self._series: Dict[Etiquetas, list] = {}
+        self._lock = Lock()
+
+    def observe(self, valor: float, **labels: str):
+        """
+        Registra una observación para la combinación de etiquetas dada.
+        """
+        clave = _clave(labels)
+        with self._lock:
+            serie = self._series.setdefault(clave, [0] * len(self.buckets) + [0, 0.0])
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += 1
+            serie[-1] += valor
+
+    def series(self) -> Dict[Etiquetas, Tuple[Tuple[int, ...], int, float]]:
+        """
+        Devuelve, por serie, (conteos acumulados por bucket, conteo total, suma).
+        """
+        with self._lock:
+            return {
+                clave: (tuple(serie[:-2]), serie[-2], serie[-1])
+                for clave, serie in self._series.items()
+            }
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            ",".join(f"{k}={v}" for k, v in clave) or "total": {
+                "count": total,
+                "sum": suma,
+                "avg": suma / total if total else 0.0,
+            }
+            for clave, (_, total, suma) in self.series().items()
+        }
+
+    @contextmanager
+    def cronometrar(self, **labels: str):
+        """
+        Observa la duración en segundos del bloque (también si lanza una excepción).
+
+            with duracion.cronometrar(etapa="router"):
+                ...
+        """
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, **labels)
+
+
+_registro: Dict[str, object] = {}
+
+
+def counter(nombre: str, descripcion: str) -> Counter:
+    """
+    Devuelve el contador registrado con ese nombre (lo crea si no existe).
+    """
+    if nombre not in _registro:
+        _registro[nombre] = Counter(nombre, descripcion)
+    return _registro[nombre]
+
+
+def gauge(nombre: str, descripcion: str) -> Gauge:
+    """
+    Devuelve el gauge registrado con ese nombre (lo crea si no existe).
+    """
+    if nombre not in _registro:
+        _registro[nombre] = Gauge(nombre, descripcion)
+    return _registro[nombre]
+
+
+def histogram(nombre: str, descripcion: str, buckets: Sequence[float] = BUCKETS_SEGUNDOS) -> Histogram:
+    """
+    Devuelve el histograma registrado con ese nombre (lo crea si no existe).
+    """
+    if nombre not in _registro:
+        _registro[nombre] = Histogram(nombre, descripcion, buckets)
+    return _registro[nombre]
+
+
+def snapshot() -> Dict[str, dict]:
+    """
+    Devuelve el valor de todas las métricas registradas.
+    """
+    return {nombre: metrica.snapshot() for nombre, metrica in _registro.items()}
+
+
+# ----------------------------------------------------------------------
+# Exposición en formato de texto de Prometheus (GET /metrics)
+# ----------------------------------------------------------------------
+
+def _escapar(valor: str, comillas: bool = True) -> str:
+    valor = valor.replace("\\", "\\\\").replace("\n", "\\n")
+    return valor.replace('"', '\\"') if comillas else valor
+
+
+def _etiquetas_prometheus(clave: Etiquetas, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pares = list(clave) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def _numero(valor: float) -> str:
+    if math.isinf(valor):
+        return "+Inf" if valor > 0 else "-Inf"
+    return repr(float(valor)) if isinstance(valor, float) and not valor.is_integer() else str(int(valor))
+
+
+def exponer_prometheus() -> str:
+    """
+    Devuelve todas las métricas registradas en el formato de texto de
+    Prometheus (version 0.0.4).
+    """
+    lineas: List[str] = []
+    for nombre, metrica in sorted(_registro.items()):
+        lineas.append(f"# HELP {nombre} {_escapar(metrica.descripcion, comillas=False)}")
+        lineas.append(f"# TYPE {nombre} {metrica.tipo}")
+        if metrica.tipo == "histogram":
+            for clave, (acumulados, total, suma) in sorted(metrica.series().items()):
+                for limite, conteo in zip(metrica.buckets, acumulados):
+                    lineas.append(f"{nombre}_bucket{_etiquetas_prometheus(clave, (('le', _numero(limite)),))} {conteo}")
+                lineas.append(f"{nombre}_bucket{_etiquetas_prometheus(clave, (('le', '+Inf'),))} {total}")
+                lineas.append(f"{nombre}_sum{_etiquetas_prometheus(clave)} {_numero(suma)}")
+                lineas.append(f"{nombre}_count{_etiquetas_prometheus(clave)} {total}")
+        else:
+            for clave, valor in sorted(metrica.series().items()):
+                lineas.append(f"{nombre}{_etiquetas_prometheus(clave)} {_numero(valor)}")
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,143 @@
+from sqlalchemy import Index, inspect, text
+from models import Mensaje, normalizar_texto
+from busqueda import crear_indice_busqueda
+
+
+def _agregar_columnas_busqueda_clientes(conn):
+    """
+    Añade nombre_normalizado y email_dominio a bases de datos creadas antes de
+    que existieran, las rellena y crea sus índices.
+    """
+    columnas = {c["name"] for c in inspect(conn).get_columns("clientes")}
+    if {"nombre_normalizado", "email_dominio"} <= columnas:
+        return
+
+    print("[migrations] Añadiendo columnas de búsqueda a 'clientes'...")
+    if "nombre_normalizado" not in columnas:
+        conn.execute(text("ALTER TABLE clientes ADD COLUMN nombre_normalizado VARCHAR"))
+    if "email_dominio" not in columnas:
+        conn.execute(text("ALTER TABLE clientes ADD COLUMN email_dominio VARCHAR"))
+
+    filas = conn.execute(text("SELECT id, nombre, email FROM clientes")).all()
+    if filas:
+        conn.execute(
+            text("UPDATE clientes SET nombre_normalizado = :n, email_dominio = :d WHERE id = :id"),
+            [
+                {"id": f.id, "n": normalizar_texto(f.nombre), "d": f.email.rsplit("@", 1)[-1].strip().lower()}
+                for f in filas
+            ]
+        )
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_normalizado ON clientes (nombre_normalizado)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_clientes_dominio_nombre ON clientes (email_dominio, nombre_normalizado)"
+    ))
+
+
+def _indice_mensajes_sesion_timestamp(conn):
+    """
+    Sustituye el índice de una sola columna sobre mensajes.session_id por el
+    compuesto (session_id, timestamp), que ya sirve para filtrar por sesión.
+    """
+    indices = {i["name"] for i in inspect(conn).get_indexes("mensajes")}
+    if "ix_mensajes_session_timestamp" not in indices:
+        print("[migrations] Creando índice (session_id, timestamp) en 'mensajes'...")
+        for indice in Mensaje.__table__.indexes:
+            if indice.name == "ix_mensajes_session_timestamp":
+                indice.create(conn)
+    if "ix_mensajes_session_id" in indices:
+        Index("ix_mensajes_session_id", Mensaje.__table__.c.session_id).drop(conn)
+
+
+def _columna_canal_mensajes(conn):
+    """
+    Añade mensajes.canal (para la retención por canal). Las sesiones de
+    WhatsApp se reconocen por su session_id, que es el número de teléfono.
+    """
+    columnas = {c["name"] for c in inspect(conn).get_columns("mensajes")}
+    if "canal" in columnas:
+        return
+
+    print("[migrations] Añadiendo columna 'canal' a 'mensajes'...")
+    conn.execute(text("ALTER TABLE mensajes ADD COLUMN canal VARCHAR NOT NULL DEFAULT 'web'"))
+    sesiones = [fila[0] for fila in conn.execute(text("SELECT DISTINCT session_id FROM mensajes")).all()]
+    whatsapp = [session_id for session_id in sesiones if session_id.isdigit()]
+    for i in range(0, len(whatsapp), 500):
+        conn.execute(
+            Mensaje.__table__.update()
+            .where(Mensaje.__table__.c.session_id.in_(whatsapp[i:i + 500]))
+            .values(canal="whatsapp")
+        )
+
+
+def _columna_nombre_dudoso_estados_creacion(conn):
+    """
+    Añade estados_creacion.nombre_dudoso (confirmación de nombres extraídos
+    con marcadores débiles). Las creaciones en curso empiezan sin confirmar.
+    """
+    columnas = {c["name"] for c in inspect(conn).get_columns("estados_creacion")}
+    if "nombre_dudoso" not in columnas:
+        print("[migrations] Añadiendo columna 'nombre_dudoso' a 'estados_creacion'...")
+        conn.execute(text("ALTER TABLE estados_creacion ADD COLUMN nombre_dudoso BOOLEAN NOT NULL DEFAULT 0"))
+
+
+def _indice_mensajes_canal(conn):
+    """
+    Crea el índice (canal, session_id, timestamp) que usa la retención para
+    buscar sesiones inactivas sin recorrer la tabla mensajes en cada lote.
+    """
+    indices = {i["name"] for i in inspect(conn).get_indexes("mensajes")}
+    if "ix_mensajes_canal_session_timestamp" not in indices:
+        print("[migrations] Creando índice (canal, session_id, timestamp) en 'mensajes'...")
+        for indice in Mensaje.__table__.indexes:
+            if indice.name == "ix_mensajes_canal_session_timestamp":
+                indice.create(conn)
+
+
+# Migraciones de la tabla mensajes, que también se aplican a cada shard
+MIGRACIONES_MENSAJES = [
+    _indice_mensajes_sesion_timestamp,
+    _columna_canal_mensajes,
+    _indice_mensajes_canal,
+]
+
+# Migraciones en orden; cada una debe ser idempotente
+MIGRACIONES = [
+    _agregar_columnas_busqueda_clientes,
+    crear_indice_busqueda,
+    _columna_nombre_dudoso_estados_creacion,
+] + MIGRACIONES_MENSAJES
+
+
+def aplicar_migraciones(engine):
+    """
+    Aplica las migraciones pendientes sobre una base de datos existente.
+    Se ejecuta al arrancar, después de Base.metadata.create_all. En SQLite el
+    paso a WAL no necesita migración: lo aplica el PRAGMA de cada conexión y
+    queda guardado en el propio fichero.
+
+    Args:
+        engine: Engine síncrono de SQLAlchemy
+    """
+    with engine.begin() as conn:
+        for migracion in MIGRACIONES:
+            migracion(conn)
+
+
+def aplicar_migraciones_mensajes(engine):
+    """
+    Aplica las migraciones de la tabla mensajes a un shard.
+
+    Args:
+        engine: Engine síncrono del shard
+    """
+    with engine.begin() as conn:
+        for migracion in MIGRACIONES_MENSAJES:
+            migracion(conn)
+
+
+if __name__ == "__main__":
+    from database import engine
+    aplicar_migraciones(engine)
+    print("✅ Migraciones aplicadas")
@@ -1,6 +1,14 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Index, LargeBinary
+from sqlalchemy.orm import validates
 from datetime import datetime
 from database import Base
+import unicodedata
+
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas y sin tildes, para búsquedas y ordenación independientes de mayúsculas"""
+    texto = unicodedata.normalize("NFKD", texto.strip().lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
 
 
 class Cliente(Base):
@@ -10,6 +18,23 @@ class Cliente(Base):
     id = Column(Integer, primary_key=True, index=True)
     nombre = Column(String, nullable=False)
     email = Column(String, nullable=False, unique=True)
+    nombre_normalizado = Column(String, index=True)  # Filtros por prefijo y orden por nombre
+    email_dominio = Column(String)  # Filtro por dominio ("gmail.com")
+
+    __table_args__ = (
+        # Filtro por dominio + orden por nombre sin ordenar en memoria
+        Index("ix_clientes_dominio_nombre", "email_dominio", "nombre_normalizado"),
+    )
+
+    @validates("nombre")
+    def _normalizar_nombre(self, key, nombre):
+        self.nombre_normalizado = normalizar_texto(nombre)
+        return nombre
+
+    @validates("email")
+    def _extraer_dominio(self, key, email):
+        self.email_dominio = email.rsplit("@", 1)[-1].strip().lower()
+        return email
 
     def __repr__(self):
         return f"<Cliente nombre={self.nombre} email={self.email}>"
@@ -20,10 +45,95 @@ class Mensaje(Base):
     __tablename__ = "mensajes"
 
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True, nullable=False)  # Identificador único de sesión
+    session_id = Column(String, nullable=False)  # Identificador único de sesión
     role = Column(String, nullable=False)  # "user" o "assistant"
     content = Column(Text, nullable=False)  # Contenido del mensaje
     timestamp = Column(DateTime, default=datetime.utcnow)  # Fecha/hora
+    canal = Column(String, nullable=False, default="web", server_default="web")  # "web" o "whatsapp" (retención)
+
+    __table_args__ = (
+        # Historial de una sesión en orden sin ordenar en memoria (en SQLite el id
+        # va implícito en el índice, así que también cubre el desempate por id)
+        Index("ix_mensajes_session_timestamp", "session_id", "timestamp"),
+        # La retención recorre las sesiones de un canal por session_id con su último
+        # timestamp: el índice cubre la consulta y el recorrido por keyset
+        Index("ix_mensajes_canal_session_timestamp", "canal", "session_id", "timestamp"),
+    )
 
     def __repr__(self):
         return f"<Mensaje session={self.session_id} role={self.role}>"
+
+
+class ResumenSesion(Base):
+    """Resumen incremental de los mensajes antiguos de una sesión (los recientes se cargan literales)"""
+    __tablename__ = "resumenes_sesion"
+
+    session_id = Column(String, primary_key=True)
+    resumen = Column(Text, nullable=False)
+    hasta_id = Column(Integer, nullable=False)  # Último mensaje (id) incluido en el resumen
+    mensajes_resumidos = Column(Integer, nullable=False, default=0)
+    actualizado = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ResumenSesion session={self.session_id} hasta_id={self.hasta_id}>"
+
+
+class SesionArchivada(Base):
+    """Mensajes de una sesión inactiva sacados de la tabla mensajes (comprimidos) por la retención"""
+    __tablename__ = "sesiones_archivadas"
+
+    session_id = Column(String, primary_key=True)
+    canal = Column(String, nullable=False)
+    datos = Column(LargeBinary, nullable=False)  # zlib(orjson([[id, role, content, timestamp], ...]))
+    mensajes = Column(Integer, nullable=False)
+    resumen = Column(Text, nullable=True)  # Resumen de la sesión (ResumenSesion) al archivarla
+    resumen_hasta = Column(Integer, nullable=True)  # Mensajes (por posición) incluidos en el resumen
+    ultimo_mensaje = Column(DateTime, nullable=False)
+    archivado = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # La purga busca los archivos más antiguos
+        Index("ix_sesiones_archivadas_ultimo_mensaje", "ultimo_mensaje"),
+    )
+
+    def __repr__(self):
+        return f"<SesionArchivada session={self.session_id} canal={self.canal} mensajes={self.mensajes}>"
+
+
+class MensajeSaliente(Base):
+    """Respuestas de WhatsApp pendientes de enviar (outbox), con sus reintentos"""
+    __tablename__ = "mensajes_salientes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String, nullable=False)
+    destino = Column(String, nullable=False)  # "whatsapp:+34..."
+    cuerpo = Column(Text, nullable=False)
+    estado = Column(String, nullable=False, default="pendiente")  # "pendiente", "enviado" o "fallido"
+    intentos = Column(Integer, nullable=False, default=0)
+    proximo_intento = Column(DateTime, nullable=False, default=datetime.utcnow)  # No enviar antes de esta hora
+    ultimo_error = Column(Text, nullable=True)
+    sid_proveedor = Column(String, nullable=True)  # SID del mensaje en Twilio
+    creado = Column(DateTime, default=datetime.utcnow)
+    enviado = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # El emisor busca los pendientes cuyo próximo intento ya ha llegado
+        Index("ix_mensajes_salientes_estado_proximo", "estado", "proximo_intento"),
+    )
+
+    def __repr__(self):
+        return f"<MensajeSaliente destino={self.destino} estado={self.estado} intentos={self.intentos}>"
+
+
+class EstadoCreacion(Base):
+    """Slots del flujo de creación de clientes pendientes por sesión"""
+    __tablename__ = "estados_creacion"
+
+    session_id = Column(String, primary_key=True)  # Una creación en curso por sesión
+    nombre = Column(String, nullable=True)  # Nombre ya extraído (o None)
+    email = Column(String, nullable=True)  # Email ya extraído (o None)
+    nombre_dudoso = Column(Boolean, nullable=False, default=False)  # Nombre de un marcador débil: confirmar antes de crear
+    actualizado = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<EstadoCreacion session={self.session_id} nombre={self.nombre} email={self.email}>"
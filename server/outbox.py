@@ -0,0 +1,335 @@
+import asyncio
+import os
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from sqlalchemy import exists, select, update
+from sqlalchemy.orm import aliased
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+from database import AsyncSessionLocal, duracion_escrituras
+from models import MensajeSaliente
+from config import (
+    OUTBOX_TRANSPORT, OUTBOX_LOCAL_LATENCY_MS, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE_SECONDS, OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_RATE_PER_SECOND, OUTBOX_RATE_BURST, OUTBOX_BATCH_SIZE, OUTBOX_CONCURRENCY,
+    OUTBOX_SEND_TIMEOUT_SECONDS,
+)
+import metrics
+
+
+# Segundos entre vueltas del emisor cuando no hay mensajes nuevos (reintentos programados)
+INTERVALO_SONDEO = 1.0
+
+encolados = metrics.counter(
+    "outbox_enqueued_total",
+    "Respuestas guardadas en el outbox"
+)
+enviados = metrics.counter(
+    "outbox_sent_total",
+    "Respuestas entregadas al proveedor"
+)
+reintentos = metrics.counter(
+    "outbox_retries_total",
+    "Envíos fallidos que se reprogramarán"
+)
+fallidos = metrics.counter(
+    "outbox_failed_total",
+    "Respuestas descartadas tras agotar los reintentos"
+)
+limitados = metrics.counter(
+    "outbox_rate_limited_total",
+    "Envíos pospuestos por el límite por destinatario"
+)
+duracion_envio = metrics.histogram(
+    "outbox_send_seconds",
+    "Duración de cada envío al proveedor (Twilio) por transporte y resultado"
+)
+
+
+class TransporteTwilio:
+    """
+    Envía mensajes de WhatsApp con un único cliente de Twilio por proceso,
+    que reutiliza su sesión HTTP (conexiones keep-alive) entre envíos.
+    """
+
+    def __init__(self):
+        # El timeout HTTP libera el hilo del envío cuando vence OUTBOX_SEND_TIMEOUT_SECONDS
+        self.cliente = Client(
+            os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"),
+            http_client=TwilioHttpClient(timeout=OUTBOX_SEND_TIMEOUT_SECONDS)
+        )
+        self.origen = os.getenv("TWILIO_PHONE_NUMBER", "whatsapp:+12697484776")
+
+    def enviar(self, destino: str, cuerpo: str) -> str:
+        """
+        Envía un mensaje (bloqueante).
+
+        Returns:
+            str: SID del mensaje en Twilio
+        """
+        return self.cliente.messages.create(from_=self.origen, to=destino, body=cuerpo).sid
+
+
+class TransporteLocal:
+    """
+    Sustituto de Twilio para pruebas y benchmarks: no sale de la máquina,
+    solo guarda los mensajes enviados.
+    """
+
+    def __init__(self, latencia_ms: float = 0):
+        self.latencia_ms = latencia_ms
+        self.enviados: List[Tuple[str, str]] = []
+
+    def enviar(self, destino: str, cuerpo: str) -> str:
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms / 1000)
+        self.enviados.append((destino, cuerpo))
+        print(f"[outbox] (local) -> {destino}: {cuerpo[:80]}")
+        return f"local-{len(self.enviados)}"
+
+
+def crear_transporte():
+    """
+    Devuelve el transporte configurado en OUTBOX_TRANSPORT ("twilio" o "local").
+    """
+    if OUTBOX_TRANSPORT == "local":
+        return TransporteLocal(OUTBOX_LOCAL_LATENCY_MS)
+    return TransporteTwilio()
+
+
+class LimitadorPorDestino:
+    """
+    Token bucket por destinatario: como máximo `por_segundo` mensajes por
+    segundo a un mismo número, con ráfagas de hasta `rafaga`.
+    """
+
+    MAXIMO_DESTINOS = 10000
+
+    def __init__(self, por_segundo: float, rafaga: int):
+        self.por_segundo = por_segundo
+        self.rafaga = rafaga
+        # destino -> (tokens disponibles, instante de la última recarga)
+        self._cubos: Dict[str, Tuple[float, float]] = {}
+
+    def reservar(self, destino: str) -> float:
+        """
+        Consume un token del destinatario si lo hay.
+
+        Returns:
+            float: 0 si se puede enviar ya; si no, segundos hasta el siguiente token
+        """
+        ahora = time.monotonic()
+        tokens, ultimo = self._cubos.get(destino, (self.rafaga, ahora))
+        tokens = min(self.rafaga, tokens + (ahora - ultimo) * self.por_segundo)
+        if tokens >= 1:
+            self._cubos[destino] = (tokens - 1, ahora)
+            self._podar()
+            return 0.0
+        self._cubos[destino] = (tokens, ahora)
+        return (1 - tokens) / self.por_segundo
+
+    def _podar(self):
+        # Un cubo lleno equivale a no tenerlo: se descartan para acotar la memoria
+        if len(self._cubos) <= self.MAXIMO_DESTINOS:
+            return
+        ahora = time.monotonic()
+        for destino, (tokens, ultimo) in list(self._cubos.items()):
+            if tokens + (ahora - ultimo) * self.por_segundo >= self.rafaga:
+                del self._cubos[destino]
+
+
+def calcular_backoff(intentos: int) -> float:
+    """
+    Espera antes del siguiente intento: exponencial con tope y jitter
+    (entre la mitad y el total) para que los reintentos no lleguen a la vez.
+    """
+    espera = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (intentos - 1))
+    return espera * random.uniform(0.5, 1.0)
+
+
+class EmisorSaliente:
+    """
+    Outbox de respuestas: el pipeline guarda la respuesta en mensajes_salientes
+    (durable) y un emisor en segundo plano la entrega. Los mensajes a un mismo
+    destinatario salen en orden; los fallos se reintentan con backoff y los
+    mensajes no se pierden aunque el proveedor esté caído o el proceso se reinicie.
+    """
+
+    def __init__(self, transporte, limitador: LimitadorPorDestino):
+        self.transporte = transporte
+        self.limitador = limitador
+        self._semaforo = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._despertar = asyncio.Event()
+        self._tarea = None
+
+    async def encolar(self, session_id: str, destino: str, cuerpo: str):
+        """
+        Guarda una respuesta en el outbox y avisa al emisor.
+
+        Args:
+            session_id: Sesión a la que pertenece la respuesta
+            destino: Destinatario ("whatsapp:+34...")
+            cuerpo: Texto a enviar
+        """
+        with duracion_escrituras.cronometrar(operacion="outbox_encolar"):
+            async with AsyncSessionLocal() as db:
+                db.add(MensajeSaliente(session_id=session_id, destino=destino, cuerpo=cuerpo))
+                await db.commit()
+        encolados.inc()
+        self._despertar.set()
+
+    async def _enviar(self, mensaje: MensajeSaliente, ahora: datetime) -> bool:
+        """
+        Intenta entregar un mensaje y actualiza su estado.
+
+        Returns:
+            bool: True si se envió o se descartó; False si se reintentará
+        """
+        mensaje.intentos += 1
+        transporte = type(self.transporte).__name__
+        try:
+            async with self._semaforo:
+                inicio = time.perf_counter()
+                try:
+                    sid = await asyncio.wait_for(
+                        asyncio.to_thread(self.transporte.enviar, mensaje.destino, mensaje.cuerpo),
+                        OUTBOX_SEND_TIMEOUT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    duracion_envio.observe(time.perf_counter() - inicio, transporte=transporte, resultado="error")
+                    raise RuntimeError(f"Envío sin respuesta tras {OUTBOX_SEND_TIMEOUT_SECONDS:g} s") from None
+                except Exception:
+                    duracion_envio.observe(time.perf_counter() - inicio, transporte=transporte, resultado="error")
+                    raise
+                duracion_envio.observe(time.perf_counter() - inicio, transporte=transporte, resultado="ok")
+        except Exception as e:
+            mensaje.ultimo_error = str(e)[:500]
+            if mensaje.intentos >= OUTBOX_MAX_ATTEMPTS:
+                mensaje.estado = "fallido"
+                fallidos.inc()
+                print(f"[outbox] Descartado mensaje {mensaje.id} a {mensaje.destino} tras {mensaje.intentos} intentos: {e}")
+                return True
+            mensaje.proximo_intento = ahora + timedelta(seconds=calcular_backoff(mensaje.intentos))
+            reintentos.inc()
+            print(f"[outbox] Error enviando mensaje {mensaje.id} (intento {mensaje.intentos}): {e}")
+            return False
+
+        mensaje.estado = "enviado"
+        mensaje.sid_proveedor = sid
+        mensaje.enviado = datetime.utcnow()
+        mensaje.ultimo_error = None
+        enviados.inc()
+        return True
+
+    async def _guardar(self, mensajes: List[MensajeSaliente]):
+        """
+        Guarda el estado de los mensajes en su propia transacción. Se llama
+        tras cada envío, así que si el proceso se cae a mitad de un lote los
+        mensajes ya entregados no se vuelven a enviar al arrancar.
+        """
+        with duracion_escrituras.cronometrar(operacion="outbox_estado"):
+            async with AsyncSessionLocal() as db:
+                for mensaje in mensajes:
+                    await db.execute(
+                        update(MensajeSaliente)
+                        .where(MensajeSaliente.id == mensaje.id)
+                        .values(
+                            estado=mensaje.estado,
+                            intentos=mensaje.intentos,
+                            proximo_intento=mensaje.proximo_intento,
+                            ultimo_error=mensaje.ultimo_error,
+                            sid_proveedor=mensaje.sid_proveedor,
+                            enviado=mensaje.enviado,
+                        )
+                    )
+                await db.commit()
+
+    async def _enviar_destino(self, mensajes: List[MensajeSaliente], ahora: datetime):
+        """
+        Envía en orden los mensajes de un destinatario y guarda el resultado de
+        cada uno. Si uno se pospone (límite o error), los siguientes esperan
+        con él para no desordenarse.
+        """
+        for i, mensaje in enumerate(mensajes):
+            espera = self.limitador.reservar(mensaje.destino)
+            if espera > 0:
+                limitados.inc(len(mensajes) - i)
+                siguiente = ahora + timedelta(seconds=espera)
+            elif await self._enviar(mensaje, ahora):
+                await self._guardar([mensaje])
+                continue
+            else:
+                siguiente = mensaje.proximo_intento
+            for pendiente in mensajes[i:]:
+                pendiente.proximo_intento = max(pendiente.proximo_intento, siguiente)
+            await self._guardar(mensajes[i:])
+            return
+
+    async def procesar_lote(self) -> int:
+        """
+        Lee un lote de mensajes pendientes y los envía (destinatarios distintos en
+        paralelo), guardando el estado de cada mensaje en cuanto se conoce.
+
+        Returns:
+            int: Mensajes leídos del outbox
+        """
+        ahora = datetime.utcnow()
+        # Un mensaje anterior al mismo destinatario que aún espera su reintento bloquea a los siguientes
+        anterior = aliased(MensajeSaliente)
+        bloqueado = exists().where(
+            anterior.destino == MensajeSaliente.destino,
+            anterior.estado == "pendiente",
+            anterior.id < MensajeSaliente.id,
+            anterior.proximo_intento > ahora
+        )
+        async with AsyncSessionLocal() as db:
+            lote = (await db.execute(
+                select(MensajeSaliente)
+                .where(MensajeSaliente.estado == "pendiente", MensajeSaliente.proximo_intento <= ahora, ~bloqueado)
+                .order_by(MensajeSaliente.id)
+                .limit(OUTBOX_BATCH_SIZE)
+            )).scalars().all()
+        if not lote:
+            return 0
+
+        por_destino = defaultdict(list)
+        for mensaje in lote:
+            por_destino[mensaje.destino].append(mensaje)
+        await asyncio.gather(*(self._enviar_destino(m, ahora) for m in por_destino.values()))
+        return len(lote)
+
+    async def _bucle(self):
+        while True:
+            self._despertar.clear()
+            try:
+                leidos = await self.procesar_lote()
+            except Exception as e:
+                print(f"[outbox] Error procesando el outbox: {e}")
+                leidos = 0
+            if leidos >= OUTBOX_BATCH_SIZE:
+                continue
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=INTERVALO_SONDEO)
+            except asyncio.TimeoutError:
+                pass
+
+    def iniciar(self):
+        """
+        Arranca el emisor en el event loop actual.
+        """
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """
+        Detiene el emisor. Lo pendiente queda en el outbox para el siguiente arranque.
+        """
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+
+
+emisor = EmisorSaliente(crear_transporte(), LimitadorPorDestino(OUTBOX_RATE_PER_SECOND, OUTBOX_RATE_BURST))
@@ -0,0 +1,353 @@
+import time
+from contextlib import contextmanager, nullcontext
+from typing import AsyncIterator, Tuple
+from langchain_core.load import dumps
+from agentes import obtener_agente
+from agente_funciones import decision_desde_pasos, DECISION_POR_HERRAMIENTA
+from agente_recepcionista import arouter_con_memoria
+from callbacks import ContadorLlamadasLLM
+from config import ORCHESTRATION_MODE, CREATE_FLOW_MODE, LLM_ROUTER_TIMEOUT_SECONDS, LLM_AGENT_TIMEOUT_SECONDS
+from limitador_llm import LLMNoDisponible, etapa_llm
+from llm_cache import sin_cache, depende_de_clientes
+from single_flight import SingleFlight
+from memory_manager import PersistentMemoryManager
+from compactador import compactador
+from prompt_builder import construir_entrada_agente
+from slot_filling import procesar_creacion
+from streaming import ExtractorRespuestaFinal
+import metrics
+
+
+# Decisiones del router que tienen un agente especializado
+AGENTES_ROUTER = ("crear", "consultar")
+
+RESPUESTA_NO_ENTENDIDA = "❓ No entendí la solicitud. Por favor, reformula tu mensaje."
+
+# Respuesta cuando el LLM está saturado o no responde a tiempo
+RESPUESTA_DEGRADADA = "⏳ Ahora mismo hay mucha demanda y no puedo atenderte. Inténtalo de nuevo en unos segundos."
+
+# Ejecuciones del agente consultar en curso: la misma pregunta con el mismo
+# historial (p. ej. el primer turno tras un mensaje masivo) se resuelve una vez
+vuelos_agentes = SingleFlight("agentes")
+
+llamadas_llm = metrics.counter(
+    "llm_calls_total",
+    "Llamadas al LLM por modo de orquestación"
+)
+turnos = metrics.counter(
+    "turns_total",
+    "Turnos procesados por modo de orquestación"
+)
+segundos_turno = metrics.counter(
+    "turn_seconds_total",
+    "Tiempo acumulado de orquestación (router + agente) por modo"
+)
+duracion_etapas = metrics.histogram(
+    "stage_duration_seconds",
+    "Duración de cada etapa del turno (memoria / router / agente)"
+)
+iteraciones_agente = metrics.histogram(
+    "agent_iterations",
+    "Iteraciones ReAct (acciones) por ejecución de agente",
+    buckets=(0, 1, 2, 3, 4, 5, 7, 10, 15)
+)
+tokens_prompt = metrics.counter(
+    "llm_prompt_tokens_total",
+    "Tokens de prompt enviados al LLM por etapa, decisión y origen (api / estimado)"
+)
+tokens_respuesta = metrics.counter(
+    "llm_completion_tokens_total",
+    "Tokens generados por el LLM por etapa, decisión y origen (api / estimado)"
+)
+respuestas_degradadas = metrics.counter(
+    "degraded_responses_total",
+    "Turnos respondidos con la respuesta degradada por etapa (LLM saturado o sin tiempo)"
+)
+
+
+def _degradada(etapa: str, error: LLMNoDisponible) -> Tuple[str, str]:
+    respuestas_degradadas.inc(etapa=etapa)
+    print(f"[pipeline] Respuesta degradada en {etapa}: {error}")
+    return "degradado", RESPUESTA_DEGRADADA
+
+
+@contextmanager
+def _etapa(nombre: str, segundos: float):
+    """
+    Etapa del turno con llamadas al LLM: fija su plazo y mide su duración.
+    """
+    with etapa_llm(nombre, segundos), duracion_etapas.cronometrar(etapa=nombre):
+        yield
+
+
+async def _cerrar_turno(session_id: str, mensaje: str, respuesta: str, decision: str,
+                        contador: ContadorLlamadasLLM, inicio: float, canal: str = "web"):
+    """
+    Registra las métricas del turno, guarda el mensaje del usuario y la
+    respuesta del asistente en un solo commit y avisa al compactador.
+    """
+    for (etapa, origen), (prompt, completion) in contador.tokens.items():
+        tokens_prompt.inc(prompt, etapa=etapa, decision=decision, origen=origen)
+        tokens_respuesta.inc(completion, etapa=etapa, decision=decision, origen=origen)
+    llamadas_llm.inc(contador.llamadas, modo=ORCHESTRATION_MODE)
+    turnos.inc(modo=ORCHESTRATION_MODE)
+    segundos_turno.inc(time.perf_counter() - inicio, modo=ORCHESTRATION_MODE)
+
+    await PersistentMemoryManager.asave_turn(session_id, mensaje, respuesta, canal=canal)
+    compactador.avisar(session_id)
+
+
+async def _guardar_turno_interrumpido(session_id: str, mensaje: str, respuesta: str, canal: str = "web"):
+    """
+    Guarda el turno que no llegó a _cerrar_turno (cliente desconectado o error
+    inesperado): el mensaje del usuario siempre y la respuesta si la hay.
+    """
+    try:
+        if respuesta:
+            await PersistentMemoryManager.asave_turn(session_id, mensaje, respuesta, canal=canal)
+        else:
+            await PersistentMemoryManager.asave_message(session_id, "user", mensaje, canal=canal)
+    except Exception as e:
+        print(f"[pipeline] Error guardando el turno interrumpido de {session_id}: {e}")
+
+
+def _contexto_cache(agente: str):
+    """
+    Uso de la caché del LLM por agente: el de crear no la usa (tiene efectos),
+    y las respuestas de los que leen clientes se invalidan cuando la tabla cambia.
+    """
+    if agente == "crear":
+        return sin_cache()
+    if agente in ("consultar", "funciones"):
+        return depende_de_clientes()
+    return nullcontext()
+
+
+async def _ejecutar_agente(agente: str, mensaje: str, memory, contador: ContadorLlamadasLLM) -> dict:
+    """
+    Invoca un agente del router. Las ejecuciones del agente consultar con la
+    misma entrada que coinciden en el tiempo se agrupan; el de crear siempre
+    se ejecuta (tiene efectos).
+    """
+    entrada = construir_entrada_agente(agente, mensaje, memory.chat_memory.messages)
+
+    def invocar():
+        return obtener_agente(agente).ainvoke(entrada, config={"callbacks": [contador]})
+
+    if agente != "consultar":
+        return await invocar()
+    return await vuelos_agentes.ejecutar((agente, dumps(entrada)), invocar)
+
+
+def _usa_slots(decision: str) -> bool:
+    return decision == "crear" and CREATE_FLOW_MODE == "slots"
+
+
+async def _turno_router(session_id: str, mensaje: str, memory, contador: ContadorLlamadasLLM) -> Tuple[str, str]:
+    """
+    Modo "router": el recepcionista decide y el agente ReAct especializado ejecuta.
+    Con CREATE_FLOW_MODE=slots la creación la resuelve la máquina de slots, sin agente.
+    """
+    try:
+        with _etapa("router", LLM_ROUTER_TIMEOUT_SECONDS):
+            decision = await arouter_con_memoria(mensaje, memory, callbacks=[contador])
+    except LLMNoDisponible as e:
+        return _degradada("router", e)
+    except Exception as e:
+        return "error", f"❌ Error al procesar la solicitud: {str(e)}"
+
+    if decision not in AGENTES_ROUTER:
+        return decision, RESPUESTA_NO_ENTENDIDA
+
+    if _usa_slots(decision):
+        try:
+            with _etapa("agente", LLM_AGENT_TIMEOUT_SECONDS):
+                return decision, await procesar_creacion(session_id, mensaje, callbacks=[contador])
+        except LLMNoDisponible as e:
+            return _degradada("agente", e)
+        except Exception as e:
+            return decision, f"❌ Error en agente crear: {str(e)}"
+
+    try:
+        with _contexto_cache(decision), _etapa("agente", LLM_AGENT_TIMEOUT_SECONDS):
+            resultado = await _ejecutar_agente(decision, mensaje, memory, contador)
+        iteraciones_agente.observe(contador.iteraciones, agente=decision)
+        return decision, resultado.get("output", str(resultado))
+    except LLMNoDisponible as e:
+        return _degradada("agente", e)
+    except Exception as e:
+        return decision, f"❌ Error en agente {decision}: {str(e)}"
+
+
+async def _turno_funciones(mensaje: str, memory, contador: ContadorLlamadasLLM) -> Tuple[str, str]:
+    """
+    Modo "funciones": un único agente de function calling decide la intención
+    y llama a la herramienta en la misma ronda.
+    """
+    try:
+        with _contexto_cache("funciones"), _etapa("agente", LLM_AGENT_TIMEOUT_SECONDS):
+            resultado = await obtener_agente("funciones").ainvoke(
+                construir_entrada_agente("funciones", mensaje, memory.chat_memory.messages),
+                config={"callbacks": [contador]}
+            )
+        iteraciones_agente.observe(contador.iteraciones, agente="funciones")
+        decision = decision_desde_pasos(resultado.get("intermediate_steps", []))
+        return decision, resultado.get("output", str(resultado))
+    except LLMNoDisponible as e:
+        return _degradada("agente", e)
+    except Exception as e:
+        return "error", f"❌ Error en agente de funciones: {str(e)}"
+
+
+async def procesar_mensaje(session_id: str, mensaje: str, canal: str = "web") -> Tuple[str, str]:
+    """
+    Procesa un turno completo de conversación sin bloquear el event loop:
+    carga la memoria, decide/ejecuta según ORCHESTRATION_MODE y guarda el
+    mensaje y la respuesta.
+
+    Args:
+        session_id: Identificador único de la sesión
+        mensaje: Mensaje del usuario
+        canal: "web" o "whatsapp" (se guarda con los mensajes para la retención)
+
+    Returns:
+        Tuple[str, str]: (decision, respuesta)
+    """
+    respuesta = ""
+    cerrado = False
+    try:
+        with duracion_etapas.cronometrar(etapa="memoria"):
+            memory = await PersistentMemoryManager.aload_memory_for_agent(session_id)
+
+        contador = ContadorLlamadasLLM()
+        inicio = time.perf_counter()
+        if ORCHESTRATION_MODE == "funciones":
+            decision, respuesta = await _turno_funciones(mensaje, memory, contador)
+        else:
+            decision, respuesta = await _turno_router(session_id, mensaje, memory, contador)
+
+        cerrado = True
+        await _cerrar_turno(session_id, mensaje, respuesta, decision, contador, inicio, canal)
+        return decision, respuesta
+    finally:
+        if not cerrado:
+            await _guardar_turno_interrumpido(session_id, mensaje, respuesta, canal)
+
+
+async def _stream_agente(agente: str, mensaje: str, memory, contador: ContadorLlamadasLLM) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Ejecuta un agente con astream_events y emite los tokens de su respuesta final.
+    En modo "funciones" emite además la decisión en cuanto el agente elige herramienta.
+
+    Yields:
+        ("token", {"texto"}), ("decision", {"decision"}) y por último ("salida", {"respuesta", "pasos"})
+    """
+    extractores = {}
+    raiz = None
+    salida = None
+    with _contexto_cache(agente):
+        async for evento in obtener_agente(agente).astream_events(
+            construir_entrada_agente(agente, mensaje, memory.chat_memory.messages),
+            config={"callbacks": [contador]},
+            version="v1"
+        ):
+            raiz = raiz or evento["run_id"]
+            tipo = evento["event"]
+
+            if tipo == "on_chat_model_stream":
+                texto = evento["data"]["chunk"].content
+                if not texto:
+                    continue
+                if agente == "funciones":
+                    # El agente de funciones redacta en texto plano
+                    yield "token", {"texto": texto}
+                else:
+                    extractor = extractores.setdefault(evento["run_id"], ExtractorRespuestaFinal())
+                    texto = extractor.agregar(texto)
+                    if texto:
+                        yield "token", {"texto": texto}
+            elif tipo == "on_tool_start" and agente == "funciones" and evento["name"] in DECISION_POR_HERRAMIENTA:
+                yield "decision", {"decision": DECISION_POR_HERRAMIENTA[evento["name"]]}
+            elif tipo == "on_chain_end" and evento["run_id"] == raiz:
+                salida = evento["data"].get("output") or {}
+
+    salida = salida or {}
+    yield "salida", {
+        "respuesta": salida.get("output", str(salida)),
+        "pasos": salida.get("intermediate_steps", []),
+    }
+
+
+async def procesar_mensaje_stream(session_id: str, mensaje: str) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Variante en streaming de procesar_mensaje. Emite primero la decisión del
+    router y después los tokens de la respuesta final a medida que llegan.
+    El mensaje y la respuesta completa se guardan al terminar; si el cliente se
+    desconecta antes, se guarda el mensaje con lo que haya de respuesta.
+
+    Args:
+        session_id: Identificador único de la sesión
+        mensaje: Mensaje del usuario
+
+    Yields:
+        Tuple[evento, datos]: ("decision", {"decision"}), ("token", {"texto"})*,
+        ("fin", {"decision", "respuesta", "session_id"})
+    """
+    respuesta = ""
+    parcial = []  # Tokens ya emitidos, por si el cliente se desconecta antes del final
+    cerrado = False
+    try:
+        with duracion_etapas.cronometrar(etapa="memoria"):
+            memory = await PersistentMemoryManager.aload_memory_for_agent(session_id)
+
+        contador = ContadorLlamadasLLM()
+        inicio = time.perf_counter()
+        decision = "funciones" if ORCHESTRATION_MODE == "funciones" else None
+        emitido = False
+        etapa = "router"
+
+        try:
+            if decision is None:
+                with _etapa(etapa, LLM_ROUTER_TIMEOUT_SECONDS):
+                    decision = await arouter_con_memoria(mensaje, memory, callbacks=[contador])
+                yield "decision", {"decision": decision}
+
+            etapa = "agente"
+            if decision == "funciones" or (decision in AGENTES_ROUTER and not _usa_slots(decision)):
+                with _etapa(etapa, LLM_AGENT_TIMEOUT_SECONDS):
+                    async for evento, datos in _stream_agente(decision, mensaje, memory, contador):
+                        if evento == "token":
+                            emitido = True
+                            parcial.append(datos["texto"])
+                            yield evento, datos
+                        elif evento == "decision":
+                            yield evento, datos
+                        else:
+                            respuesta = datos["respuesta"]
+                            iteraciones_agente.observe(contador.iteraciones, agente=decision)
+                            if decision == "funciones":
+                                decision = decision_desde_pasos(datos["pasos"])
+            elif _usa_slots(decision):
+                with _etapa(etapa, LLM_AGENT_TIMEOUT_SECONDS):
+                    respuesta = await procesar_creacion(session_id, mensaje, callbacks=[contador])
+            else:
+                respuesta = RESPUESTA_NO_ENTENDIDA
+        except LLMNoDisponible as e:
+            decision, respuesta = _degradada(etapa, e)
+            emitido = False
+            yield "error", {"detalle": str(e)}
+        except Exception as e:
+            decision = "error" if decision in (None, "funciones") else decision
+            respuesta = f"❌ Error al procesar la solicitud: {str(e)}"
+            yield "error", {"detalle": str(e)}
+
+        # Respuestas que no vienen del LLM (slots, herramientas return_direct, errores)
+        if not emitido and respuesta:
+            yield "token", {"texto": respuesta}
+
+        cerrado = True
+        await _cerrar_turno(session_id, mensaje, respuesta, decision, contador, inicio)
+        yield "fin", {"decision": decision, "respuesta": respuesta, "session_id": session_id}
+    finally:
+        if not cerrado:
+            await _guardar_turno_interrumpido(session_id, mensaje, respuesta or "".join(parcial))
@@ -0,0 +1,65 @@
+from typing import Dict, List
+from langchain_core.messages import BaseMessage
+from config import PROMPT_HISTORY_MAX_TOKENS
+from tokens import contar_tokens
+import metrics
+
+
+tokens_historial = metrics.counter(
+    "prompt_history_tokens_total",
+    "Tokens de historial enviados en los prompts"
+)
+tokens_ahorrados = metrics.counter(
+    "prompt_tokens_saved_total",
+    "Tokens que ya no se envían (historial duplicado en el input + recorte por presupuesto)"
+)
+
+
+def recortar_historial(historial: List[BaseMessage], max_tokens: int = PROMPT_HISTORY_MAX_TOKENS) -> List[BaseMessage]:
+    """
+    Devuelve los mensajes más recientes del historial que caben en el presupuesto.
+    El resumen de la sesión (mensaje de sistema inicial) se conserva siempre y
+    cuenta dentro del presupuesto.
+
+    Args:
+        historial: Mensajes de la conversación en orden cronológico
+        max_tokens: Presupuesto máximo de tokens
+
+    Returns:
+        Sufijo del historial dentro del presupuesto (precedido del resumen, si lo hay)
+    """
+    if historial and historial[0].type == "system":
+        return historial[:1] + recortar_historial(historial[1:], max_tokens - contar_tokens(historial[0].content))
+    total = 0
+    inicio = len(historial)
+    for i in range(len(historial) - 1, -1, -1):
+        total += contar_tokens(historial[i].content)
+        if total > max_tokens:
+            break
+        inicio = i
+    return historial[inicio:]
+
+
+def construir_entrada_agente(agente: str, mensaje: str, historial: List[BaseMessage]) -> Dict:
+    """
+    Construye las variables de entrada de un agente. El historial se incluye
+    UNA sola vez (variable "chat_history" del prompt) y recortado al presupuesto;
+    el input es únicamente el mensaje actual.
+
+    Args:
+        agente: Nombre del agente ("crear", "consultar"), para las métricas
+        mensaje: Mensaje actual del usuario
+        historial: Mensajes anteriores de la sesión (sin el mensaje actual)
+
+    Returns:
+        dict: {"input": ..., "chat_history": ...}
+    """
+    recortado = recortar_historial(historial)
+
+    enviados = sum(contar_tokens(m.content) for m in recortado)
+    completos = sum(contar_tokens(m.content) for m in historial)
+    # Antes el historial completo se enviaba dos veces: en el input y en la memoria
+    tokens_ahorrados.inc(2 * completos - enviados, agente=agente)
+    tokens_historial.inc(enviados, agente=agente)
+
+    return {"input": mensaje, "chat_history": recortado}
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, Tuple
+from single_flight import SingleFlightHilos
+import metrics
+
+
+aciertos = metrics.counter(
+    "result_cache_hits_total",
+    "Consultas de clientes servidas desde la caché de resultados"
+)
+fallos = metrics.counter(
+    "result_cache_misses_total",
+    "Consultas de clientes que tuvieron que ir a la base de datos"
+)
+
+
+class ResultCache:
+    """
+    Caché LRU acotada de resultados ya formateados, compartida por todas las
+    sesiones del proceso. Cada entrada se guarda con la versión de la tabla
+    del momento en que se leyó; al escribir en la tabla se incrementa la
+    versión y las entradas anteriores dejan de servirse.
+
+    Los fallos idénticos y simultáneos (p. ej. muchas sesiones que piden la
+    misma lista a la vez) hacen una sola lectura de la base de datos.
+    """
+
+    def __init__(self, max_entradas: int):
+        """
+        Args:
+            max_entradas: Número máximo de resultados en caché (0 la desactiva)
+        """
+        self.max_entradas = max_entradas
+        self.version = 0
+        self._entradas: "OrderedDict[Hashable, Tuple[int, str]]" = OrderedDict()
+        self._lock = Lock()
+        self._vuelos = SingleFlightHilos("herramientas")
+
+    def obtener(self, nombre: str, clave: Hashable, calcular: Callable[[], str]) -> str:
+        """
+        Devuelve el resultado en caché para la versión actual o lo calcula y lo guarda.
+
+        Args:
+            nombre: Consulta (etiqueta de las métricas)
+            clave: Argumentos de la consulta (hashable)
+            calcular: Función que lee de la base de datos y formatea el resultado
+
+        Returns:
+            Resultado formateado
+        """
+        clave = (nombre, clave)
+        if self.max_entradas <= 0:
+            return self._vuelos.ejecutar((clave, self.version), calcular)
+        with self._lock:
+            # La versión se toma antes de leer: si hay una escritura mientras
+            # tanto, el resultado se guarda con la versión vieja y no se sirve
+            version = self.version
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[0] == version:
+                self._entradas.move_to_end(clave)
+                aciertos.inc(consulta=nombre)
+                return entrada[1]
+
+        fallos.inc(consulta=nombre)
+        resultado = self._vuelos.ejecutar((clave, version), calcular)
+        with self._lock:
+            actual = self._entradas.get(clave)
+            if actual is None or actual[0] <= version:
+                self._entradas[clave] = (version, resultado)
+                self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+        return resultado
+
+    def invalidar(self):
+        """
+        Incrementa la versión de la tabla tras una escritura y descarta los resultados guardados.
+        """
+        with self._lock:
+            self.version += 1
+            self._entradas.clear()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
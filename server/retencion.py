@@ -0,0 +1,464 @@
+import argparse
+import asyncio
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import orjson
+from sqlalchemy import delete, func, insert, select, update
+from models import Mensaje, ResumenSesion, SesionArchivada
+from config import (
+    RETENTION, RETENTION_TTL_DAYS, RETENTION_PURGE_DAYS, RETENTION_INTERVAL_SECONDS, RETENTION_BATCH_SESSIONS,
+    HISTORY_ARCHIVE_CACHE_SIZE,
+)
+from shards import SHARDS, Shard, obtener_shard
+from single_flight import SingleFlight
+import metrics
+
+
+sesiones_archivadas = metrics.counter(
+    "retention_archived_sessions_total",
+    "Sesiones inactivas movidas de mensajes al archivo comprimido por canal"
+)
+mensajes_archivados = metrics.counter(
+    "retention_archived_messages_total",
+    "Mensajes movidos de mensajes al archivo comprimido por canal"
+)
+sesiones_restauradas = metrics.counter(
+    "retention_restored_sessions_total",
+    "Sesiones archivadas que volvieron a la tabla mensajes al usarse de nuevo"
+)
+sesiones_purgadas = metrics.counter(
+    "retention_purged_sessions_total",
+    "Sesiones archivadas borradas definitivamente"
+)
+duracion_retencion = metrics.histogram(
+    "retention_run_seconds",
+    "Duración de cada pasada de retención (archivado y purga de todos los shards)"
+)
+
+# Restauraciones en curso: las peticiones simultáneas de una sesión archivada la restauran una vez
+vuelos_restauracion = SingleFlight("restauraciones")
+
+
+def _comprimir(mensajes: list) -> bytes:
+    return zlib.compress(orjson.dumps(mensajes))
+
+
+def _descomprimir(datos: bytes) -> list:
+    return orjson.loads(zlib.decompress(datos))
+
+
+def _filas(mensajes: list) -> List[tuple]:
+    """
+    Filas (id, role, content, timestamp) de un archivo descomprimido. Cada
+    mensaje es [id, role, content, timestamp]; los archivados antes de guardar
+    el id ([role, content, timestamp]) se numeran -n..-1 para que queden
+    antes que cualquier id real.
+    """
+    n = len(mensajes)
+    return [
+        (m[0], m[1], m[2], datetime.fromisoformat(m[3])) if len(m) == 4
+        else (i - n, m[0], m[1], datetime.fromisoformat(m[2]))
+        for i, m in enumerate(mensajes)
+    ]
+
+
+# Archivos descomprimidos recientes, por sesión, con la fecha de archivado como
+# versión: las páginas sucesivas de GET /history no vuelven a descomprimirlo
+_leidos: "OrderedDict[str, Tuple[datetime, List[tuple]]]" = OrderedDict()
+_leidos_lock = Lock()
+
+
+# ----------------------------------------------------------------------
+# Operaciones sobre una conexión síncrona (también se usan desde el motor
+# asíncrono con run_sync); cada llamada va dentro de una transacción
+# ----------------------------------------------------------------------
+
+def _archivar_sesion(conn, session_id: str) -> int:
+    """
+    Mueve los mensajes de una sesión (y su resumen) a sesiones_archivadas.
+    Si la sesión ya tenía archivo, los mensajes se añaden a él. Solo se borran
+    los mensajes leídos: lo que se escriba mientras tanto sigue en mensajes.
+
+    Returns:
+        int: Mensajes archivados
+    """
+    filas = conn.execute(
+        select(Mensaje.id, Mensaje.role, Mensaje.content, Mensaje.timestamp, Mensaje.canal)
+        .where(Mensaje.session_id == session_id)
+        .order_by(Mensaje.timestamp, Mensaje.id)
+    ).all()
+    if not filas:
+        return 0
+    resumen = conn.execute(
+        select(ResumenSesion.resumen, ResumenSesion.hasta_id).where(ResumenSesion.session_id == session_id)
+    ).first()
+    previo = conn.execute(
+        select(SesionArchivada).where(SesionArchivada.session_id == session_id)
+    ).first()
+
+    mensajes = _descomprimir(previo.datos) if previo else []
+    texto_resumen = previo.resumen if previo else None
+    resumen_hasta = previo.resumen_hasta if previo else None
+    if resumen is not None:
+        texto_resumen = resumen.resumen
+        resumen_hasta = len(mensajes) + sum(1 for fila in filas if fila.id <= resumen.hasta_id)
+    # Con el id original el cursor del historial sigue valiendo tras restaurar o volver a archivar
+    mensajes += [[fila.id, fila.role, fila.content, fila.timestamp] for fila in filas]
+
+    valores = {
+        "canal": filas[-1].canal,
+        "datos": _comprimir(mensajes),
+        "mensajes": len(mensajes),
+        "resumen": texto_resumen,
+        "resumen_hasta": resumen_hasta,
+        "ultimo_mensaje": max(fila.timestamp for fila in filas),
+        "archivado": datetime.utcnow(),
+    }
+    if previo:
+        conn.execute(update(SesionArchivada).where(SesionArchivada.session_id == session_id).values(**valores))
+    else:
+        conn.execute(insert(SesionArchivada).values(session_id=session_id, **valores))
+    conn.execute(delete(Mensaje).where(
+        Mensaje.session_id == session_id, Mensaje.id <= max(fila.id for fila in filas)
+    ))
+    conn.execute(delete(ResumenSesion).where(ResumenSesion.session_id == session_id))
+    return len(filas)
+
+
+def _archivar_lote(conn, canal: str, corte: datetime, limite: int, desde: str = "") -> List[tuple]:
+    """
+    Archiva hasta `limite` sesiones del canal sin mensajes posteriores a `corte`,
+    recorriéndolas por session_id a partir de `desde` (keyset): con el índice
+    (canal, session_id, timestamp) cada lote sigue donde acabó el anterior en
+    vez de volver a recorrer la tabla desde el principio.
+
+    Returns:
+        Lista de (session_id, mensajes archivados) en orden de session_id
+    """
+    inactivas = conn.execute(
+        select(Mensaje.session_id)
+        .where(Mensaje.canal == canal, Mensaje.session_id > desde)
+        .group_by(Mensaje.session_id)
+        .having(func.max(Mensaje.timestamp) < corte)
+        .order_by(Mensaje.session_id)
+        .limit(limite)
+    ).scalars().all()
+    return [(session_id, _archivar_sesion(conn, session_id)) for session_id in inactivas]
+
+
+def _restaurar(conn, session_id: str) -> int:
+    """
+    Devuelve a la tabla mensajes los mensajes archivados de una sesión (con
+    su resumen, si no se ha hecho otro desde entonces) y borra el archivo.
+
+    Returns:
+        int: Mensajes restaurados (0 si la sesión no estaba archivada)
+    """
+    archivo = conn.execute(
+        select(SesionArchivada).where(SesionArchivada.session_id == session_id)
+    ).first()
+    if archivo is None:
+        return 0
+    # Otro proceso puede estar restaurándola a la vez: solo sigue quien borra el archivo
+    if conn.execute(delete(SesionArchivada).where(SesionArchivada.session_id == session_id)).rowcount == 0:
+        return 0
+
+    filas = _filas(_descomprimir(archivo.datos))
+    # Se conserva el id original salvo que otra fila lo haya reutilizado entretanto
+    # (SQLite reutiliza los ids más altos borrados) o el mensaje no lo guardara
+    originales = [fila[0] for fila in filas if fila[0] > 0]
+    ocupados = set()
+    for i in range(0, len(originales), 500):
+        ocupados.update(conn.execute(
+            select(Mensaje.id).where(Mensaje.id.in_(originales[i:i + 500]))
+        ).scalars())
+    con_id, sin_id = [], []
+    for id, role, content, timestamp in filas:
+        valores = {"session_id": session_id, "canal": archivo.canal, "role": role,
+                   "content": content, "timestamp": timestamp}
+        if id > 0 and id not in ocupados:
+            con_id.append({"id": id, **valores})
+        else:
+            sin_id.append(valores)
+    if con_id:
+        conn.execute(insert(Mensaje), con_id)
+    if sin_id:
+        conn.execute(insert(Mensaje), sin_id)
+
+    hay_resumen = conn.execute(
+        select(ResumenSesion.session_id).where(ResumenSesion.session_id == session_id)
+    ).first() is not None
+    if archivo.resumen and archivo.resumen_hasta and not hay_resumen:
+        # Algún id puede haber cambiado al reinsertar: el resumen apunta al mensaje en la misma posición
+        hasta_id = conn.execute(
+            select(Mensaje.id)
+            .where(Mensaje.session_id == session_id)
+            .order_by(Mensaje.timestamp, Mensaje.id)
+            .offset(archivo.resumen_hasta - 1)
+            .limit(1)
+        ).scalar()
+        conn.execute(insert(ResumenSesion).values(
+            session_id=session_id,
+            resumen=archivo.resumen,
+            hasta_id=hasta_id,
+            mensajes_resumidos=archivo.resumen_hasta,
+        ))
+    return len(filas)
+
+
+def _leer_archivo(conn, session_id: str, desde: Optional[datetime] = None) -> List[tuple]:
+    """
+    Mensajes archivados de una sesión, sin restaurarla. Si todos son
+    anteriores a `desde` el archivo ni se descomprime.
+
+    Returns:
+        Lista de (id, role, content, timestamp) en orden cronológico (vacía si
+        no está archivada o no hay mensajes desde `desde`)
+    """
+    archivo = conn.execute(
+        select(SesionArchivada.archivado, SesionArchivada.ultimo_mensaje)
+        .where(SesionArchivada.session_id == session_id)
+    ).first()
+    if archivo is None:
+        with _leidos_lock:
+            _leidos.pop(session_id, None)
+        return []
+    if desde is not None and archivo.ultimo_mensaje < desde:
+        return []
+    with _leidos_lock:
+        leido = _leidos.get(session_id)
+        if leido is not None and leido[0] == archivo.archivado:
+            _leidos.move_to_end(session_id)
+            return leido[1]
+
+    datos = conn.execute(
+        select(SesionArchivada.datos).where(SesionArchivada.session_id == session_id)
+    ).scalar()
+    if datos is None:
+        return []
+    filas = _filas(_descomprimir(datos))
+    if HISTORY_ARCHIVE_CACHE_SIZE > 0:
+        with _leidos_lock:
+            _leidos[session_id] = (archivo.archivado, filas)
+            _leidos.move_to_end(session_id)
+            while len(_leidos) > HISTORY_ARCHIVE_CACHE_SIZE:
+                _leidos.popitem(last=False)
+    return filas
+
+
+def _purgar_lote(conn, corte: datetime, limite: int) -> int:
+    """
+    Borra hasta `limite` sesiones archivadas cuyo último mensaje es anterior a `corte`.
+
+    Returns:
+        int: Sesiones borradas
+    """
+    ids = conn.execute(
+        select(SesionArchivada.session_id)
+        .where(SesionArchivada.ultimo_mensaje < corte)
+        .limit(limite)
+    ).scalars().all()
+    if ids:
+        conn.execute(delete(SesionArchivada).where(SesionArchivada.session_id.in_(ids)))
+    return len(ids)
+
+
+# ----------------------------------------------------------------------
+# API asíncrona
+# ----------------------------------------------------------------------
+
+async def restaurar_sesion(session_id: str) -> int:
+    """
+    Restaura la sesión si está archivada. Se llama antes de cargar la memoria
+    de una sesión (un turno nuevo), así que el archivado es transparente: una
+    sesión archivada que vuelve a usarse recupera todos sus mensajes. Leer el
+    historial no la restaura (ver leer_sesion_archivada).
+
+    Args:
+        session_id: Identificador único de la sesión
+
+    Returns:
+        int: Mensajes restaurados (0 si no estaba archivada)
+    """
+    shard = obtener_shard(session_id)
+
+    async def restaurar():
+        async with shard.async_engine.begin() as conn:
+            restaurados = await conn.run_sync(_restaurar, session_id)
+        if restaurados:
+            sesiones_restauradas.inc()
+            print(f"[retencion] Sesión {session_id} restaurada ({restaurados} mensajes)")
+        return restaurados
+
+    return await vuelos_restauracion.ejecutar(session_id, restaurar)
+
+
+def restaurar_sesion_sync(session_id: str) -> int:
+    """
+    Versión síncrona de restaurar_sesion.
+    """
+    with obtener_shard(session_id).engine.begin() as conn:
+        restaurados = _restaurar(conn, session_id)
+    if restaurados:
+        sesiones_restauradas.inc()
+    return restaurados
+
+
+async def leer_sesion_archivada(session_id: str, desde: Optional[datetime] = None) -> List[tuple]:
+    """
+    Lee los mensajes archivados de una sesión descomprimiendo su archivo, sin
+    devolverlos a la tabla mensajes: consultar el historial de una sesión
+    antigua no la reactiva. Los últimos HISTORY_ARCHIVE_CACHE_SIZE archivos
+    leídos se guardan descomprimidos en memoria.
+
+    Args:
+        session_id: Identificador único de la sesión
+        desde: Si todos los mensajes archivados son anteriores, no se lee el archivo
+
+    Returns:
+        Lista de (id, role, content, timestamp) en orden cronológico (vacía si no está archivada)
+    """
+    async with obtener_shard(session_id).async_engine.connect() as conn:
+        return await conn.run_sync(_leer_archivo, session_id, desde)
+
+
+def leer_sesion_archivada_sync(session_id: str, desde: Optional[datetime] = None) -> List[tuple]:
+    """
+    Versión síncrona de leer_sesion_archivada.
+    """
+    with obtener_shard(session_id).engine.connect() as conn:
+        return _leer_archivo(conn, session_id, desde)
+
+
+async def archivar_inactivas(shard: Shard, ahora: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Archiva las sesiones del shard que llevan más días sin actividad que el
+    TTL de su canal, en transacciones de RETENTION_BATCH_SESSIONS sesiones.
+
+    Returns:
+        dict: Sesiones archivadas por canal
+    """
+    ahora = ahora or datetime.utcnow()
+    archivadas: Dict[str, int] = {}
+    for canal, dias in RETENTION_TTL_DAYS.items():
+        corte = ahora - timedelta(days=dias)
+        archivadas[canal] = 0
+        desde = ""
+        while True:
+            async with shard.async_engine.begin() as conn:
+                lote = await conn.run_sync(_archivar_lote, canal, corte, RETENTION_BATCH_SESSIONS, desde)
+            if lote:
+                desde = lote[-1][0]
+            for session_id, mensajes in lote:
+                sesiones_archivadas.inc(canal=canal)
+                mensajes_archivados.inc(mensajes, canal=canal)
+            archivadas[canal] += len(lote)
+            if len(lote) < RETENTION_BATCH_SESSIONS:
+                break
+            await asyncio.sleep(0)  # Deja pasar a las peticiones entre lotes
+    return archivadas
+
+
+async def purgar_archivadas(shard: Shard, ahora: Optional[datetime] = None) -> int:
+    """
+    Borra definitivamente las sesiones archivadas más antiguas que RETENTION_PURGE_DAYS.
+
+    Returns:
+        int: Sesiones borradas
+    """
+    if RETENTION_PURGE_DAYS <= 0:
+        return 0
+    corte = (ahora or datetime.utcnow()) - timedelta(days=RETENTION_PURGE_DAYS)
+    purgadas = 0
+    while True:
+        async with shard.async_engine.begin() as conn:
+            borradas = await conn.run_sync(_purgar_lote, corte, RETENTION_BATCH_SESSIONS)
+        purgadas += borradas
+        sesiones_purgadas.inc(borradas)
+        if borradas < RETENTION_BATCH_SESSIONS:
+            return purgadas
+        await asyncio.sleep(0)
+
+
+class GestorRetencion:
+    """
+    Tarea en segundo plano que cada RETENTION_INTERVAL_SECONDS archiva las
+    sesiones inactivas de todos los shards y purga los archivos caducados.
+    Así la tabla mensajes (y su índice por sesión) solo contiene las
+    sesiones vivas y cabe en la caché de páginas.
+    """
+
+    def __init__(self):
+        self._tarea: Optional[asyncio.Task] = None
+
+    async def ejecutar_una_vez(self) -> dict:
+        """
+        Hace una pasada completa de archivado y purga.
+
+        Returns:
+            dict: Sesiones archivadas por canal y sesiones purgadas
+        """
+        archivadas: Dict[str, int] = {}
+        purgadas = 0
+        with duracion_retencion.cronometrar():
+            for shard in SHARDS:
+                for canal, sesiones in (await archivar_inactivas(shard)).items():
+                    archivadas[canal] = archivadas.get(canal, 0) + sesiones
+                purgadas += await purgar_archivadas(shard)
+        if any(archivadas.values()) or purgadas:
+            print(f"[retencion] Archivadas {archivadas}, purgadas {purgadas}")
+        return {"archivadas": archivadas, "purgadas": purgadas}
+
+    async def _bucle(self):
+        while True:
+            try:
+                await self.ejecutar_una_vez()
+            except Exception as e:
+                print(f"[retencion] Error en la pasada de retención: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+    def iniciar(self):
+        """
+        Arranca la retención en el event loop actual.
+        """
+        if RETENTION and self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """
+        Detiene la retención. Una pasada interrumpida deja cada lote completo o sin aplicar.
+        """
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+
+
+gestor_retencion = GestorRetencion()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retención de mensajes: archivado de sesiones inactivas y purga")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("ejecutar", help="Hace una pasada de archivado y purga")
+    res = sub.add_parser("restaurar", help="Devuelve una sesión archivada a la tabla mensajes")
+    res.add_argument("session_id")
+    args = parser.parse_args()
+
+    from shards import inicializar_shards, detener_shards
+    inicializar_shards()
+
+    async def main():
+        try:
+            if args.comando == "ejecutar":
+                resultado = await gestor_retencion.ejecutar_una_vez()
+                print(f"✅ Archivadas {resultado['archivadas']}, purgadas {resultado['purgadas']}")
+            else:
+                print(f"✅ Restaurados {await restaurar_sesion(args.session_id)} mensajes")
+        finally:
+            await detener_shards()
+
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, List, Optional, Tuple
+
+# Un mensaje en caché: (role, content)
+MensajeCache = Tuple[str, str]
+
+
+class SessionCache:
+    """
+    Caché LRU acotada con la ventana de historial de las sesiones "calientes".
+    Se actualiza en el sitio al guardar mensajes, de modo que los turnos de una
+    sesión ya cargada no vuelven a leer de la base de datos.
+    """
+
+    def __init__(self, max_sesiones: int, recortar: Callable[[List[MensajeCache]], List[MensajeCache]]):
+        """
+        Args:
+            max_sesiones: Número máximo de sesiones que se mantienen en caché
+            recortar: Función que aplica la ventana/presupuesto a una lista de mensajes
+        """
+        self.max_sesiones = max_sesiones
+        self._recortar = recortar
+        self._sesiones: "OrderedDict[str, List[MensajeCache]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, session_id: str) -> Optional[List[MensajeCache]]:
+        """
+        Devuelve una copia de la ventana de la sesión o None si no está en caché.
+        """
+        with self._lock:
+            mensajes = self._sesiones.get(session_id)
+            if mensajes is None:
+                return None
+            self._sesiones.move_to_end(session_id)
+            return list(mensajes)
+
+    def put(self, session_id: str, mensajes: List[MensajeCache]):
+        """
+        Guarda la ventana de una sesión, expulsando la menos usada si hace falta.
+        """
+        if self.max_sesiones <= 0:
+            return
+        with self._lock:
+            self._sesiones[session_id] = self._recortar(list(mensajes))
+            self._sesiones.move_to_end(session_id)
+            while len(self._sesiones) > self.max_sesiones:
+                self._sesiones.popitem(last=False)
+
+    def append(self, session_id: str, role: str, content: str):
+        """
+        Añade un mensaje a la ventana de la sesión si ya está en caché.
+        Las sesiones que no están en caché se cargarán desde BD en su próximo turno.
+        """
+        with self._lock:
+            mensajes = self._sesiones.get(session_id)
+            if mensajes is None:
+                return
+            mensajes.append((role, content))
+            self._sesiones[session_id] = self._recortar(mensajes)
+
+    def invalidate(self, session_id: str):
+        """
+        Elimina la sesión de la caché.
+        """
+        with self._lock:
+            self._sesiones.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._sesiones)
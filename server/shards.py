@@ -0,0 +1,202 @@
+import argparse
+import zlib
+from typing import List
+from sqlalchemy import delete, distinct, func, insert, inspect, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+import database
+from database import Base, crear_engine, crear_async_engine, url_asincrona
+from models import Mensaje, ResumenSesion, SesionArchivada
+from message_sink import MessageSink
+from migrations import aplicar_migraciones_mensajes
+from config import MESSAGE_SHARDS, MESSAGE_SHARD_URL, DATABASE_URL
+
+
+class Shard:
+    """
+    Una de las bases de datos donde se guardan los mensajes de conversación:
+    sus engines, fábricas de sesiones y su sink de escritura agrupada.
+    """
+
+    def __init__(self, indice: int, url: str, engine=None, async_engine=None):
+        self.indice = indice
+        self.url = url
+        self.engine = engine or crear_engine(url)
+        self.async_engine = async_engine or crear_async_engine(url_asincrona(url))
+        self.SessionLocal = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
+        self.AsyncSessionLocal = async_sessionmaker(
+            bind=self.async_engine, autoflush=False, expire_on_commit=False
+        )
+        self.sink = MessageSink(self.async_engine, shard=indice)
+
+    def __repr__(self):
+        return f"<Shard {self.indice} url={self.url}>"
+
+
+def urls_shards(numero: int = MESSAGE_SHARDS, plantilla: str = MESSAGE_SHARD_URL) -> List[str]:
+    """
+    URLs de los shards configurados. Con un solo shard es DATABASE_URL.
+    """
+    if numero <= 1:
+        return [DATABASE_URL]
+    return [plantilla.format(shard=i) for i in range(numero)]
+
+
+def _crear_shards() -> List[Shard]:
+    urls = urls_shards()
+    if len(urls) == 1:
+        # Sin reparto: los mensajes siguen en la base de datos principal
+        return [Shard(0, urls[0], database.engine, database.async_engine)]
+    return [Shard(i, url) for i, url in enumerate(urls)]
+
+
+SHARDS = _crear_shards()
+
+
+def indice_shard(session_id: str, numero: int = None) -> int:
+    """
+    Shard de una sesión: hash estable (CRC32, igual en todos los procesos) módulo N.
+    """
+    numero = numero or len(SHARDS)
+    return zlib.crc32(session_id.encode("utf-8")) % numero
+
+
+def obtener_shard(session_id: str) -> Shard:
+    """
+    Devuelve el shard donde se guardan los mensajes de la sesión.
+    """
+    return SHARDS[indice_shard(session_id)]
+
+
+def inicializar_shards():
+    """
+    Crea las tablas mensajes (con sus índices), resumenes_sesion y
+    sesiones_archivadas en los shards que aún no las tengan y aplica las
+    migraciones de mensajes.
+    """
+    for shard in SHARDS:
+        Base.metadata.create_all(
+            bind=shard.engine,
+            tables=[Mensaje.__table__, ResumenSesion.__table__, SesionArchivada.__table__]
+        )
+        aplicar_migraciones_mensajes(shard.engine)
+
+
+async def detener_shards():
+    """
+    Guarda lo pendiente en los sinks y cierra los pools de todos los shards.
+    """
+    for shard in SHARDS:
+        await shard.sink.detener()
+        await shard.async_engine.dispose()
+
+
+# ----------------------------------------------------------------------
+# Rebalanceo: mueve cada sesión al shard que le corresponde
+# ----------------------------------------------------------------------
+
+def _mover_sesion(origen_engine, destino: Shard, session_id: str) -> int:
+    """
+    Copia los mensajes de una sesión al shard destino y los borra del origen
+    (junto con su resumen).
+    Es idempotente: si se interrumpe y se repite, no duplica los mensajes ya copiados.
+
+    Returns:
+        int: Mensajes copiados
+    """
+    columnas = (Mensaje.session_id, Mensaje.role, Mensaje.content, Mensaje.timestamp, Mensaje.canal)
+    with origen_engine.connect() as origen:
+        filas = origen.execute(
+            select(*columnas).where(Mensaje.session_id == session_id).order_by(Mensaje.timestamp, Mensaje.id)
+        ).all()
+    with destino.engine.begin() as conn:
+        existentes = set(conn.execute(select(*columnas).where(Mensaje.session_id == session_id)).all())
+        nuevas = [fila._asdict() for fila in filas if tuple(fila) not in existentes]
+        if nuevas:
+            conn.execute(insert(Mensaje), nuevas)
+    with origen_engine.begin() as origen:
+        origen.execute(delete(Mensaje).where(Mensaje.session_id == session_id))
+        # Los ids cambian al copiar: el compactador rehará el resumen en el destino
+        if inspect(origen).has_table(ResumenSesion.__tablename__):
+            origen.execute(delete(ResumenSesion).where(ResumenSesion.session_id == session_id))
+    return len(nuevas)
+
+
+def _mover_archivo(origen_engine, destino: Shard, session_id: str):
+    """
+    Mueve la sesión archivada (sesiones_archivadas) al shard destino.
+    """
+    with origen_engine.connect() as origen:
+        fila = origen.execute(
+            select(SesionArchivada.__table__).where(SesionArchivada.session_id == session_id)
+        ).first()
+    if fila is None:
+        return
+    with destino.engine.begin() as conn:
+        conn.execute(delete(SesionArchivada).where(SesionArchivada.session_id == session_id))
+        conn.execute(insert(SesionArchivada), [fila._asdict()])
+    with origen_engine.begin() as origen:
+        origen.execute(delete(SesionArchivada).where(SesionArchivada.session_id == session_id))
+
+
+def rebalancear(urls_extra: List[str] = ()) -> dict:
+    """
+    Recorre los shards actuales (y las bases de datos adicionales indicadas,
+    p. ej. la base única anterior o los shards que sobran al reducir N) y
+    mueve cada sesión que no esté en su shard, también las archivadas.
+
+    Args:
+        urls_extra: URLs de bases de datos de origen que no son shards actuales
+
+    Returns:
+        dict: Sesiones y mensajes movidos
+    """
+    inicializar_shards()
+    actuales = {shard.url: shard.engine for shard in SHARDS}
+    origenes = list(actuales.items()) + [(url, crear_engine(url)) for url in urls_extra if url not in actuales]
+    for _, origen_engine in origenes[len(actuales):]:
+        aplicar_migraciones_mensajes(origen_engine)  # Bases antiguas sin mensajes.canal
+
+    sesiones = mensajes = 0
+    for url, origen_engine in origenes:
+        with origen_engine.connect() as conn:
+            ids = [fila[0] for fila in conn.execute(select(distinct(Mensaje.session_id))).all()]
+        for session_id in ids:
+            destino = obtener_shard(session_id)
+            if destino.url == url:
+                continue
+            mensajes += _mover_sesion(origen_engine, destino, session_id)
+            sesiones += 1
+        if not inspect(origen_engine).has_table(SesionArchivada.__tablename__):
+            continue
+        with origen_engine.connect() as conn:
+            archivadas = conn.execute(select(SesionArchivada.session_id)).scalars().all()
+        for session_id in archivadas:
+            destino = obtener_shard(session_id)
+            if destino.url != url:
+                _mover_archivo(origen_engine, destino, session_id)
+                sesiones += 1
+        print(f"[shards] {url}: revisadas {len(ids)} sesiones")
+    return {"sesiones": sesiones, "mensajes": mensajes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Herramientas de shards de mensajes")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    reb = sub.add_parser("rebalancear", help="Mueve cada sesión a su shard según MESSAGE_SHARDS")
+    reb.add_argument(
+        "--desde", action="append", default=[],
+        help="URL de una base de datos de origen adicional (repetible), p. ej. sqlite:///./server_chat.db"
+    )
+    sub.add_parser("listar", help="Muestra los shards configurados y sus mensajes")
+    args = parser.parse_args()
+
+    if args.comando == "rebalancear":
+        resultado = rebalancear(args.desde)
+        print(f"✅ Movidas {resultado['sesiones']} sesiones ({resultado['mensajes']} mensajes)")
+    else:
+        inicializar_shards()
+        for shard in SHARDS:
+            with shard.engine.connect() as conn:
+                total = conn.execute(select(func.count(Mensaje.id))).scalar_one()
+            print(f"Shard {shard.indice}: {shard.url} ({total} mensajes)")
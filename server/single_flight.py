@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable
+import metrics
+
+
+ejecuciones = metrics.counter(
+    "singleflight_executions_total",
+    "Operaciones ejecutadas de verdad por grupo (llm / agentes / herramientas)"
+)
+agrupadas = metrics.counter(
+    "singleflight_coalesced_total",
+    "Llamadas que esperaron el resultado de una idéntica ya en curso, por grupo"
+)
+
+
+class SingleFlight:
+    """
+    Agrupa las llamadas asíncronas idénticas que coinciden en el tiempo: la
+    primera ejecuta la operación y las que llegan mientras está en curso
+    esperan y reciben el mismo resultado (o la misma excepción). No guarda
+    nada: en cuanto termina, la siguiente llamada vuelve a ejecutar.
+    """
+
+    def __init__(self, grupo: str):
+        self.grupo = grupo  # Etiqueta de las métricas
+        self._en_curso: Dict[Hashable, asyncio.Future] = {}
+
+    async def ejecutar(self, clave: Hashable, operacion: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Ejecuta la operación o se une a una idéntica en curso.
+
+        Args:
+            clave: Identifica las llamadas equivalentes
+            operacion: Función sin argumentos que devuelve la corrutina a ejecutar
+
+        Returns:
+            Resultado de la operación
+        """
+        contada = False
+        while clave in self._en_curso:
+            futuro = self._en_curso[clave]
+            if not contada:
+                agrupadas.inc(grupo=self.grupo)
+                contada = True
+            try:
+                # shield: si se cancela esta llamada no se cancela la que ejecuta
+                return await asyncio.shield(futuro)
+            except asyncio.CancelledError:
+                if not futuro.cancelled():
+                    raise
+                # Se canceló la que ejecutaba, no esta: se vuelve a intentar
+
+        ejecuciones.inc(grupo=self.grupo)
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_curso[clave] = futuro
+        try:
+            resultado = await operacion()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                futuro.cancel()
+            else:
+                futuro.set_exception(e)
+                # Marcar la excepción como recuperada si nadie más la esperaba
+                futuro.exception()
+            raise
+        finally:
+            if self._en_curso.get(clave) is futuro:
+                del self._en_curso[clave]
+        futuro.set_result(resultado)
+        return resultado
+
+    def __len__(self) -> int:
+        return len(self._en_curso)
+
+
+class SingleFlightHilos:
+    """
+    Variante de SingleFlight para funciones síncronas que se ejecutan en
+    varios hilos (las herramientas, que LangChain lanza en un executor).
+    """
+
+    def __init__(self, grupo: str):
+        self.grupo = grupo
+        self._en_curso: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def ejecutar(self, clave: Hashable, funcion: Callable[[], Any]) -> Any:
+        """
+        Ejecuta la función o espera a una idéntica en curso en otro hilo.
+
+        Args:
+            clave: Identifica las llamadas equivalentes
+            funcion: Función sin argumentos
+
+        Returns:
+            Resultado de la función
+        """
+        with self._lock:
+            futuro = self._en_curso.get(clave)
+            ejecuta = futuro is None
+            if ejecuta:
+                futuro = Future()
+                self._en_curso[clave] = futuro
+
+        if not ejecuta:
+            agrupadas.inc(grupo=self.grupo)
+            return futuro.result()
+
+        ejecuciones.inc(grupo=self.grupo)
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
@@ -0,0 +1,268 @@
+import json
+import re
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from langchain_core.messages import HumanMessage, SystemMessage
+from sqlalchemy import delete
+from database import AsyncSessionLocal
+from models import EstadoCreacion
+from tools import crear_cliente
+from llm import llm
+from limitador_llm import LLMNoDisponible
+from config import SLOT_TTL_MINUTES
+import metrics
+
+
+PATRON_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+_LETRA = r"A-Za-zÁÉÍÓÚÜÑáéíóúüñ"
+_PALABRA = rf"[{_LETRA}][{_LETRA}'-]*"
+# Palabras que cortan un nombre ("Juan con email ...", "Ana y su correo ...")
+_CORTE = r"(?:con|y|e|email|correo|mail|su|cuyo|cuya|que|para)"
+# Partículas de los nombres compuestos ("María José de la Cruz"): no cuentan
+# para el límite de palabras y se conservan tal como las escribe el usuario
+_PARTICULAS = {"de", "del", "la", "las", "los", "y"}
+_PARTICULA = r"(?:de|del|la|las|los|y)"
+_MAX_PALABRAS_NOMBRE = 6
+# Respuestas cortas que no son un nombre aunque se esté esperando uno
+_NO_NOMBRE = {
+    "si", "sí", "no", "ok", "vale", "claro", "gracias", "hola", "bueno", "listo",
+    "quiero", "crear", "crea", "cliente", "nuevo", "nombre", "el", "la", "es",
+}
+
+# Marcadores explícitos: el texto que sigue es un nombre aunque esté en minúsculas
+PATRON_NOMBRE_EXPLICITO = re.compile(
+    rf"(?:me llamo|mi nombre es|su nombre es|el nombre es|nombre:?|se llama|llamad[oa])\s+"
+    rf"((?:(?:{_PARTICULA}\s+)*(?!{_CORTE}\b)(?!{_PARTICULA}\b){_PALABRA}\s*){{1,{_MAX_PALABRAS_NOMBRE}}})",
+    re.IGNORECASE
+)
+# Marcadores débiles: solo se aceptan nombres con mayúscula inicial ("crea a Juan Pérez")
+PATRON_NOMBRE_CAPITALIZADO = re.compile(
+    rf"\b(?:cliente|a)\b\s+((?:(?:{_PARTICULA}\s+)*[A-ZÁÉÍÓÚÑ][{_LETRA}'-]*\s*){{1,{_MAX_PALABRAS_NOMBRE}}})"
+)
+# Saludo con vocativo al principio del mensaje ("Hola Ana, ...", "Buenos días Bot: ..."):
+# el nombre al que se saluda no es el del cliente
+PATRON_SALUDO = re.compile(
+    r"^\s*(?:hola|buenas|buenos días|buenos dias|buenas tardes|buenas noches|hey|oye)\b[^,.:;!?¡¿]*[,.:;!?]+",
+    re.IGNORECASE
+)
+# Respuestas a la confirmación de un nombre dudoso
+_AFIRMACIONES = {"si", "sí", "vale", "ok", "claro", "confirmo", "correcto", "adelante", "exacto", "perfecto"}
+_NEGACIONES = {"no", "nop", "incorrecto", "cancela"}
+
+PREGUNTAS = {
+    (False, False): "Para crear el cliente necesito su nombre y su email. ¿Cuáles son?",
+    (True, False): "¿Cuál es el email de {nombre}?",
+    (False, True): "¿Cuál es el nombre del cliente con email {email}?",
+}
+PREGUNTA_CONFIRMAR = "¿Creo el cliente {nombre} con email {email}? Responde sí o no (o dime el nombre correcto)."
+
+prompt_extraccion = """Extrae el nombre y el email del cliente que aparecen en el mensaje del usuario.
+Responde SOLO con JSON: {"nombre": "...", "email": "..."}
+Usa null para el dato que no aparezca. No inventes datos."""
+
+extracciones = metrics.counter(
+    "slot_extractions_total",
+    "Extracciones de slots del flujo crear por método (local / llm)"
+)
+
+
+def extraer_email(texto: str) -> Optional[str]:
+    """
+    Devuelve el primer email del texto o None.
+    """
+    coincidencia = PATRON_EMAIL.search(texto)
+    return coincidencia.group(0).lower() if coincidencia else None
+
+
+def extraer_nombre(texto: str, esperando_nombre: bool = False) -> Tuple[Optional[str], bool]:
+    """
+    Extrae un nombre de persona con reglas locales.
+
+    Args:
+        texto: Mensaje del usuario
+        esperando_nombre: True si el asistente acaba de pedir el nombre; en ese caso
+            un mensaje corto sin marcadores ("juan pérez") se toma como el nombre
+
+    Returns:
+        Tuple[nombre, dudoso]: Nombre con mayúsculas iniciales (o None) y True si
+            salió de un marcador débil o se cortó en el límite de palabras, y
+            conviene confirmarlo antes de crear
+    """
+    sin_email = PATRON_SALUDO.sub(" ", PATRON_EMAIL.sub(" ", texto))
+
+    coincidencia = PATRON_NOMBRE_EXPLICITO.search(sin_email)
+    if coincidencia:
+        return _formatear_nombre(coincidencia.group(1)), _cortado(sin_email, coincidencia)
+    coincidencia = PATRON_NOMBRE_CAPITALIZADO.search(sin_email)
+    if coincidencia:
+        return _formatear_nombre(coincidencia.group(1)), True
+
+    if esperando_nombre:
+        palabras = re.findall(_PALABRA, sin_email)
+        principales = [p for p in palabras if p.lower() not in _PARTICULAS]
+        if 1 <= len(principales) <= _MAX_PALABRAS_NOMBRE \
+                and palabras[0].lower() not in _PARTICULAS \
+                and not any(p.lower() in _NO_NOMBRE for p in principales) \
+                and not re.search(rf"\b{_CORTE}\b", sin_email, re.IGNORECASE):
+            return _formatear_nombre(" ".join(palabras)), False
+    return None, False
+
+
+def _cortado(texto: str, coincidencia: re.Match) -> bool:
+    """
+    True si el nombre se cortó en el límite de palabras: lo siguiente es otra
+    palabra que no es de corte (y no el final del texto, un signo o "con ...").
+    """
+    siguiente = re.match(rf"\s*({_PALABRA})", texto[coincidencia.end():])
+    return siguiente is not None and not re.fullmatch(_CORTE, siguiente.group(1), re.IGNORECASE)
+
+
+def _formatear_nombre(nombre: str) -> str:
+    # Mayúscula inicial salvo en las partículas, que quedan como las escribió el usuario
+    return " ".join(p if p.lower() in _PARTICULAS else p[:1].upper() + p[1:] for p in nombre.split())
+
+
+async def extraer_con_llm(mensaje: str, callbacks=None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Extracción de respaldo con una única llamada al LLM (sin bucle de agente).
+
+    Args:
+        mensaje: Mensaje del usuario
+        callbacks: Callbacks de LangChain opcionales
+
+    Returns:
+        Tuple[nombre, email], cada uno None si no se encontró
+
+    Raises:
+        LLMNoDisponible: LLM saturado o plazo de la etapa agotado
+    """
+    try:
+        respuesta = await llm.ainvoke(
+            [SystemMessage(content=prompt_extraccion), HumanMessage(content=mensaje)],
+            config={"callbacks": callbacks}
+        )
+        texto = respuesta.content.strip().strip("`")
+        datos = json.loads(texto[texto.find("{"):texto.rfind("}") + 1])
+    except LLMNoDisponible:
+        # LLM saturado: el turno recibe la respuesta degradada, no otra pregunta
+        raise
+    except Exception:
+        return None, None
+
+    nombre = datos.get("nombre") or None
+    email = datos.get("email") or None
+    if email and not PATRON_EMAIL.fullmatch(email.strip()):
+        email = None
+    return (_formatear_nombre(nombre) if nombre else None), (email.strip().lower() if email else None)
+
+
+class SlotStateManager:
+    """
+    Persiste los slots (nombre, email) de la creación en curso de cada sesión,
+    en la tabla estados_creacion junto a los mensajes.
+    """
+
+    @staticmethod
+    async def aget(session_id: str) -> Optional[EstadoCreacion]:
+        """
+        Devuelve el estado vigente de la sesión (None si no hay o ha caducado).
+        """
+        async with AsyncSessionLocal() as db:
+            estado = await db.get(EstadoCreacion, session_id)
+        if estado and estado.actualizado < datetime.utcnow() - timedelta(minutes=SLOT_TTL_MINUTES):
+            return None
+        return estado
+
+    @staticmethod
+    async def asave(session_id: str, nombre: Optional[str], email: Optional[str], nombre_dudoso: bool = False):
+        """
+        Crea o actualiza los slots de la sesión. nombre_dudoso indica que el
+        nombre salió de un marcador débil y hay que confirmarlo antes de crear.
+        """
+        async with AsyncSessionLocal() as db:
+            estado = await db.get(EstadoCreacion, session_id)
+            if estado is None:
+                estado = EstadoCreacion(session_id=session_id)
+                db.add(estado)
+            estado.nombre = nombre
+            estado.email = email
+            estado.nombre_dudoso = nombre_dudoso
+            estado.actualizado = datetime.utcnow()
+            await db.commit()
+
+    @staticmethod
+    async def aclear(session_id: str):
+        """
+        Elimina la creación en curso de la sesión.
+        """
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(EstadoCreacion).where(EstadoCreacion.session_id == session_id)
+            )
+            await db.commit()
+
+
+async def procesar_creacion(session_id: str, mensaje: str, callbacks=None) -> str:
+    """
+    Turno del flujo "crear" como máquina de estados de slots:
+    extrae nombre/email del mensaje con reglas locales (LLM solo si fallan),
+    y cuando ambos están completos llama directamente a crear_cliente. Si el
+    nombre salió de un marcador débil ("crea a Juan") se pide confirmación antes.
+
+    Args:
+        session_id: Identificador único de la sesión
+        mensaje: Mensaje actual del usuario
+        callbacks: Callbacks de LangChain para la extracción de respaldo y la herramienta
+
+    Returns:
+        str: Respuesta para el usuario
+    """
+    estado = await SlotStateManager.aget(session_id)
+    nombre = estado.nombre if estado else None
+    email = estado.email if estado else None
+    nombre_dudoso = bool(estado and estado.nombre_dudoso and nombre)
+
+    # 0. Slots completos con un nombre dudoso: se había pedido confirmación.
+    #    "Sí" crea, "no" descarta el nombre y lo demás se trata como corrección
+    if nombre_dudoso and email:
+        palabras = [p.lower() for p in re.findall(_PALABRA, PATRON_EMAIL.sub(" ", mensaje))]
+        if palabras and palabras[0] in _AFIRMACIONES and not extraer_email(mensaje):
+            await SlotStateManager.aclear(session_id)
+            return await crear_cliente.ainvoke({"nombre": nombre, "email": email}, config={"callbacks": callbacks})
+        if palabras and palabras[0] in _NEGACIONES:
+            mensaje = mensaje.split(None, 1)[1] if len(palabras) > 1 else ""
+            nombre, nombre_dudoso = None, False
+
+    # 1. Extracción local
+    email_local = extraer_email(mensaje)
+    nombre_local, dudoso = extraer_nombre(mensaje, esperando_nombre=estado is not None and not nombre)
+    # Un nombre dudoso de turnos anteriores lo sigue siendo mientras no se corrija
+    dudoso = dudoso if nombre_local else nombre_dudoso
+    if email_local or nombre_local:
+        extracciones.inc(metodo="local")
+    email = email_local or email
+    nombre = nombre_local or nombre
+
+    # 2. Respaldo con LLM solo si la extracción local no encontró nada y el
+    #    mensaje podía contener datos (respuesta a nuestra pregunta o mensaje largo)
+    if not (nombre and email) and not (email_local or nombre_local) \
+            and mensaje.strip() and (estado is not None or len(mensaje.split()) > 4):
+        nombre_llm, email_llm = await extraer_con_llm(mensaje, callbacks)
+        extracciones.inc(metodo="llm")
+        nombre = nombre or nombre_llm
+        email = email or email_llm
+
+    # 3. Faltan datos: guardar el progreso y preguntar solo por lo que falta
+    if not (nombre and email):
+        await SlotStateManager.asave(session_id, nombre, email, nombre_dudoso=dudoso and bool(nombre))
+        return PREGUNTAS[(bool(nombre), bool(email))].format(nombre=nombre, email=email)
+
+    # 4. Nombre de un marcador débil: confirmar antes de crear
+    if dudoso:
+        await SlotStateManager.asave(session_id, nombre, email, nombre_dudoso=True)
+        return PREGUNTA_CONFIRMAR.format(nombre=nombre, email=email)
+
+    # 5. Slots completos: ejecutar la herramienta directamente, sin agente
+    await SlotStateManager.aclear(session_id)
+    return await crear_cliente.ainvoke({"nombre": nombre, "email": email}, config={"callbacks": callbacks})
@@ -0,0 +1,82 @@
+import json
+import re
+from typing import Optional
+
+
+# Inicio del texto de la respuesta final en la salida del agente structured-chat:
+# {"action": "Final Answer", "action_input": "<texto>"}
+PATRON_RESPUESTA_FINAL = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+
+ESCAPES_JSON = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class ExtractorRespuestaFinal:
+    """
+    Extrae, token a token, el texto de "action_input" de la acción
+    "Final Answer" mientras el agente structured-chat la va generando.
+    Los pasos intermedios (llamadas a herramientas) no producen texto.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._inicio: Optional[int] = None  # Posición del primer carácter de la respuesta
+        self._posicion = 0  # Siguiente carácter del buffer por decodificar
+        self.terminado = False
+
+    def agregar(self, fragmento: str) -> str:
+        """
+        Añade un fragmento de la salida del LLM.
+
+        Args:
+            fragmento: Nuevo texto generado por el modelo
+
+        Returns:
+            str: Texto de la respuesta final decodificado en este fragmento (puede ser "")
+        """
+        if self.terminado:
+            return ""
+        self._buffer += fragmento
+
+        if self._inicio is None:
+            coincidencia = PATRON_RESPUESTA_FINAL.search(self._buffer)
+            if not coincidencia:
+                return ""
+            self._inicio = self._posicion = coincidencia.end()
+
+        salida = []
+        while self._posicion < len(self._buffer):
+            caracter = self._buffer[self._posicion]
+            if caracter == '"':
+                self.terminado = True
+                break
+            if caracter != "\\":
+                salida.append(caracter)
+                self._posicion += 1
+                continue
+            # Secuencia de escape: esperar a tenerla completa
+            if self._posicion + 1 >= len(self._buffer):
+                break
+            siguiente = self._buffer[self._posicion + 1]
+            if siguiente == "u":
+                if self._posicion + 6 > len(self._buffer):
+                    break
+                salida.append(chr(int(self._buffer[self._posicion + 2:self._posicion + 6], 16)))
+                self._posicion += 6
+            else:
+                salida.append(ESCAPES_JSON.get(siguiente, siguiente))
+                self._posicion += 2
+        return "".join(salida)
+
+
+def evento_sse(evento: str, datos: dict) -> str:
+    """
+    Formatea un evento Server-Sent Events.
+
+    Args:
+        evento: Nombre del evento ("decision", "token", "fin", "error")
+        datos: Carga útil serializable a JSON
+
+    Returns:
+        str: Evento listo para escribir en la respuesta
+    """
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
@@ -0,0 +1,18 @@
+# Aproximación estándar para modelos de OpenAI: ~4 caracteres por token.
+# Evita depender de tiktoken (que descarga sus tablas la primera vez).
+CARACTERES_POR_TOKEN = 4
+
+
+def contar_tokens(texto: str) -> int:
+    """
+    Estima el número de tokens de un texto.
+
+    Args:
+        texto: Texto a medir
+
+    Returns:
+        int: Número aproximado de tokens
+    """
+    if not texto:
+        return 0
+    return max(1, len(texto) // CARACTERES_POR_TOKEN)
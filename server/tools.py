@@ -1,6 +1,17 @@
+from typing import Optional
 from langchain.tools import tool
-from database import SessionLocal
+from database import SessionLocal, duracion_escrituras
 from models import Cliente
+from result_cache import ResultCache
+from config import RESULT_CACHE_MAX_ENTRIES
+import consultas
+import busqueda
+
+
+# Resultados de consultar/contar/buscar por filtros y versión de la tabla clientes.
+# crear_cliente incrementa la versión, así que las lecturas solo van a la base de
+# datos después de una escritura
+cache_clientes = ResultCache(RESULT_CACHE_MAX_ENTRIES)
 
 
 @tool
@@ -20,8 +31,10 @@ def crear_cliente(nombre: str, email: str) -> str:
     try:
         cliente = Cliente(nombre=nombre, email=email)
         db.add(cliente)
-        db.commit()
+        with duracion_escrituras.cronometrar(operacion="clientes"):
+            db.commit()
         db.refresh(cliente)
+        cache_clientes.invalidar()
         return f"✅ Cliente creado: {cliente.nombre} ({cliente.email})"
     except Exception as e:
         db.rollback()
@@ -31,20 +44,117 @@ def crear_cliente(nombre: str, email: str) -> str:
 
 
 @tool
-def consultar_clientes() -> str:
+def consultar_clientes(
+    dominio_email: Optional[str] = None,
+    nombre_prefijo: Optional[str] = None,
+    nombre_contiene: Optional[str] = None,
+    orden: str = "nombre",
+    limite: int = 20,
+    cursor: Optional[str] = None
+) -> str:
     """
-    Devuelve la lista de todos los clientes registrados en la base de datos.
+    Lista clientes registrados aplicando los filtros en la base de datos.
+    Usa los filtros en lugar de pedir todos los clientes y filtrar tú.
+
+    Args:
+        dominio_email: Solo clientes con este dominio de email (ej. "gmail.com" o "gmail")
+        nombre_prefijo: Solo clientes cuyo nombre empieza por este texto
+        nombre_contiene: Solo clientes cuyo nombre contiene este texto
+        orden: "nombre", "email" o "recientes"
+        limite: Número máximo de clientes a devolver (máximo 100)
+        cursor: Cursor de la página anterior para ver más resultados
 
     Returns:
         Lista formateada de clientes o mensaje si no hay clientes
     """
+    return cache_clientes.obtener(
+        "consultar",
+        (dominio_email, nombre_prefijo, nombre_contiene, orden, limite, cursor),
+        lambda: _consultar(dominio_email, nombre_prefijo, nombre_contiene, orden, limite, cursor)
+    )
+
+
+def _consultar(dominio_email, nombre_prefijo, nombre_contiene, orden, limite, cursor) -> str:
     db = SessionLocal()
     try:
-        clientes = db.query(Cliente).all()
-        if not clientes:
-            return "📭 No hay clientes registrados"
-        return "\n".join(
-            [f"- {c.nombre} | {c.email}" for c in clientes]
+        clientes, siguiente = consultas.consultar_pagina(
+            db, dominio_email, nombre_prefijo, nombre_contiene, orden, limite, cursor
         )
+    except ValueError as e:
+        return f"❌ Error: {str(e)}"
     finally:
         db.close()
+
+    if not clientes:
+        if dominio_email or nombre_prefijo or nombre_contiene or cursor:
+            return "📭 No hay clientes que coincidan"
+        return "📭 No hay clientes registrados"
+    texto = "\n".join(
+        [f"- {nombre} | {email}" for nombre, email in clientes]
+    )
+    if siguiente:
+        texto += f"\n(Hay más resultados: usa cursor=\"{siguiente}\")"
+    return texto
+
+
+@tool
+def contar_clientes(
+    dominio_email: Optional[str] = None,
+    nombre_prefijo: Optional[str] = None,
+    nombre_contiene: Optional[str] = None
+) -> str:
+    """
+    Cuenta los clientes registrados que cumplen los filtros, sin listarlos.
+
+    Args:
+        dominio_email: Solo clientes con este dominio de email (ej. "gmail.com" o "gmail")
+        nombre_prefijo: Solo clientes cuyo nombre empieza por este texto
+        nombre_contiene: Solo clientes cuyo nombre contiene este texto
+
+    Returns:
+        Número de clientes
+    """
+    return cache_clientes.obtener(
+        "contar",
+        (dominio_email, nombre_prefijo, nombre_contiene),
+        lambda: _contar(dominio_email, nombre_prefijo, nombre_contiene)
+    )
+
+
+def _contar(dominio_email, nombre_prefijo, nombre_contiene) -> str:
+    db = SessionLocal()
+    try:
+        total = consultas.contar(db, dominio_email, nombre_prefijo, nombre_contiene)
+    finally:
+        db.close()
+    return f"🔢 {total} cliente(s)"
+
+
+@tool
+def buscar_clientes(texto: str, limite: int = 10) -> str:
+    """
+    Busca clientes por nombre o email aunque el texto sea parcial o tenga
+    errores de escritura. Devuelve los más parecidos primero.
+
+    Args:
+        texto: Nombre, parte del nombre o del email a buscar
+        limite: Número máximo de resultados (máximo 50)
+
+    Returns:
+        Lista de coincidencias ordenadas por similitud
+    """
+    return cache_clientes.obtener("buscar", (texto, limite), lambda: _buscar(texto, limite))
+
+
+def _buscar(texto: str, limite: int) -> str:
+    db = SessionLocal()
+    try:
+        resultados = busqueda.buscar(db, texto, max(1, min(int(limite), busqueda.CANDIDATOS)))
+    finally:
+        db.close()
+
+    if not resultados:
+        return f"📭 No hay clientes parecidos a '{texto}'"
+    return "\n".join(
+        [f"- {nombre} | {email} (similitud {similitud:.2f})" for nombre, email, similitud in resultados]
+    )